@@ -1,3 +1,5 @@
+import re
+
 colors = {
     'black': '0;30', 'bright gray': '0;37',
     'blue': '0;34', 'white': '1;37',
@@ -13,6 +15,76 @@ colors = {
     'normal': '0'
 }
 
+# the escape sequences, built once
+CLOSE = "\033[0m"
+OPEN = dict((name, "\033[" + code + "m") for name, code in colors.items())
+
+# what a client can ask for: full color, the eight plain colors, or none
+FULL = "on"
+BASIC = "basic"
+OFF = "off"
+MODES = (FULL, BASIC, OFF)
+
+ESCAPE = re.compile("\033\\[[0-9;]*m")
+
 
 def colorfy(text, color):
-    return "\033[" + colors[color] + "m" + text + "\033[0m"
+    return OPEN[color] + text + CLOSE
+
+
+def spans(*segments):
+    """Colors several (text, color) segments and joins them in one go."""
+    parts = []
+    for text, color in segments:
+        parts.append(OPEN[color])
+        parts.append(text)
+        parts.append(CLOSE)
+    return "".join(parts)
+
+
+def basicSequence(match):
+    # bold/bright colors become their plain counterparts, except dark gray:
+    # plain black would vanish on a dark background, so it becomes gray
+    sequence = match.group(0)
+    if sequence == "\033[1;30m":
+        return "\033[0;37m"
+    if sequence.startswith("\033[1;3"):
+        return "\033[0;3" + sequence[5:]
+    return sequence
+
+
+# the last payload converted for each mode: a broadcast hands the same
+# bytes to everyone, so each mode converts it once
+converted = {BASIC: (None, None), OFF: (None, None)}
+
+
+def downgrade(payload, mode):
+    """Returns a payload as a client in the given mode should see it."""
+    if mode == FULL:
+        return payload
+    original, result = converted[mode]
+    if original is payload:
+        return result
+    if mode == OFF:
+        result = ESCAPE.sub("", payload)
+    else:
+        result = ESCAPE.sub(basicSequence, payload)
+    converted[mode] = (payload, result)
+    return result
+
+
+def listing():
+    """The colors command's list, one line per color with every name that
+       picks it."""
+    names = {}
+    for name, code in colors.items():
+        names.setdefault(code, []).append(name)
+    lines = ["    List of colors:"]
+    for code in sorted(names, key=lambda code: (code.split(";")[-1], code)):
+        aliases = sorted(names[code], key=lambda name: (len(name), name))
+        lines.append("        " + OPEN[aliases[0]] + aliases[0].upper() + CLOSE +
+                     "".join(" / " + alias.upper() for alias in aliases[1:]))
+    return "\n".join(lines)
+
+
+LISTING = listing()
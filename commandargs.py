@@ -0,0 +1,24 @@
+"""
+What a command handler is given: one CommandArgs per line a player types.
+
+    name - command name
+    tokens - full input, tokenized
+    full - full input, untokenized
+    actor - being object who used the command
+
+Routing spells out shorthands, aliases and prefixes by changing the args
+in place, so a command costs one of these however it was typed.
+"""
+
+
+class CommandArgs(object):
+    __slots__ = ('name', 'tokens', 'full', 'actor')
+
+    def __init__(self, name, tokens, full, actor):
+        self.name = name
+        self.tokens = tokens
+        self.full = full
+        self.actor = actor
+
+    def __repr__(self):
+        return "CommandArgs(name=%r, tokens=%r, full=%r, actor=%r)" % (self.name, self.tokens, self.full, self.actor)
@@ -1,13 +1,79 @@
 import functionmapper
 import threading
-import time
-import namedtuple
 import traceback
+import dispatchqueue
+import metrics
+import ratelimit
+import time
+from commandargs import CommandArgs
+
+dispatchers = []
+dispatchersLock = threading.Lock()
+dispatching = False
+
+TOO_FAST = "You're doing that too often. Wait a moment and try again."
+
+
+class Dispatcher(object):
+    """A command queue and the worker thread that empties it. Every session
+       instance (room) gets its own, so a busy room never holds up a quiet
+       one."""
+
+    def __init__(self, name="Dispatcher"):
+        self.name = name
+        self.queue = dispatchqueue.CommandQueue()
+        self.thread = None
+        self.finish = None
+        with dispatchersLock:
+            dispatchers.append(self)
+            if dispatching:
+                self.start()
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.dispatchForever, name=self.name)
+            self.thread.start()
+
+    def stop(self):
+        """Lets the worker finish every queued command, then stops it."""
+        self.queue.close()
+        if self.thread is not None and self.thread is not threading.current_thread():
+            self.thread.join()
+
+    def close(self, finish=None):
+        """Retires the dispatcher without waiting for it: the worker runs
+           what's already queued, then finish, then exits."""
+        with dispatchersLock:
+            if self in dispatchers:
+                dispatchers.remove(self)
+            self.finish = finish
+            started = self.thread is not None
+        self.queue.close()
+        if not started and finish is not None:
+            finish()
+
+    def put(self, args):
+        self.queue.put(args)
+
+    def dispatchForever(self):
+        while True:
+            # blocks until there is something to do, None means we're done
+            args = self.queue.get()
+            if args is None:
+                break
+            try:
+                dispatchCommand(args, self.queue.lastWait)
+            except:
+                # nothing gets past dispatchCommand on purpose; if something
+                # does, the room still has to keep running commands
+                print traceback.format_exc()
 
-CommandArgs = namedtuple.namedtuple('CommandArgs', 'name tokens full actor')
-commandsToExecute = []
-dispatcher = None
-parsing = True
+        if self.finish is not None:
+            self.finish()
+        print self.name + ": I am dead."
+
+
+defaultDispatcher = Dispatcher()
 
 
 def parseLine(line, entity):
@@ -18,44 +84,88 @@ def parseLine(line, entity):
 
 
 def queueCommand(args):
-    """Enqueues a command into the dispatch queue.
-       Args is in the following form: (name tokens full actor)"""
-    commandsToExecute.append(args)
+    """Enqueues a command into the dispatch queue of the actor's instance.
+       Args is a commandargs.CommandArgs."""
+    dispatcher = getattr(args.actor.instance, 'dispatcher', None)
+    if dispatcher is None:
+        dispatcher = defaultDispatcher
+    dispatcher.put(args)
+
+
+def queueStats():
+    """Returns the counters of every dispatch queue, keyed by dispatcher
+       name: current and max depth, commands enqueued and dispatched, and
+       average/max time spent waiting."""
+    with dispatchersLock:
+        return dict((d.name, d.queue.stats()) for d in dispatchers)
 
 
 def startDispatching():
-    dispatcher = threading.Thread(target=dispatchForever)
-    dispatcher.start()
+    """Starts every dispatcher, and any created from now on."""
+    global dispatching
+    with dispatchersLock:
+        dispatching = True
+        for dispatcher in dispatchers:
+            dispatcher.start()
 
 
 def stopDispatching():
-    global parsing
-    parsing = False
+    """Lets every dispatcher finish its queued commands, then stops them."""
+    global dispatching
+    with dispatchersLock:
+        dispatching = False
+        stopping = list(dispatchers)
+    for dispatcher in stopping:
+        dispatcher.stop()
+
+
+def dispatchCommand(args, wait=None):
+    if metrics.enabled:
+        timedDispatch(args, wait)
+        return
 
+    try:
+        function, args = functionmapper.router.route(args)
 
-def dispatchForever():
-    # need to do this shit in a new thread
-    while parsing:
-        # If we have no commands to execute, fuck it
-        if len(commandsToExecute) == 0:
-            time.sleep(0)
+        if function is None:
+            args.actor.sendMessage("What?")
+            return
+
+        if not ratelimit.admit(args.actor, args.name):
+            args.actor.sendMessage(TOO_FAST)
+            return
+
+        ret = function(args)  # this calls the function
+        if not ret:
+            args.actor.sendMessage("What?")
+    except:
+        print "Server: An error has occured."
+        print "-----------------------------"
+        print traceback.format_exc()
+
+
+def timedDispatch(args, wait):
+    """dispatchCommand, recording where the time went."""
+    start = time.time()
+    routed = start
+    name = "(unknown)"
+    ret = False
+    try:
+        function, args = functionmapper.router.route(args)
+        routed = time.time()
+
+        if function is None:
+            args.actor.sendMessage("What?")
         else:
-            # get the next command in the queue and execute it
-            args = commandsToExecute.pop()
-
-            args = functionmapper.shorthandHandler(args)
-            command = args.name
-
-            if command in functionmapper.commandFunctions:
-                try:
-                    ret = functionmapper.commandFunctions[command](args)  # this calls the function
-                    if not ret:
-                        args.actor.sendMessage("What?")
-                except:
-                    print "Server: An error has occured."
-                    print "-----------------------------"
-                    print traceback.format_exc()
+            name = args.name
+            if not ratelimit.admit(args.actor, args.name):
+                args.actor.sendMessage(TOO_FAST)
             else:
-                args.actor.sendMessage("What?")
-
-    print "Dispatcher: I am dead."
+                ret = function(args)
+                if not ret:
+                    args.actor.sendMessage("What?")
+    except:
+        print "Server: An error has occured."
+        print "-----------------------------"
+        print traceback.format_exc()
+    metrics.command(name, wait, routed - start, time.time() - routed, bool(ret))
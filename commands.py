@@ -1,20 +1,17 @@
-import sys
-import inspect
-import random
-import namedtuple
 import functionmapper
 import commandparser
 import entity
+import metrics
+import transcript
 from colorer import colors as swatch
-from colorer import colorfy
-
-CommandArgs = namedtuple.namedtuple('CommandArgs', 'name tokens full actor')
+from colorer import colorfy, spans
+import colorer
+from commandargs import CommandArgs
 
 """
 General, universal commands are defined here.
 
-Arguments for functions, in parameter 'args' look like this:
-(name, tokens, full, actor)
+Arguments for functions, in parameter 'args', are a commandargs.CommandArgs:
 name - command name
 tokens - full input, tokenized
 full - full input, untokenized
@@ -30,38 +27,31 @@ def help(args):
     """
     Check these helpfiles for something.
     syntax: help <subject>
+            help search <word> [word...]
             subject - the subject or command which you want to check for help
+            word - find every helpfile that mentions these words
     """
+    index = functionmapper.helpIndex
     if len(args.tokens) == 1:
-        commands = functionmapper.commandFunctions.keys()
-        commands.sort()
-
-        msg = "    "
-        i = 0
-        for command in commands:
-            msg = msg + command + (' ' * (15 - len(command)))
-            i = (i + 1) % 4
-            if i == 0:
-                msg = msg + "\n    "
-
-        args.actor.sendMessage("There are help files on the following commands.\nType help <command> for details.")
-        args.actor.sendMessage(msg)
-
+        args.actor.sendPayload(index.contents())
         return True
 
-    helpFunctionName = args.tokens[1]
-    functions = inspect.getmembers(sys.modules[__name__], inspect.isfunction)
-    docstring = None
-    for functionName, function in functions:
-        if functionName == helpFunctionName:
-            docstring = function.__doc__
+    if args.tokens[1] == 'search':
+        if len(args.tokens) < 3:
+            return False
+        text = args.full[len(args.tokens[0] + " " + args.tokens[1] + " "):]
+        found = index.search(text)
+        if len(found) == 0:
+            args.actor.sendMessage("No helpfiles mention " + text + ".")
+        else:
+            args.actor.sendMessage("Helpfiles mentioning " + text + ":\n    " + ", ".join(found))
+        return True
 
-    if docstring is None:
+    page = index.page(args.tokens[1])
+    if page is None:
         args.actor.sendMessage("There is no helpfile for " + args.tokens[1] + ".")
     else:
-        prelude = "help file for: " + args.tokens[1] + "\n" + ("-" * len("help file for: " + args.tokens[1]))
-        prelude = colorfy(prelude, 'green')
-        args.actor.sendMessage(prelude + docstring)
+        args.actor.sendPayload(page)
 
     return True
 
@@ -140,12 +130,8 @@ def say(args):
     if msg[-1] not in ('.', '!', '?'):
         msg = msg + '.'
 
-    marking = colorfy(marking, 'yellow')
-    for e in args.actor.instance.connections:
-        if e == args.actor:
-            e.sendMessage(marking + colorfy('You say, "' + msg + '"', "white"))
-        else:
-            e.sendMessage(marking + colorfy(args.actor.name + ' says, "' + msg + '"', "white"))
+    args.actor.instance.broadcast(spans((marking, 'yellow'), (args.actor.name + ' says, "' + msg + '"', "white")),
+                                  actor=args.actor, actorMessage=spans((marking, 'yellow'), ('You say, "' + msg + '"', "white")))
 
     return True
 
@@ -163,12 +149,12 @@ def pm(args):
     if not len(args.tokens) >= 3:
         return False
 
-    for e in args.actor.instance.connections:
-        if e.name.lower() == args.tokens[1].lower():
-            e.sendMessage(colorfy("[" + args.actor.name + ">>] " +
-                          args.full[len(args.tokens[0] + " " + args.tokens[1] + " "):], 'purple'))
-            args.actor.sendMessage(colorfy("[>>" + e.name + "] " +
-                                   args.full[len(args.tokens[0] + " " + args.tokens[1] + " "):], 'purple'))
+    e = args.actor.instance.world.findPlayer(args.tokens[1])
+    if e is not None:
+        e.sendMessage(colorfy("[" + args.actor.name + ">>] " +
+                      args.full[len(args.tokens[0] + " " + args.tokens[1] + " "):], 'purple'))
+        args.actor.sendMessage(colorfy("[>>" + e.name + "] " +
+                               args.full[len(args.tokens[0] + " " + args.tokens[1] + " "):], 'purple'))
     return True
 
 
@@ -238,28 +224,28 @@ def whisper(args):
     if msg[-1] not in ('.', '!', '?'):
         msg = msg + '.'
 
-    marking = colorfy(marking, 'yellow')
-
-    for e in args.actor.instance.connections:
-        if e == args.actor:
-            e.sendMessage(marking + colorfy('You whisper, "' + msg + '"', "dark gray"))
-        else:
-            e.sendMessage(marking + colorfy(args.actor.name + ' whispers, "' + msg + '"', 'dark gray'))
+    args.actor.instance.broadcast(spans((marking, 'yellow'), (args.actor.name + ' whispers, "' + msg + '"', 'dark gray')),
+                                  actor=args.actor, actorMessage=spans((marking, 'yellow'), ('You whisper, "' + msg + '"', "dark gray")))
 
     return True
 
 
 def who(args):
     """
-    See who is connected to the MUSH server.
+    See who is connected to the MUSH server. When there is more than one
+    room, everyone's room is shown next to their name.
 
     syntax: who
     """
+    world = args.actor.instance.world
+    showRooms = len(world.listRooms()) > 1
     msg = colorfy("Currently connected players:\n", "bright blue")
-    for e in args.actor.instance.connections:
+    for e in world.allPlayers():
         name = colorfy(e.name, "bright blue")
         if e.dm:
             name = name + colorfy(" (DM)", "bright red")
+        if showRooms:
+            name = name + colorfy(" [" + e.instance.name + "]", "dark gray")
         msg = msg + "    " + name + "\n"
     args.actor.sendMessage(msg)
     return True
@@ -271,20 +257,80 @@ def logout(args):
 
     syntax: logout
     """
-    for e in args.actor.instance.connections:
-        if e == args.actor:
-            args.actor.sendMessage(colorfy("[SERVER] You have quit the session.", "bright yellow"))
-        else:
-            e.sendMessage(colorfy("[SERVER] " + args.actor.name + " has quit the session.", "bright yellow"))
+    args.actor.instance.broadcast(colorfy("[SERVER] " + args.actor.name + " has quit the session.", "bright yellow"),
+                                  actor=args.actor, actorMessage=colorfy("[SERVER] You have quit the session.", "bright yellow"))
     try:
         args.actor.proxy.running = False
-        args.actor.instance.connections.remove(args.actor)
+        args.actor.instance.world.leave(args.actor)
         args.actor.proxy.kill()
     except:
         return True
     return True
 
 
+def join(args):
+    """
+    Move to another room. Each room has its own scene, and only the people
+    in a room hear what is said there. Everyone starts out in the lobby.
+    Only a DM can open a room that doesn't exist yet, and a room nobody is
+    in closes again, though its scene is kept.
+
+    syntax: join <room>
+
+    example:
+        join tavern
+        >> You join the tavern.
+
+    To see which rooms exist, type "rooms".
+    """
+    if len(args.tokens) != 2:
+        return False
+
+    world = args.actor.instance.world
+    name = args.tokens[1]
+    room = world.room(name, create=args.actor.dm)
+    if room is None:
+        if not args.actor.dm and not world.exists(name):
+            args.actor.sendMessage("There is no room called " + name.lower() + ". Only a DM can open a new one.")
+        else:
+            args.actor.sendMessage("The server has as many rooms open as it can hold. Try one that's already open.")
+        return True
+    if room is args.actor.instance:
+        args.actor.sendMessage("You are already in the " + room.name + ".")
+        return True
+
+    world.move(args.actor, room)
+    return True
+
+
+def rooms(args):
+    """
+    List the rooms on the server and how many people are in each, then the
+    empty rooms whose scenes are kept. DMs also see how often each room's
+    scene was served from its cache by look.
+
+    syntax: rooms
+    """
+    world = args.actor.instance.world
+    msg = colorfy("Rooms:\n", "bright blue")
+    shown = set()
+    for room in world.listRooms():
+        shown.add(room.name)
+        line = room.name + (' ' * (15 - len(room.name))) + str(len(room.connections))
+        if args.actor.dm and hasattr(room, 'cacheStats'):
+            stats = room.cacheStats()
+            line = line + "    look cache: " + str(stats['hits']) + " hits, " + str(stats['misses']) + " misses"
+        if room is args.actor.instance:
+            line = line + colorfy(" (you are here)", "dark gray")
+        msg = msg + "    " + line + "\n"
+    if world.archive is not None:
+        for name in world.archive.names():
+            if name not in shown:
+                msg = msg + "    " + name + (' ' * (15 - len(name))) + "0" + colorfy(" (stored)", "dark gray") + "\n"
+    args.actor.sendMessage(msg)
+    return True
+
+
 def emote(args):
     """
     Perform an emote. Use the ";" token as a placeholder for your name.
@@ -318,8 +364,7 @@ def emote(args):
 
     rest = rest.replace(';', args.actor.name)
 
-    for e in args.actor.instance.connections:
-        e.sendMessage(colorfy(marking + rest, "dark gray"))
+    args.actor.instance.broadcast(colorfy(marking + rest, "dark gray"), actor=args.actor)
 
     return True
 
@@ -354,83 +399,88 @@ def ooc(args):
 
     rest = args.full[len(args.name + " "):]
 
-    for e in args.actor.instance.connections:
-        e.sendMessage(marking + rest)
+    args.actor.instance.broadcast(marking + rest, actor=args.actor)
 
     return True
 
 
-def roll(args):
+def plugins(args):
     """
-    Roll a dice of a specified number of sides. The dice roll is public.
+    A DM may list the command plugins, and reload the ones that changed
+    without anyone being disconnected.
 
-    syntax: roll <number>d<sides> [reason]
+    syntax: plugins
+            plugins reload [plugin]
 
-    example:
-        roll 1d20
-        >>[DICE] DM_Eitan rolls 1d20.
-        >>  18
+    With no plugin named, reload picks up every plugin whose file changed
+    and any new ones.
+    """
+    if not args.actor.dm:
+        return False
 
-        roll 2d6 damage
-        >>[DICE (damage)] Justin rolls 2d6.
-        >>  3
-        >>  5
+    loader = functionmapper.plugins
 
+    if len(args.tokens) == 1:
+        msg = colorfy("Plugins:", "bright blue")
+        for name, loaded, names in loader.listPlugins():
+            state = "loaded" if loaded else "not loaded yet"
+            msg = msg + "\n    " + name + (' ' * (15 - len(name))) + state + (' ' * (16 - len(state))) + ", ".join(names)
+        args.actor.sendMessage(msg)
 
-    Alternatively, as a shorthand, you may roll a single die of N sides
-    with no specified purpose with the "#" token (no space).
+    elif args.tokens[1] == "reload" and len(args.tokens) <= 3:
+        name = None
+        if len(args.tokens) == 3:
+            name = args.tokens[2]
+        results = loader.reload(name)
+        if len(results) == 0:
+            args.actor.sendMessage("No plugins have changed.")
+            return True
+        lines = []
+        for plugin, error in results:
+            if error is None:
+                lines.append("Reloaded " + plugin + ".")
+            else:
+                lines.append(colorfy("Could not reload " + plugin + ": " + error, "bright red"))
+        args.actor.sendMessage("\n".join(lines))
 
-    example:
-        #20
-        >>[DICE] DM_Eitan rolls 1d20.
-        >>  18
+    else:
+        return False
 
+    return True
 
-    Rolls can also be kept hidden from others. To do this, use the
-    command "hroll" instead of "roll".
 
-    example:
-        hroll 1d20
+def stats(args):
     """
-    if len(args.tokens) < 2:
-        return False
-
-    # simple case
-    num = 0
-    sides = 0
-    purpose = ""
+    A DM may see where the server's time goes: how often each command ran,
+    how long it took (median, 95th percentile and worst), how long it sat
+    in the queue first and how long routing it took, and how much each
+    player has been sent.
 
-    dice = args.tokens[1].split('d')
-    if len(dice) != 2:
-        return False
+    syntax: stats
+            stats <on|off|reset>
 
-    try:
-        num = int(dice[0])
-        sides = int(dice[1])
-    except:
+    Nothing is recorded until stats are turned on, either here or by
+    starting the server with --metrics.
+    """
+    if not args.actor.dm:
         return False
 
-    visible = True
-    if args.tokens[0] == 'hroll':
-        visible = False
-
-    purpose = args.full[len(args.tokens[0] + " " + args.tokens[1] + " "):]
+    if len(args.tokens) == 1:
+        if not metrics.enabled:
+            args.actor.sendMessage("Stats are off. Type \"stats on\" to start recording.")
+            return True
+        args.actor.sendMessage("\n".join(metrics.report()))
 
-    marking = "[DICE"
-    if purpose != "":
-        marking = marking + " (" + purpose + ")"
-    marking = marking + "] "
-    marking = colorfy(marking, 'bright yellow')
+    elif len(args.tokens) == 2 and args.tokens[1] in ("on", "off"):
+        metrics.enabled = args.tokens[1] == "on"
+        args.actor.sendMessage("Stats are " + args.tokens[1] + ".")
 
-    dice = []
-    for i in range(num):
-        dice.append(random.randint(1, sides))
+    elif len(args.tokens) == 2 and args.tokens[1] == "reset":
+        metrics.reset()
+        args.actor.sendMessage("Stats have been reset.")
 
-    for e in args.actor.instance.connections:
-        if visible or e == args.actor:
-            e.sendMessage(marking + args.actor.name + " rolls " + str(num) + "d" + str(sides) + ".")
-            for die in dice:
-                e.sendMessage("  " + str(die))
+    else:
+        return False
 
     return True
 
@@ -528,9 +578,7 @@ def display(args):
                 return False
             target_name = args.tokens[4]
 
-            for e in args.actor.instance.connections:
-                if e.name.lower() == target_name.lower():
-                    target = e
+            target = args.actor.instance.findConnection(target_name)
 
             if target == None:
                 return False
@@ -543,8 +591,7 @@ def display(args):
     if target != None:
         target.sendMessage(rest)
     else:
-        for e in args.actor.instance.connections:
-            e.sendMessage(rest)
+        args.actor.instance.broadcast(rest, actor=args.actor)
 
     return True
 
@@ -589,11 +636,8 @@ def status(args):
 
     status = status[0].lower() + status[1:]
 
-    for e in args.actor.instance.connections:
-        if e == args.actor:
-            e.sendMessage(colorfy(">You are " + status, "dark gray"))
-        else:
-            e.sendMessage(colorfy(">" + args.actor.name + " is " + status, "dark gray"))
+    args.actor.instance.broadcast(colorfy(">" + args.actor.name + " is " + status, "dark gray"),
+                                  actor=args.actor, actorMessage=colorfy(">You are " + status, "dark gray"))
 
     return True
 
@@ -608,14 +652,14 @@ def glance(args):
     if len(args.tokens) < 2:
         return False
 
-    for e in args.actor.instance.connections:
-        if e.name.lower() == args.tokens[1].lower():
-            args.actor.sendMessage("You glance at " + e.name + ".")
-            if e.status == "":
-                return True
-            status = e.status[0].lower() + e.status[1:]
-            args.actor.sendMessage("  " + e.name + " is " + colorfy(status, "dark gray"))
+    e = args.actor.instance.findConnection(args.tokens[1])
+    if e is not None:
+        args.actor.sendMessage("You glance at " + e.name + ".")
+        if e.status == "":
             return True
+        status = e.status[0].lower() + e.status[1:]
+        args.actor.sendMessage("  " + e.name + " is " + colorfy(status, "dark gray"))
+        return True
 
     args.actor.sendMessage('There is no player "' + args.tokens[1] + '" here.')
     return True
@@ -624,30 +668,27 @@ def glance(args):
 def colors(args):
     """
     Displays a list of the colors available for use in certain commands.
+    You may also choose how colors reach you: in full, in the eight basic
+    colors only (for terminals that show bright colors badly), or not at
+    all.
 
     syntax: colors
+            colors <on|basic|off>
     """
+    if len(args.tokens) == 1:
+        args.actor.sendMessage(colorer.LISTING)
+        return True
 
-    msg = """    List of colors:
-        \033[1;34mDEFAULT\033[0m
-        \033[1;37mWHITE\033[0m
-        \033[0;37mBGRAY\033[0m
-        \033[1;30mDGRAY\033[0m
-        \033[0;30mBLACK\033[0m
-        \033[0;34mBLUE\033[0m
-        \033[1;34mBBLUE\033[0m
-        \033[0;36mCYAN\033[0m
-        \033[1;36mBCYAN\033[0m
-        \033[0;32mGREEN\033[0m
-        \033[1;32mBGREEN\033[0m
-        \033[0;33mYELLOW\033[0m
-        \033[1;33mBYELLOW\033[0m
-        \033[0;31mRED\033[0m
-        \033[1;31mBRED\033[0m
-        \033[0;35mPURPLE\033[0m
-        \033[1;35mBPURPLE\033[0m
-    """
-    args.actor.sendMessage(msg)
+    if len(args.tokens) != 2 or args.tokens[1] not in colorer.MODES:
+        return False
+
+    args.actor.color = args.tokens[1]
+    if args.actor.color == colorer.OFF:
+        args.actor.sendMessage("Colors are off.")
+    elif args.actor.color == colorer.BASIC:
+        args.actor.sendMessage(colorfy("Colors are limited to the basic eight.", "bright green"))
+    else:
+        args.actor.sendMessage(colorfy("Colors are on.", "bright green"))
     return True
 
 
@@ -703,20 +744,17 @@ def paint(args):
 
     if tokens[1] == "title":
         args.actor.instance.paintSceneTitle(colorfy(args.full[snipped + len(tokens[0] + " " + tokens[1] + " "):], color))
-        for e in args.actor.instance.connections:
-            e.sendMessage(colorfy(args.actor.name + " paints a scene.", "bright red"))
+        args.actor.instance.broadcast(colorfy(args.actor.name + " paints a scene.", "bright red"))
 
     elif tokens[1] == "body":
         args.actor.instance.paintSceneBody(colorfy(args.full[snipped + len(tokens[0] + " " + tokens[1] + " "):], color))
-        for e in args.actor.instance.connections:
-            e.sendMessage(colorfy(args.actor.name + " paints a scene.", "bright red"))
+        args.actor.instance.broadcast(colorfy(args.actor.name + " paints a scene.", "bright red"))
 
     elif tokens[1] == "object":
         if len(tokens) < 4:
             return False
         args.actor.instance.paintObject(tokens[2], colorfy(args.full[snipped + len(tokens[0] + " " + tokens[1] + " " + tokens[2] + " "):], color))
-        for e in args.actor.instance.connections:
-            e.sendMessage(colorfy(args.actor.name + " paints a " + tokens[2] + ".", "bright red"))
+        args.actor.instance.broadcast(colorfy(args.actor.name + " paints a " + tokens[2] + ".", "bright red"))
 
     else:
         return False
@@ -743,8 +781,7 @@ def erase(args):
 
     if args.tokens[1] == "scene":
         args.actor.instance.wipeScene()
-        for e in args.actor.instance.connections:
-            e.sendMessage(colorfy(args.actor.name + " erases the scene.", "bright red"))
+        args.actor.instance.broadcast(colorfy(args.actor.name + " erases the scene.", "bright red"))
 
     elif args.tokens[1] == "object":
         if len(args.tokens) < 3:
@@ -752,8 +789,7 @@ def erase(args):
 
         if args.tokens[2].lower() in args.actor.instance.objects:
             args.actor.instance.eraseObject(args.tokens[2])
-            for e in args.actor.instance.connections:
-                e.sendMessage(colorfy(args.actor.name + " erases the " + args.tokens[2] + ".", "bright red"))
+            args.actor.instance.broadcast(colorfy(args.actor.name + " erases the " + args.tokens[2] + ".", "bright red"))
 
     else:
         return False
@@ -773,9 +809,140 @@ def wipe(args):
     args.actor.instance.wipeScene()
     args.actor.instance.wipeObjects()
 
-    for e in args.actor.instance.connections:
-        e.sendMessage(colorfy(args.actor.name + " wipes the whole scene.", "bright red"))
+    args.actor.instance.broadcast(colorfy(args.actor.name + " wipes the whole scene.", "bright red"))
+
+    return True
+
+
+def scene(args):
+    """
+    A DM may save the scene and objects painted in a room under a name, and
+    load them again later in any room. Loading replaces the whole scene and
+    every object at once.
+
+    syntax: scene save <name>
+            scene load <name>
+            scene list
+
+    example:
+        scene save inferno
+        join cave
+        scene load inferno
+    """
+    if len(args.tokens) < 2:
+        return False
+
+    if not args.actor.dm:
+        return False
+
+    instance = args.actor.instance
+    library = instance.world.library
+    if library is None:
+        args.actor.sendMessage("There is no scene library on this server.")
+        return True
+
+    if args.tokens[1] == "list" and len(args.tokens) == 2:
+        saved = library.names()
+        if len(saved) == 0:
+            args.actor.sendMessage("No scenes have been saved yet.")
+            return True
+        msg = colorfy("Saved scenes:\n", "bright blue")
+        for name, count, saved_at in saved:
+            msg = msg + "    " + name + (' ' * (20 - len(name))) + str(count) + " objects\n"
+        args.actor.sendMessage(msg)
+
+    elif args.tokens[1] == "save" and len(args.tokens) == 3:
+        library.save(args.tokens[2], instance.scene_title, instance.scene_body, instance.objects)
+        args.actor.sendMessage(colorfy("Saved the scene as " + args.tokens[2].lower() + ".", "bright red"))
+
+    elif args.tokens[1] == "load" and len(args.tokens) == 3:
+        saved = library.load(args.tokens[2])
+        if saved is None:
+            args.actor.sendMessage('There is no saved scene called "' + args.tokens[2] + '".')
+            return True
+        instance.loadScene(*saved)
+        msg = colorfy(args.actor.name + " loads a scene.", "bright red")
+        view = instance.viewScene()
+        if view != "":
+            msg = msg + "\n" + view
+        instance.broadcast(msg, actor=args.actor)
+
+    else:
+        return False
+
+    return True
+
+
+def log(args):
+    """
+    Read back what has been said and done in the room you're in, even while
+    you were away.
+
+    syntax: log
+            log since <time>
+            log search [-s <speaker>] <words>
+
+            time - how long ago, like 30m, 2h or 3d, or a time of day like
+                   20:30, or a date like 2024-05-01 with or without a time
+            speaker - only what this player said or did
+            words - only lines with every one of these words in them
+
+    With nothing after it, log shows the last few lines.
+
+    examples:
+        log since 20:30
+        log search dragon gold
+        log search -s Justin
+    """
+    recording = args.actor.instance.transcript
+    if recording is None:
+        args.actor.sendMessage("Nothing is recorded in this room.")
+        return True
+
+    more = False
+    if len(args.tokens) == 1:
+        recording.flush()
+        found = recording.tail(20)
+        heading = "Lately in the " + args.actor.instance.name + ":"
+
+    elif args.tokens[1] == "since" and len(args.tokens) >= 3:
+        text = args.full[len(args.tokens[0] + " " + args.tokens[1] + " "):]
+        moment = transcript.parseTime(text)
+        if moment is None:
+            args.actor.sendMessage('"' + text + '" is not a time. Try something like 30m, 20:30 or 2024-05-01.')
+            return True
+        recording.flush()
+        found, more = recording.since(moment)
+        heading = "Since " + text + ":"
+
+    elif args.tokens[1] == "search" and len(args.tokens) >= 3:
+        speaker = None
+        text = args.full[len(args.tokens[0] + " " + args.tokens[1] + " "):]
+        if args.tokens[2] == "-s":
+            if len(args.tokens) < 4:
+                return False
+            speaker = args.tokens[3]
+            text = args.full[len(args.tokens[0] + " " + args.tokens[1] + " " + args.tokens[2] + " " + args.tokens[3] + " "):]
+        if speaker is None and len(transcript.words(text)) == 0:
+            return False
+        recording.flush()
+        found, more = recording.search(text, speaker)
+        heading = "Found in the log:"
 
+    else:
+        return False
+
+    if len(found) == 0:
+        args.actor.sendMessage("Nothing in the log.")
+        return True
+
+    msg = colorfy(heading, "bright blue") + "\n" + "\n".join(transcript.describe(event) for event in found)
+    if more:
+        if args.tokens[1] == "since":
+            msg = msg + "\n" + colorfy("...and more after that; try a later time.", "bright blue")
+        else:
+            msg = msg + "\n" + colorfy("...and older ones; only the latest " + str(len(found)) + " are shown.", "bright blue")
+    args.actor.sendMessage(msg)
     return True
 
 
@@ -789,16 +956,16 @@ def look(args):
     To view a list of objects in the scene, simply use look without arguments.
     """
     if len(args.tokens) == 1:
-        scene = args.actor.instance.viewScene()
-        if scene == "":
+        scene = args.actor.instance.scenePayload()
+        if scene is None:
             args.actor.sendMessage("The scene is blank.")
         else:
-            args.actor.sendMessage(scene)
+            args.actor.sendPayload(scene)
         return True
 
-    description = args.actor.instance.viewObject(args.tokens[1])
-    if description == "":
+    description = args.actor.instance.objectPayload(args.tokens[1])
+    if description is None:
         args.actor.sendMessage('There is no "' + args.tokens[1] + '" in the scene.')
     else:
-        args.actor.sendMessage(description)
+        args.actor.sendPayload(description)
     return True
@@ -0,0 +1,397 @@
+import re
+import time
+import random
+import threading
+from collections import OrderedDict
+
+"""
+Dice expressions: parsing them, rolling them and describing the result.
+
+An expression is a sum of terms, each a number or a pool of dice:
+
+    3d6         three six sided dice
+    d20         one die; d% is a d100
+    4d6kh3      keep the highest three (kl keeps the lowest, dh and dl drop)
+    2d20k1      k is short for kh
+    3d6!        exploding: every die that rolls its maximum adds another die
+    adv, dis    a d20 rolled with advantage or disadvantage (2d20kh1, 2d20kl1)
+    4d6kh3+2    terms are joined with + and -
+
+Parsed expressions are cached, so a table rolling the same thing all night
+parses it once. Big pools are rolled in one batch, with NumPy when it is
+installed, and are summarized rather than listed die by die.
+"""
+
+# limits on a single roll
+maxDice = 1000000
+maxSides = 1000000
+maxTerms = 20
+timeLimit = 0.5
+
+# pools up to this size have every die listed
+detailLimit = 20
+# pools this big or bigger go through NumPy, when it's there
+batchSize = 1000
+parseCacheSize = 256
+
+# NumPy is slow to import, so that waits for the first pool big enough
+numpy = None
+numpyTried = False
+
+NUMBER = re.compile(r"\d+")
+DICE = re.compile(r"(\d*)d(\d+|%)")
+KEEP = re.compile(r"(kh|kl|dh|dl|k)(\d*)")
+SHORTCUTS = {'adv': "2d20kh1", 'dis': "2d20kl1"}
+
+
+class DiceError(ValueError):
+    """A dice expression that can't be parsed or goes over the limits. The
+       message is meant for the player."""
+
+
+class Number(object):
+
+    def __init__(self, value):
+        self.value = value
+        self.label = str(value)
+
+    def roll(self, roller):
+        return Term(self.label, self.value)
+
+
+class Dice(object):
+
+    def __init__(self, count, sides, explode=False, keep=None, keepCount=1):
+        self.count = count
+        self.sides = sides
+        self.explode = explode
+        self.keep = keep
+        self.keepCount = keepCount
+        label = str(count) + "d" + str(sides)
+        if keep is not None:
+            label = label + keep + str(keepCount)
+        if explode:
+            label = label + "!"
+        self.label = label
+
+    def roll(self, roller):
+        pool = roller.dice(self.count, self.sides)
+        if self.explode and self.sides > 1:
+            extra = roller.count(pool, self.sides)
+            rolls = [pool]
+            while extra > 0:
+                more = roller.dice(extra, self.sides)
+                rolls.append(more)
+                extra = roller.count(more, self.sides)
+            pool = roller.join(rolls)
+
+        dropped = None
+        if self.keep is not None:
+            ordered = roller.sort(pool)
+            roller.check()
+            n = min(self.keepCount, len(ordered))
+            if self.keep == 'kh':
+                pool, dropped = ordered[len(ordered) - n:], ordered[:len(ordered) - n]
+            elif self.keep == 'kl':
+                pool, dropped = ordered[:n], ordered[n:]
+            elif self.keep == 'dh':
+                pool, dropped = ordered[:len(ordered) - n], ordered[len(ordered) - n:]
+            else:
+                pool, dropped = ordered[n:], ordered[:n]
+
+        total = int(sum(pool)) if not roller.isArray(pool) else int(pool.sum())
+        roller.check()
+        term = Term(self.label, total)
+        if len(pool) + (len(dropped) if dropped is not None else 0) <= detailLimit:
+            term.dice = [int(die) for die in pool]
+            if dropped is not None:
+                term.dropped = [int(die) for die in dropped]
+        else:
+            term.summary = roller.summarize(pool, self.sides, dropped)
+        return term
+
+
+class Expression(object):
+    """A parsed dice expression: a list of (sign, term) pairs."""
+
+    def __init__(self, terms):
+        self.terms = terms
+        text = ""
+        for sign, node in terms:
+            if sign < 0:
+                text = text + "-"
+            elif text != "":
+                text = text + "+"
+            text = text + node.label
+        self.text = text
+
+    def roll(self, rng=None):
+        """Rolls the expression and returns a Result. rng is a
+           random.Random, a shared one by default."""
+        roller = Roller(rng)
+        terms = []
+        total = 0
+        for sign, node in self.terms:
+            term = node.roll(roller)
+            term.sign = sign
+            terms.append(term)
+            total = total + sign * term.total
+        return Result(self, terms, total)
+
+
+class Term(object):
+    """What one term of an expression came to."""
+
+    def __init__(self, label, total):
+        self.label = label
+        self.total = total
+        self.sign = 1
+        self.dice = None
+        self.dropped = None
+        self.summary = None
+
+    def describe(self):
+        if self.dice is None and self.summary is None:
+            return self.label
+        if self.summary is not None:
+            return self.label + ": " + self.summary
+        shown = [str(die) for die in self.dice]
+        if self.dropped:
+            shown = shown + ["(" + str(die) + ")" for die in self.dropped]
+        return self.label + ": " + ", ".join(shown)
+
+
+class Result(object):
+
+    def __init__(self, expression, terms, total):
+        self.expression = expression
+        self.terms = terms
+        self.total = total
+
+    def lines(self):
+        """The result as lines of text to show under the roll."""
+        if len(self.terms) == 1:
+            term = self.terms[0]
+            if term.dice is not None and term.dropped is None and len(term.dice) <= detailLimit:
+                if len(term.dice) == 1:
+                    return ["  " + str(term.total)]
+                return ["  " + ", ".join(str(die) for die in term.dice) + "  = " + str(self.total)]
+        lines = []
+        for term in self.terms:
+            if term.dice is not None or term.summary is not None:
+                lines.append("  " + term.describe())
+        lines.append("  total: " + str(self.total))
+        return lines
+
+
+class Roller(object):
+    """Rolls batches of dice for one expression and keeps it in budget."""
+
+    def __init__(self, rng=None):
+        if rng is None:
+            rng = defaultRandom
+        self.rng = rng
+        self.numpyState = None
+        self.rolled = 0
+        self.deadline = time.time() + timeLimit
+
+    def check(self):
+        if time.time() > self.deadline:
+            raise DiceError("That roll took too long.")
+
+    def dice(self, count, sides):
+        self.rolled = self.rolled + count
+        if self.rolled > maxDice:
+            raise DiceError("That's more than " + str(maxDice) + " dice.")
+        self.check()
+
+        if count >= batchSize and loadNumpy() is not None:
+            if self.numpyState is None:
+                # seeded from rng, so a seeded rng still repeats its rolls
+                self.numpyState = numpy.random.RandomState(self.rng.getrandbits(32))
+            return self.numpyState.randint(1, sides + 1, size=count)
+
+        draw = self.rng.random
+        pool = []
+        while len(pool) < count:
+            step = min(count - len(pool), 65536)
+            pool.extend([int(draw() * sides) + 1 for i in xrange(step)])
+            self.check()
+        return pool
+
+    def isArray(self, pool):
+        return numpy is not None and isinstance(pool, numpy.ndarray)
+
+    def count(self, pool, value):
+        if self.isArray(pool):
+            return int((pool == value).sum())
+        return pool.count(value)
+
+    def join(self, pools):
+        if any(self.isArray(pool) for pool in pools):
+            return numpy.concatenate([numpy.asarray(pool) for pool in pools])
+        joined = []
+        for pool in pools:
+            joined.extend(pool)
+        return joined
+
+    def sort(self, pool):
+        if self.isArray(pool):
+            return numpy.sort(pool)
+        # a slice at a time, checking the budget; the last sort then only
+        # has sorted runs to merge
+        runs = []
+        for start in xrange(0, len(pool), 65536):
+            runs.extend(sorted(pool[start:start + 65536]))
+            self.check()
+        return sorted(runs)
+
+    def summarize(self, pool, sides, dropped):
+        n = len(pool)
+        if n == 0:
+            text = "0 dice kept"
+        else:
+            faces = None
+            if self.isArray(pool):
+                low, high, mean = int(pool.min()), int(pool.max()), float(pool.mean())
+                if sides <= detailLimit:
+                    counts = numpy.bincount(pool, minlength=sides + 1)
+                    faces = [(face, int(counts[face])) for face in range(1, sides + 1)]
+            else:
+                low, high, mean, faces = self.tally(pool, sides)
+            text = "%d dice, lowest %d, highest %d, average %.2f" % (n, low, high, mean)
+            if faces is not None:
+                text = text + "\n    " + "  ".join("%d:%d" % face for face in faces)
+        if dropped is not None and len(dropped) > 0:
+            text = text + " (" + str(len(dropped)) + " dropped)"
+        return text
+
+    def tally(self, pool, sides):
+        # a list pool's lowest, highest, average and (for few sides) count
+        # of each face, a slice at a time so a big pool stays in budget
+        low = high = pool[0]
+        total = 0
+        counts = None
+        if sides <= detailLimit:
+            counts = [0] * (sides + 1)
+        for start in xrange(0, len(pool), 65536):
+            piece = pool[start:start + 65536]
+            low = min(low, min(piece))
+            high = max(high, max(piece))
+            total = total + sum(piece)
+            if counts is not None:
+                for face in xrange(1, sides + 1):
+                    counts[face] = counts[face] + piece.count(face)
+            self.check()
+        faces = None
+        if counts is not None:
+            faces = [(face, counts[face]) for face in range(1, sides + 1)]
+        return low, high, float(total) / len(pool), faces
+
+
+def loadNumpy():
+    global numpy, numpyTried
+    if not numpyTried:
+        numpyTried = True
+        try:
+            import numpy as module
+            numpy = module
+        except ImportError:
+            pass
+    return numpy
+
+
+defaultRandom = random.Random()
+parseCache = OrderedDict()
+parseLock = threading.Lock()
+
+
+def parse(text):
+    """Returns the Expression for some text, raising DiceError if it isn't
+       one."""
+    key = text.lower()
+    with parseLock:
+        expression = parseCache.get(key)
+        if expression is not None:
+            del parseCache[key]
+            parseCache[key] = expression
+            return expression
+
+    expression = build(key)
+    with parseLock:
+        parseCache[key] = expression
+        while len(parseCache) > parseCacheSize:
+            parseCache.popitem(last=False)
+    return expression
+
+
+def build(text):
+    terms = []
+    position = 0
+    sign = 1
+    while True:
+        if position >= len(text):
+            raise DiceError("A roll can't end with + or -.")
+        if len(terms) >= maxTerms:
+            raise DiceError("That's more than " + str(maxTerms) + " terms.")
+
+        node = None
+        for word, expansion in SHORTCUTS.items():
+            if text.startswith(word, position):
+                node = build(expansion).terms[0][1]
+                position = position + len(word)
+                break
+
+        if node is None:
+            match = DICE.match(text, position)
+            if match is not None:
+                count = int(match.group(1)) if match.group(1) else 1
+                sides = 100 if match.group(2) == '%' else int(match.group(2))
+                if count < 1 or count > maxDice:
+                    raise DiceError("You can roll between 1 and " + str(maxDice) + " dice.")
+                if sides < 1 or sides > maxSides:
+                    raise DiceError("Dice have between 1 and " + str(maxSides) + " sides.")
+                position = match.end()
+
+                explode = False
+                keep = None
+                keepCount = 1
+                while position < len(text) and text[position] not in "+-":
+                    if text[position] == '!' and not explode:
+                        explode = True
+                        position = position + 1
+                        continue
+                    match = KEEP.match(text, position)
+                    if match is None or keep is not None:
+                        raise DiceError("I don't understand \"" + text[position:] + "\".")
+                    keep = match.group(1)
+                    if keep == 'k':
+                        keep = 'kh'
+                    if match.group(2):
+                        keepCount = int(match.group(2))
+                    position = match.end()
+                node = Dice(count, sides, explode, keep, keepCount)
+
+        if node is None:
+            match = NUMBER.match(text, position)
+            if match is None:
+                raise DiceError("I don't understand \"" + text[position:] + "\".")
+            node = Number(int(match.group(0)))
+            position = match.end()
+
+        terms.append((sign, node))
+        if position == len(text):
+            break
+        if text[position] not in "+-":
+            raise DiceError("I don't understand \"" + text[position:] + "\".")
+        sign = 1 if text[position] == '+' else -1
+        position = position + 1
+
+    if not any(isinstance(node, Dice) for sign, node in terms):
+        raise DiceError("There are no dice in that.")
+    return Expression(terms)
+
+
+def roll(text, rng=None):
+    """Parses and rolls an expression in one go."""
+    return parse(text).roll(rng)
@@ -0,0 +1,182 @@
+import os
+import json
+import time
+import random
+import urllib
+import hashlib
+import threading
+from collections import deque
+
+import dice
+
+"""
+An append-only record of every roll made in a room, for settling disputes.
+
+Each room rolls from its own random stream. Every roll draws a fresh seed
+from that stream and rolls with a generator seeded from it, and the log
+keeps the seed next to the actor, the expression and what came up, so any
+roll can be rolled again and checked on its own. Entries are chained by
+hash: each one carries the hash of the one before, so an entry edited or
+removed after the fact shows up when the log is verified.
+
+The log is one JSON object per line:
+
+    {"seq": 12, "time": ..., "actor": "Alice", "expr": "4d6kh3", "hidden": false,
+     "seed": ..., "total": 13, "lines": [...], "prev": "...", "hash": "..."}
+
+Reseeding the room's stream is logged too, as an entry with "expr": null.
+"""
+
+# entries kept in memory for show, and for rooms without a log file
+recentSize = 1000
+
+
+def digest(entry):
+    body = dict(entry)
+    body.pop('hash', None)
+    return hashlib.sha256(json.dumps(body, sort_keys=True, encoding='latin-1')).hexdigest()
+
+
+def newSeed():
+    return int(os.urandom(8).encode('hex'), 16)
+
+
+class DiceLog(object):
+    """One room's random stream and the log of what it rolled. The world
+       keeps one per room name, so a room closed and opened again carries on
+       the same chain; writing to the log takes a lock, since the old
+       room's dispatcher may still be finishing its last rolls."""
+
+    def __init__(self, room, directory=None, seed=None):
+        self.room = room
+        self.lock = threading.Lock()
+        self.path = None
+        self.file = None
+        self.recent = deque(maxlen=recentSize)
+        self.seq = 0
+        self.last = ""
+        if directory is not None:
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            self.path = os.path.join(directory, urllib.quote(room, safe='') + ".log")
+            self.resume()
+        self.reseed(seed)
+
+    def resume(self):
+        # picks up the sequence number and hash chain from the last entry
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, 'rb') as f:
+            f.seek(0, os.SEEK_END)
+            f.seek(max(0, f.tell() - 65536))
+            lines = f.read().splitlines()
+        for line in reversed(lines):
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            self.seq = entry['seq']
+            self.last = entry['hash']
+            return
+
+    def reseed(self, seed=None, actor=None):
+        if seed is None:
+            seed = newSeed()
+        self.seed = seed
+        self.rng = random.Random(seed)
+        self.append({'actor': actor, 'expr': None, 'seed': seed})
+
+    def append(self, entry):
+        with self.lock:
+            self.seq += 1
+            entry['seq'] = self.seq
+            entry['time'] = time.time()
+            entry['prev'] = self.last
+            entry['hash'] = digest(entry)
+            self.last = entry['hash']
+            self.recent.append(entry)
+            if self.path is not None:
+                if self.file is None:
+                    self.file = open(self.path, 'ab')
+                self.file.write(json.dumps(entry, sort_keys=True, encoding='latin-1') + "\n")
+                self.file.flush()
+        return entry
+
+    def roll(self, actor, text, hidden=False):
+        """Rolls a dice expression for an actor and logs it. Returns the
+           dice.Result; raises dice.DiceError like dice.roll."""
+        expression = dice.parse(text)
+        seed = self.rng.getrandbits(64)
+        result = expression.roll(random.Random(seed))
+        self.append({'actor': actor, 'expr': expression.text, 'hidden': hidden, 'seed': seed,
+                     'total': result.total, 'lines': result.lines()})
+        return result
+
+    def entries(self):
+        """Every logged entry, oldest first."""
+        if self.path is None:
+            return iter(list(self.recent))
+        return self.read()
+
+    def read(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.flush()
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, 'rb') as f:
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    yield None
+
+    def find(self, seq):
+        for entry in reversed(self.recent):
+            if entry['seq'] == seq:
+                return entry
+        for entry in self.entries():
+            if entry is not None and entry['seq'] == seq:
+                return entry
+        return None
+
+    def replay(self, entry):
+        """Rolls a logged roll again from its seed and returns the result."""
+        return dice.parse(entry['expr']).roll(random.Random(entry['seed']))
+
+    def verify(self):
+        """Checks the hash chain and rolls every logged roll again. Returns
+           (rolls checked, list of problems)."""
+        checked = 0
+        problems = []
+        previous = None
+        seq = 0
+        for entry in self.entries():
+            if entry is None:
+                problems.append("an unreadable line after #" + str(seq))
+                continue
+            seq = entry['seq']
+            if entry['hash'] != digest(entry):
+                problems.append("#" + str(seq) + " was altered")
+            elif previous is not None and entry['prev'] != previous:
+                problems.append("the chain is broken before #" + str(seq))
+            previous = entry['hash']
+
+            if entry['expr'] is None:
+                continue
+            checked += 1
+            try:
+                result = self.replay(entry)
+            except dice.DiceError:
+                problems.append("#" + str(seq) + " can't be rolled again")
+                continue
+            if result.total != entry['total'] or result.lines() != entry['lines']:
+                problems.append("#" + str(seq) + " rolls differently")
+        return checked, problems
+
+    def close(self):
+        """Closes the file; the next entry opens it again."""
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
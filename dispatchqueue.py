@@ -0,0 +1,88 @@
+import threading
+import time
+from collections import deque
+
+
+class CommandQueue(object):
+    """A blocking FIFO of pending commands.
+
+       Commands come out in the order they went in, so every actor's
+       commands run in the order they were typed. Consumers block on a
+       condition variable instead of polling, and closing the queue lets
+       the consumer drain whatever is left before it is told to stop."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.ready = threading.Condition(self.lock)
+        self.items = deque()
+        self.closing = False
+        self.finished = False
+
+        # counters, read through stats()
+        self.enqueued = 0
+        self.dispatched = 0
+        self.rejected = 0
+        self.maxDepth = 0
+        self.totalWait = 0.0
+        self.maxWait = 0.0
+        # how long the item get() last returned had waited; only the
+        # consumer reads it
+        self.lastWait = 0.0
+
+    def put(self, item):
+        """Adds an item to the back of the queue. Returns False if the
+           consumer has already shut down and the item was dropped."""
+        with self.lock:
+            if self.finished:
+                self.rejected += 1
+                return False
+            self.items.append((time.time(), item))
+            self.enqueued += 1
+            if len(self.items) > self.maxDepth:
+                self.maxDepth = len(self.items)
+            self.ready.notify()
+        return True
+
+    def get(self):
+        """Blocks until an item is available and returns it. Returns None
+           once the queue has been closed and everything in it handed out."""
+        with self.lock:
+            while len(self.items) == 0:
+                if self.closing:
+                    self.finished = True
+                    return None
+                self.ready.wait()
+            queued, item = self.items.popleft()
+            wait = time.time() - queued
+            self.lastWait = wait
+            self.dispatched += 1
+            self.totalWait += wait
+            if wait > self.maxWait:
+                self.maxWait = wait
+        return item
+
+    def close(self):
+        """Stops the consumer once the queue is empty. Items already queued,
+           and items queued while draining, are still handed out."""
+        with self.lock:
+            self.closing = True
+            self.ready.notify_all()
+
+    def depth(self):
+        with self.lock:
+            return len(self.items)
+
+    def stats(self):
+        with self.lock:
+            average = 0.0
+            if self.dispatched > 0:
+                average = self.totalWait / self.dispatched
+            return {
+                'depth': len(self.items),
+                'max_depth': self.maxDepth,
+                'enqueued': self.enqueued,
+                'dispatched': self.dispatched,
+                'rejected': self.rejected,
+                'average_wait': average,
+                'max_wait': self.maxWait,
+            }
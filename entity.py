@@ -3,9 +3,20 @@ import sys
 import threading
 import socket
 import commandparser
+import session
+import outbuffer
+import telnet
+import metrics
+import colorer
+import scrollback
+import ratelimit
+import time
+from colorer import colorfy
 
 
 class Entity(object):
+    __slots__ = ('proxy', 'name', 'instance', 'dm', 'status', 'color', 'scrollback', 'buckets')
+
     def __init__(self, proxy, name, instance):
         self.proxy = proxy
         if self.proxy is not None:
@@ -14,46 +25,166 @@ class Entity(object):
         self.instance = instance
         self.dm = False
         self.status = ""
+        # colorer.FULL, BASIC or OFF, as chosen with the colors command
+        self.color = colorer.FULL
+        # recent output, replayed if the player comes back
+        self.scrollback = scrollback.Scrollback()
+        # ratelimit's buckets for each command class, made on first use
+        self.buckets = None
 
     def sendMessage(self, message):
+        self.sendPayload(session.encode(message))
+
+    def sendPayload(self, payload):
+        """Sends bytes that are already encoded and newline terminated."""
+        if(self.proxy is not None):
+            if self.color != colorer.FULL:
+                payload = colorer.downgrade(payload, self.color)
+            self.scrollback.add(payload)
+            self.deliver(payload)
+
+    def takeOver(self, previous):
+        """Carries on where an earlier login of the same player left off:
+           keeps its color mode and scrollback, and replays the scrollback
+           in one write."""
+        self.color = previous.color
+        self.scrollback = previous.scrollback
+        tail = self.scrollback.contents()
+        if tail == "" or self.proxy is None:
+            return
+        header = session.encode(colorfy("[SERVER] Picking up where you left off:", "bright green"))
+        footer = session.encode(colorfy("[SERVER] You're caught up.", "bright green"))
+        if self.color != colorer.FULL:
+            header = colorer.downgrade(header, self.color)
+            footer = colorer.downgrade(footer, self.color)
+        self.deliver(header + tail + footer)
+
+    def deliver(self, payload):
         if(self.proxy is not None):
             try:
-                self.proxy.socket.send(message + "\n")
+                if metrics.enabled:
+                    start = time.time()
+                    self.proxy.send(payload)
+                    metrics.phase("(send)", time.time() - start)
+                    metrics.sent(self.name, len(payload))
+                else:
+                    self.proxy.send(payload)
             except:
                 print "Server: Exception thrown while sending " + self.name + " a message."
                 self.proxy.kill()
 
 
 class ClientProxy(threading.Thread):
-    def __init__(self, socket):
+    def __init__(self, socket, decoder=None, lines=(), reaper=None):
         threading.Thread.__init__(self)
         self.socket = socket
+        # the reaper.Reaper watching this connection, if any
+        self.reaper = reaper
+        self.connected = time.time()
+        self.lastRead = self.connected
+        self.lastProbe = 0.0
+        if decoder is None:
+            decoder = telnet.LineDecoder()
+        self.decoder = decoder
+        # lines already read past the end of login
+        self.lines = list(lines)
         self.entity = None
-        self.running = False
+        self.running = True
+        self.output = outbuffer.OutputBuffer()
+        self.bucket = ratelimit.inputBucket()
+        self.writer = threading.Thread(target=self.drain)
 
     def setEntity(self, entity):
         self.entity = entity
 
+    def start(self):
+        threading.Thread.start(self)
+        self.writer.start()
+
+    def send(self, data):
+        if not self.output.put(data):
+            print "Server: Client fell too far behind, disconnecting."
+            self.abort()
+
     def kill(self):
+        """Stops reading, and closes the socket once queued output is out."""
+        self.running = False
         try:
-            self.socket.shutdown(socket.SHUT_RDWR)
+            self.socket.shutdown(socket.SHUT_RD)
+        except:
+            pass
+        self.output.close()
+        if not self.writer.is_alive():
             self.socket.close()
-            self.running = False
+
+    def abort(self):
+        """Drops the connection without flushing what is still queued."""
+        self.running = False
+        self.output.close(discard=True)
+        try:
+            self.socket.shutdown(socket.SHUT_RDWR)
         except:
             pass
 
+    def drain(self):
+        # the writer: takes whatever has piled up and writes it in one go
+        try:
+            while True:
+                batch = self.output.take()
+                if batch is None:
+                    break
+                data, queued = batch
+                if metrics.enabled:
+                    start = time.time()
+                    self.socket.sendall(data)
+                    metrics.phase("(socket write)", time.time() - start)
+                else:
+                    self.socket.sendall(data)
+                self.output.sent(len(data), queued)
+        except:
+            self.output.close(discard=True)
+            print "Server: Exception thrown while sending to a client."
+        self.running = False
+        try:
+            self.socket.shutdown(socket.SHUT_RDWR)
+        except:
+            pass
+        self.socket.close()
+
+    def throttle(self):
+        # not reading while over the limit leaves the flood in the client's
+        # TCP window, not in our queues
+        wait = self.bucket.charge()
+        if wait > 0:
+            if metrics.enabled:
+                metrics.throttled("input", wait)
+            time.sleep(wait)
+
     def run(self):
         try:
-            self.running = True
+            lines = self.lines
+            self.lines = []
             while self.running:
-                data = self.socket.recv(4096).strip()
+                for line in lines:
+                    line = line.strip()
+                    if line:
+                        commandparser.parseLine(line, self.entity)
+                        if self.bucket is not None:
+                            self.throttle()
+
+                data = self.socket.recv(4096)
                 if not data:
-                    continue
-                else:
-                    commandparser.parseLine(data, self.entity)
+                    break
+                self.lastRead = time.time()
+                lines = self.decoder.feed(data)
+
+            if self.running:
+                self.abort()
+                print "Client connection closed"
         except:
             exc_type, exc_value, exc_traceback = sys.exc_info()
             traceback.print_exception(exc_type, exc_value, exc_traceback, limit=None, file=sys.stdout)
-            self.running = False
-            self.socket.close()
+            self.abort()
             print "Client connection closed"
+        if self.reaper is not None:
+            self.reaper.untrack(self)
@@ -0,0 +1,476 @@
+import os
+import sys
+import heapq
+import errno
+import fcntl
+import select
+import socket
+import threading
+import itertools
+import traceback
+import commandparser
+from collections import deque
+import entity
+import login
+import outbuffer
+import telnet
+import metrics
+import ratelimit
+import reaper
+import time
+
+READ = select.POLLIN | select.POLLPRI
+WRITE = select.POLLOUT
+ERROR = select.POLLERR | select.POLLHUP | select.POLLNVAL
+
+WOULD_BLOCK = (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR)
+
+
+class Poller(object):
+    """epoll where the platform has it, poll everywhere else. Both take the
+       same event masks; they only disagree on the unit of the timeout."""
+
+    def __init__(self):
+        if hasattr(select, 'epoll'):
+            self.impl = select.epoll()
+            self.scale = 1
+        else:
+            self.impl = select.poll()
+            self.scale = 1000
+
+    def register(self, fd, events):
+        self.impl.register(fd, events)
+
+    def modify(self, fd, events):
+        self.impl.modify(fd, events)
+
+    def unregister(self, fd):
+        self.impl.unregister(fd)
+
+    def poll(self, timeout=None):
+        if timeout is None:
+            timeout = -1
+        else:
+            timeout = timeout * self.scale
+        try:
+            return self.impl.poll(timeout)
+        except (select.error, IOError), e:
+            if e.args[0] == errno.EINTR:
+                return []
+            raise
+
+    def close(self):
+        if hasattr(self.impl, 'close'):
+            self.impl.close()
+
+
+class Connection(object):
+    """Stands in for a ClientProxy when the connection is served by the
+       event loop. Anything may call send() or kill(); the socket itself is
+       only ever touched from the loop thread."""
+
+    def __init__(self, loop, socket, world):
+        self.loop = loop
+        self.socket = socket
+        self.fileno = socket.fileno()
+        self.entity = None
+        # running is what the rest of the server checks (and logout clears);
+        # open tracks whether the loop still owns the socket
+        self.running = True
+        self.open = True
+        self.closing = False
+        self.aborted = False
+        self.events = READ
+        self.dialog = login.LoginSession(world)
+        self.decoder = telnet.LineDecoder()
+        self.lines = deque()
+        self.output = outbuffer.OutputBuffer()
+        self.pending = ""
+        self.queued = None
+        self.bucket = ratelimit.inputBucket()
+        # not read from until the input bucket refills
+        self.paused = False
+        # for the reaper
+        self.connected = time.time()
+        self.lastRead = self.connected
+        self.lastProbe = 0.0
+
+    def setEntity(self, entity):
+        self.entity = entity
+
+    def send(self, data):
+        if not self.output.put(data):
+            print "Server: Client fell too far behind, disconnecting."
+            self.abort()
+            return
+        self.loop.schedule(self)
+
+    def kill(self):
+        self.closing = True
+        self.output.close()
+        self.loop.schedule(self)
+
+    def abort(self):
+        self.aborted = True
+        self.output.close(discard=True)
+        self.kill()
+
+
+class EventLoop(object):
+    """Accepts, logs in and serves every client from a single thread.
+       Complete lines are handed to commandparser.parseLine exactly as the
+       threaded core does, so commands run on the dispatcher unchanged.
+
+       The loop can also run without a listening socket and be handed
+       connections with adopt(), and watch other file descriptors with
+       addReader(); the sharded server uses both."""
+
+    def __init__(self, server_socket, world):
+        self.server_socket = server_socket
+        self.world = world
+        self.reaper = reaper.Reaper(world)
+        self.poller = Poller()
+        self.connections = {}
+        self.readers = {}
+        self.thread = None
+        self.running = False
+
+        # other threads poke the loop through this pipe when they queue output
+        self.wakeRead, self.wakeWrite = os.pipe()
+        for fd in (self.wakeRead, self.wakeWrite):
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        self.lock = threading.Lock()
+        self.dirty = set()
+        self.calls = []
+        # (when, order, callback), for callLater
+        self.timers = []
+        self.order = itertools.count()
+        self.woken = False
+        self.closed = False
+
+        if self.server_socket is not None:
+            self.server_socket.setblocking(0)
+            self.poller.register(self.server_socket.fileno(), READ)
+        self.poller.register(self.wakeRead, READ)
+
+    def addReader(self, fd, callback):
+        """Calls callback() on the loop thread whenever fd is readable."""
+        self.readers[fd] = callback
+        self.poller.register(fd, READ)
+
+    def removeReader(self, fd):
+        if fd in self.readers:
+            del self.readers[fd]
+            self.poller.unregister(fd)
+
+    def schedule(self, connection):
+        """Marks a connection as having output to flush or a pending close."""
+        with self.lock:
+            if self.closed:
+                return
+            self.dirty.add(connection)
+        self.wake()
+
+    def callSoon(self, callback):
+        """Runs callback() on the loop thread at the end of this pass."""
+        with self.lock:
+            if self.closed:
+                return
+            self.calls.append(callback)
+        self.wake()
+
+    def callLater(self, delay, callback):
+        """Runs callback() on the loop thread after delay seconds. Only call
+           this from the loop thread."""
+        heapq.heappush(self.timers, (time.time() + delay, self.order.next(), callback))
+
+    def runTimers(self):
+        now = time.time()
+        while self.timers and self.timers[0][0] <= now:
+            callback = heapq.heappop(self.timers)[2]
+            try:
+                callback()
+            except:
+                exc_type, exc_value, exc_traceback = sys.exc_info()
+                traceback.print_exception(exc_type, exc_value, exc_traceback, limit=None, file=sys.stdout)
+
+    def wake(self):
+        with self.lock:
+            if self.closed or self.woken or threading.current_thread() is self.thread:
+                return
+            self.woken = True
+        try:
+            os.write(self.wakeWrite, "x")
+        except OSError:
+            pass
+
+    def sweep(self):
+        # scheduled first, so a sweep that fails doesn't end the sweeping
+        self.callLater(reaper.checkInterval, self.sweep)
+        self.reaper.sweep()
+
+    def run(self):
+        self.thread = threading.current_thread()
+        self.running = True
+        self.callLater(reaper.checkInterval, self.sweep)
+        listener = None
+        if self.server_socket is not None:
+            listener = self.server_socket.fileno()
+        while self.running:
+            timeout = None
+            if self.timers:
+                timeout = max(0.0, self.timers[0][0] - time.time())
+            for fd, events in self.poller.poll(timeout):
+                if fd == listener:
+                    self.accept()
+                elif fd == self.wakeRead:
+                    self.drainWakeups()
+                elif fd in self.readers:
+                    self.readers[fd]()
+                elif fd in self.connections:
+                    connection = self.connections[fd]
+                    if events & (READ | ERROR):
+                        self.read(connection)
+                    if events & WRITE and connection.open:
+                        self.flush(connection)
+            self.runTimers()
+            self.processDirty()
+
+    def stop(self):
+        """Makes run() return; safe to call from any thread."""
+        self.running = False
+        self.wake()
+
+    def drainWakeups(self):
+        try:
+            while os.read(self.wakeRead, 4096):
+                pass
+        except OSError:
+            pass
+        with self.lock:
+            self.woken = False
+
+    def processDirty(self):
+        with self.lock:
+            dirty = self.dirty
+            self.dirty = set()
+            calls = self.calls
+            self.calls = []
+        for callback in calls:
+            try:
+                callback()
+            except:
+                exc_type, exc_value, exc_traceback = sys.exc_info()
+                traceback.print_exception(exc_type, exc_value, exc_traceback, limit=None, file=sys.stdout)
+        for connection in dirty:
+            if not connection.open:
+                continue
+            if connection.aborted:
+                self.drop(connection)
+            else:
+                self.flush(connection)
+
+    def accept(self):
+        while True:
+            try:
+                client_socket, address = self.server_socket.accept()
+            except socket.error, e:
+                if e.args[0] in WOULD_BLOCK or e.args[0] == errno.ECONNABORTED:
+                    return
+                raise
+            print "Server: Accepting connection from " + address[0] + "..."
+            connection = self.register(client_socket)
+            connection.send(connection.dialog.start())
+
+    def register(self, client_socket):
+        client_socket.setblocking(0)
+        reaper.keepalive(client_socket)
+        connection = Connection(self, client_socket, self.world)
+        self.connections[connection.fileno] = connection
+        self.poller.register(connection.fileno, READ)
+        self.reaper.track(connection)
+        return connection
+
+    def adopt(self, client_socket, decoder=None, lines=()):
+        """Takes over a socket whose login already happened elsewhere. The
+           caller attaches an entity and then calls processLines() to run
+           anything the client typed ahead."""
+        connection = self.register(client_socket)
+        connection.dialog = None
+        if decoder is not None:
+            connection.decoder = decoder
+        connection.lines.extend(lines)
+        return connection
+
+    def detach(self, connection):
+        """Hands a connection's socket back to the caller, still open, after
+           writing out everything queued for it. Returns the socket."""
+        connection.running = False
+        connection.open = False
+        connection.output.close()
+        self.reaper.untrack(connection)
+        if connection.fileno in self.connections:
+            del self.connections[connection.fileno]
+        try:
+            self.poller.unregister(connection.fileno)
+        except (IOError, OSError, KeyError):
+            pass
+        connection.socket.setblocking(1)
+        try:
+            if connection.pending:
+                connection.socket.sendall(connection.pending)
+            batch = connection.output.take(block=False)
+            if batch is not None:
+                connection.socket.sendall(batch[0])
+        except socket.error:
+            pass
+        connection.pending = ""
+        return connection.socket
+
+    def read(self, connection):
+        try:
+            data = connection.socket.recv(4096)
+        except socket.error, e:
+            if e.args[0] in WOULD_BLOCK:
+                return
+            data = ""
+        if not data:
+            self.drop(connection)
+            return
+        connection.lastRead = time.time()
+
+        connection.lines.extend(connection.decoder.feed(data))
+        self.processLines(connection)
+
+    def processLines(self, connection):
+        while connection.lines and connection.open and not connection.paused:
+            line = connection.lines.popleft()
+            try:
+                self.handleLine(connection, line.strip())
+            except:
+                exc_type, exc_value, exc_traceback = sys.exc_info()
+                traceback.print_exception(exc_type, exc_value, exc_traceback, limit=None, file=sys.stdout)
+                self.drop(connection)
+
+    def handleLine(self, connection, line):
+        if connection.entity is not None:
+            if line:
+                commandparser.parseLine(line, connection.entity)
+                if connection.bucket is not None:
+                    wait = connection.bucket.charge()
+                    if wait > 0:
+                        self.pause(connection, wait)
+            return
+
+        dialog = connection.dialog
+        if dialog is None:
+            # turned away at login, waiting to be closed
+            return
+        reply = dialog.feed(line)
+        if reply:
+            connection.send(reply)
+        if not dialog.finished:
+            return
+
+        connection.dialog = None
+        if dialog.rejected:
+            connection.kill()
+            return
+
+        self.loggedIn(connection, dialog)
+
+    def loggedIn(self, connection, dialog):
+        player = entity.Entity(connection, dialog.username, self.world.lobby)
+        player.dm = dialog.dm
+        login.enterSession(self.world, player, clone=dialog.clone)
+
+    def flush(self, connection):
+        output = connection.output
+        while True:
+            if not connection.pending:
+                batch = output.take(block=False)
+                if batch is None:
+                    break
+                connection.pending, connection.queued = batch
+            try:
+                if metrics.enabled:
+                    start = time.time()
+                    sent = connection.socket.send(connection.pending)
+                    metrics.phase("(socket write)", time.time() - start)
+                else:
+                    sent = connection.socket.send(connection.pending)
+            except socket.error, e:
+                if e.args[0] in WOULD_BLOCK:
+                    # the kernel won't take any more yet, wait for POLLOUT
+                    self.watch(connection, READ | WRITE)
+                    return
+                self.drop(connection)
+                return
+            if sent < len(connection.pending):
+                output.sent(sent)
+                connection.pending = connection.pending[sent:]
+            else:
+                output.sent(sent, connection.queued)
+                connection.pending = ""
+                connection.queued = None
+        if connection.closing:
+            # everything queued before kill() is out
+            self.drop(connection)
+            return
+        self.watch(connection, READ)
+
+    def pause(self, connection, seconds):
+        """Stops reading from a connection for a while. Whatever the client
+           sends meanwhile waits in the kernel, and then in its own TCP
+           window."""
+        if metrics.enabled:
+            metrics.throttled("input", seconds)
+        connection.paused = True
+        self.watch(connection, connection.events & ~READ)
+        self.callLater(seconds, lambda: self.resume(connection))
+
+    def resume(self, connection):
+        if not connection.open:
+            return
+        connection.paused = False
+        self.watch(connection, connection.events | READ)
+        self.processLines(connection)
+
+    def watch(self, connection, events):
+        if connection.paused:
+            events &= ~READ
+        if connection.events != events and connection.open:
+            connection.events = events
+            self.poller.modify(connection.fileno, events)
+
+    def drop(self, connection):
+        if not connection.open:
+            return
+        connection.running = False
+        connection.open = False
+        connection.output.close(discard=True)
+        self.reaper.untrack(connection)
+        if connection.fileno in self.connections:
+            del self.connections[connection.fileno]
+        try:
+            self.poller.unregister(connection.fileno)
+        except (IOError, OSError, KeyError):
+            pass
+        try:
+            connection.socket.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        connection.socket.close()
+        if connection.entity is None:
+            print "Server: Client connection closed during login."
+        else:
+            print "Client connection closed"
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+        for connection in self.connections.values():
+            self.drop(connection)
+        self.poller.close()
+        os.close(self.wakeRead)
+        os.close(self.wakeWrite)
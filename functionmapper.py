@@ -1,85 +1,190 @@
+import threading
 import commands
-import namedtuple
-
-CommandArgs = namedtuple.namedtuple('CommandArgs', 'name tokens full actor')
-commandFunctions = {}
-
-if len(commandFunctions) == 0:
-    #commandFunctions["look"] = (commands.look)
-    commandFunctions["say"] = (commands.say)
-    commandFunctions["logout"] = (commands.logout)
-    commandFunctions["help"] = (commands.help)
-    commandFunctions["who"] = (commands.who)
-    commandFunctions["pm"] = (commands.pm)
-    commandFunctions["whisper"] = (commands.whisper)
-    commandFunctions["emote"] = (commands.emote)
-    commandFunctions["ooc"] = (commands.ooc)
-    commandFunctions["roll"] = (commands.roll)
-    commandFunctions["hroll"] = (commands.roll)
-    commandFunctions["display"] = (commands.display)
-    commandFunctions["mask"] = (commands.mask)
-    commandFunctions["status"] = (commands.status)
-    commandFunctions["glance"] = (commands.glance)
-    commandFunctions["colors"] = (commands.colors)
-    commandFunctions["paint"] = (commands.paint)
-    commandFunctions["erase"] = (commands.erase)
-    commandFunctions["wipe"] = (commands.wipe)
-    commandFunctions["look"] = (commands.look)
-
-
-def shorthandHandler(args):
-    if len(args.tokens) < 1:
-        return args
-
-    if len(args.full) < 2:
+import helpindex
+import pluginloader
+
+
+class Shorthand(object):
+    """How a one-character prefix expands into a full command.
+
+       name - the command it expands to
+       insert - tokens placed between the command name and the rest
+       glue - text stuck onto the front of the first word
+       rest - whether anything after the first word is kept
+
+    For example ';' expands ";laughs loudly" to "emote ; laughs loudly", and
+    '#' expands "#20" to "roll 1d20"."""
+
+    def __init__(self, name, insert=(), glue="", rest=True):
+        self.name = name
+        self.glue = glue
+        self.rest = rest
+        # precomputed once, so expanding is one list splice and one concat
+        self.headTokens = [name] + list(insert)
+        self.prefix = " ".join(self.headTokens) + " "
+        self.head = self.prefix + glue
+
+    def expand(self, args):
+        tokens = args.tokens
+        first = self.glue + tokens[0][1:]
+        if self.rest:
+            tokens[0:1] = self.headTokens + [first]
+            full = self.head + args.full[1:]
+        else:
+            tokens[0:] = self.headTokens + [first]
+            full = self.prefix + first
+        args.name = self.name
+        args.full = full
         return args
 
-    if args.name[0] == ';':
-        new_name = "emote"
-        new_tokens = ["emote", ";", args.tokens[0][1:]] + args.tokens[1:]
-        new_full = "emote ; " + args.full[1:]
-
-        newargs = CommandArgs(name=new_name, tokens=new_tokens, full=new_full, actor=args.actor)
-        return newargs
-
-    elif args.name[0] == "'":
-        new_name = "say"
-        new_tokens = ["say", args.tokens[0][1:]] + args.tokens[1:]
-        new_full = "say " + args.full[1:]
 
-        newargs = CommandArgs(name=new_name, tokens=new_tokens, full=new_full, actor=args.actor)
-        return newargs
+class Router(object):
+    """Maps what a player typed to the function that handles it.
+
+    A command can be reached by its name, by a registered alias, by any
+    prefix of its name that no other command shares, or through a
+    one-character shorthand. Aliases and prefixes are folded into a single
+    lookup table the first time a command is routed after a registration,
+    so routing a command is a dict lookup or two."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.commands = {}
+        self.aliases = {}
+        self.shorthands = {}
+        self.table = None
+        # bumped on every registration so caches built from the router
+        # (the prefix table, the help index) know to rebuild
+        self.version = 0
+
+    def register(self, name, function, aliases=()):
+        with self.lock:
+            self.commands[name] = function
+            for alias in aliases:
+                self.aliases[alias] = name
+            self.table = None
+            self.version += 1
+
+    def unregister(self, name):
+        with self.lock:
+            self.commands.pop(name, None)
+            for alias, target in self.aliases.items():
+                if target == name:
+                    del self.aliases[alias]
+            self.table = None
+            self.version += 1
+
+    def alias(self, alias, name):
+        with self.lock:
+            self.aliases[alias] = name
+            self.table = None
+            self.version += 1
+
+    def shorthand(self, char, name, insert=(), glue="", rest=True):
+        with self.lock:
+            self.shorthands[char] = Shorthand(name, insert, glue, rest)
+            self.version += 1
+
+    def compile(self):
+        # with the lock held
+        if self.table is not None:
+            return self.table
+        owners = {}
+        for name in self.commands:
+            for end in range(1, len(name)):
+                owners.setdefault(name[:end], set()).add(name)
+        table = {}
+        for prefix, names in owners.items():
+            if len(names) == 1:
+                table[prefix] = iter(names).next()
+        for alias, name in self.aliases.items():
+            table[alias] = name
+        for name in self.commands:
+            table[name] = name
+        self.table = table
+        return table
+
+    def resolve(self, word):
+        """Returns the name of the command a word refers to, or None."""
+        with self.lock:
+            return self.compile().get(word)
+
+    def route(self, args):
+        """Returns (function, args) for a command, with shorthands expanded
+           and the command name spelled out in full. The function is None if
+           nothing matches."""
+        if len(args.full) >= 2:
+            shorthand = self.shorthands.get(args.name[0])
+            if shorthand is not None:
+                args = shorthand.expand(args)
+
+        # the name and its function are looked up together, so a plugin
+        # unregistering in between can't leave a name with no function
+        with self.lock:
+            name = self.compile().get(args.name)
+            function = self.commands.get(name)
+        if function is None:
+            return None, args
+        if name != args.name:
+            # spell it out so handlers can keep measuring offsets into full
+            args.tokens[0] = name
+            args.full = name + args.full[len(args.name):]
+            args.name = name
+        return function, args
+
+
+router = Router()
+commandFunctions = router.commands
+helpIndex = helpindex.HelpIndex(router)
+plugins = pluginloader.Loader(router)
+
+
+def register(name, function, aliases=()):
+    """Makes a command available to players. Plugins call this too."""
+    router.register(name, function, aliases)
+
+
+def registerShorthand(char, name, insert=(), glue="", rest=True):
+    router.shorthand(char, name, insert, glue, rest)
 
-    elif args.name[0] == "*":
-        new_name = "ooc"
-        new_tokens = ["ooc", args.tokens[0][1:]] + args.tokens[1:]
-        new_full = "ooc " + args.full[1:]
 
-        newargs = CommandArgs(name=new_name, tokens=new_tokens, full=new_full, actor=args.actor)
-        return newargs
-
-    elif args.name[0] == "#":
-        new_name = "roll"
-        new_tokens = ["roll", '1d' + args.tokens[0][1:]]
-        new_full = "roll 1d" + args.tokens[0][1:]
-
-        newargs = CommandArgs(name=new_name, tokens=new_tokens, full=new_full, actor=args.actor)
-        return newargs
-
-    elif args.name[0] == "$":
-        new_name = "mask"
-        new_tokens = ["mask", args.tokens[0][1:]] + args.tokens[1:]
-        new_full = "mask " + args.full[1:]
-
-        newargs = CommandArgs(name=new_name, tokens=new_tokens, full=new_full, actor=args.actor)
-        return newargs
-
-    elif args.name[0] == "@":
-        new_name = "display"
-        new_tokens = ["display", "-c", args.tokens[0][1:]] + args.tokens[1:]
-        new_full = "display -c " + args.full[1:]
+def shorthandHandler(args):
+    """Expands shorthands, aliases and prefixes into the full command."""
+    function, args = router.route(args)
+    return args
 
-        newargs = CommandArgs(name=new_name, tokens=new_tokens, full=new_full, actor=args.actor)
-        return newargs
 
-    return args
+if len(commandFunctions) == 0:
+    register("say", commands.say)
+    register("logout", commands.logout)
+    register("help", commands.help)
+    register("who", commands.who, aliases=("wh",))
+    register("pm", commands.pm)
+    register("whisper", commands.whisper)
+    register("emote", commands.emote)
+    register("ooc", commands.ooc)
+    register("display", commands.display)
+    register("mask", commands.mask)
+    register("status", commands.status)
+    register("glance", commands.glance)
+    register("colors", commands.colors)
+    register("paint", commands.paint)
+    register("erase", commands.erase)
+    register("wipe", commands.wipe)
+    register("look", commands.look, aliases=("l",))
+    register("scene", commands.scene)
+    register("log", commands.log)
+    register("plugins", commands.plugins)
+    register("stats", commands.stats)
+    register("join", commands.join)
+    register("rooms", commands.rooms)
+
+    registerShorthand(";", "emote", insert=(";",))
+    registerShorthand("'", "say")
+    registerShorthand("*", "ooc")
+    registerShorthand("#", "roll", glue="1d", rest=False)
+    registerShorthand("$", "mask")
+    registerShorthand("@", "display", insert=("-c",))
+
+    # commands from the plugins package, imported when first used
+    plugins.discover()
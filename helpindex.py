@@ -0,0 +1,105 @@
+import re
+import threading
+
+import session
+from colorer import colorfy
+
+WORD = re.compile("[a-z0-9]+")
+
+
+class HelpIndex(object):
+    """Help pages for every routed command, rendered ahead of time.
+
+       Each page is the command's docstring with a colored title and a note
+       of its aliases and shorthands, already encoded for the wire. An
+       inverted index from docstring words to command names answers
+       "help search". Everything is rebuilt only when the router's
+       registrations change."""
+
+    def __init__(self, router):
+        self.router = router
+        self.lock = threading.Lock()
+        self.version = None
+        self.pages = {}
+        self.overview = ""
+        self.words = {}
+
+    def refresh(self):
+        """Rebuilds the index if commands were registered since the last
+           build. Cheap when nothing changed."""
+        if self.version == self.router.version:
+            return
+        with self.lock:
+            if self.version == self.router.version:
+                return
+            version = self.router.version
+            self.build()
+            self.version = version
+
+    def build(self):
+        commands = dict(self.router.commands)
+        aliases = {}
+        for alias, name in self.router.aliases.items():
+            aliases.setdefault(name, []).append(alias)
+        shorthands = {}
+        for char, shorthand in self.router.shorthands.items():
+            shorthands.setdefault(shorthand.name, []).append(char)
+
+        pages = {}
+        words = {}
+        for name, function in commands.items():
+            docstring = function.__doc__
+            if docstring is None:
+                continue
+            title = "help file for: " + name
+            page = colorfy(title + "\n" + ("-" * len(title)), 'green') + docstring.rstrip() + "\n"
+            if name in aliases:
+                page = page + "\n    aliases: " + ", ".join(sorted(aliases[name]))
+            if name in shorthands:
+                page = page + "\n    shorthand: " + ", ".join(sorted(shorthands[name]))
+            pages[name] = session.encode(page)
+
+            for word in set(WORD.findall(docstring.lower())):
+                words.setdefault(word, set()).add(name)
+
+        names = sorted(commands.keys())
+        msg = "    "
+        i = 0
+        for command in names:
+            msg = msg + command + (' ' * (15 - len(command)))
+            i = (i + 1) % 4
+            if i == 0:
+                msg = msg + "\n    "
+
+        self.overview = session.encode("There are help files on the following commands.\n"
+                                       "Type help <command> for details, or help search <word>.") + session.encode(msg)
+        self.pages = pages
+        self.words = words
+
+    def page(self, topic):
+        """Returns the encoded help page for a command, alias or prefix, or
+           None if there is none."""
+        self.refresh()
+        name = self.router.resolve(topic)
+        if name is None:
+            return None
+        return self.pages.get(name)
+
+    def contents(self):
+        self.refresh()
+        return self.overview
+
+    def search(self, text):
+        """Returns the sorted names of commands whose help mentions every
+           word in text."""
+        self.refresh()
+        found = None
+        for word in WORD.findall(text.lower()):
+            names = self.words.get(word, set())
+            if found is None:
+                found = set(names)
+            else:
+                found = found & names
+        if not found:
+            return []
+        return sorted(found)
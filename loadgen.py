@@ -0,0 +1,533 @@
+import os
+import re
+import sys
+import json
+import time
+import heapq
+import errno
+import random
+import signal
+import socket
+import shutil
+import argparse
+import resource
+import tempfile
+import subprocess
+from eventloop import Poller, READ, WRITE, ERROR
+
+"""
+Load generator: starts a server, logs in a crowd of simulated telnet
+clients and has them type a mix of commands, then reports how the server
+held up.
+
+    python loadgen.py --clients 500 --rate 0.5 --duration 30 --json run.json
+    python loadgen.py --clients 50 --server-args "--core eventloop"
+
+Every command carries a numbered token, like "say ~123~", which comes back
+in the text the server sends. The time until the sender sees its token is
+the command's round trip. For commands heard by the whole room (say, emote,
+roll), the time until the last person in the room sees it is the broadcast
+fan-out time. All the clients are driven from one thread with the server's
+own Poller.
+
+The server's CPU time and memory come from /proc, summed over its worker
+processes too.
+"""
+
+TOKEN = re.compile(r"~(\d+)~")
+JOINED = "You have joined the session."
+ROOM_PROMPT = "Which room will you join"
+# what the server says when a client can't get into its room
+TURNED_AWAY = ("There is no room called", "as many rooms open as it can hold", "isn't open, so")
+BROADCAST = ("say", "emote", "roll")
+DEFAULT_MIX = "say=35,emote=15,roll=20,look=20,pm=10"
+
+# client states
+CONNECTING = 0
+LOGGING_IN = 1
+JOINING = 2
+READY = 3
+CLOSED = 4
+
+
+def percentiles(samples):
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    pick = lambda fraction: ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+    return {'count': len(ordered), 'mean': sum(ordered) / len(ordered), 'p50': pick(0.5),
+            'p90': pick(0.9), 'p99': pick(0.99), 'max': ordered[-1]}
+
+
+def parseMix(text):
+    mix = []
+    for part in text.split(","):
+        name, weight = part.split("=")
+        if name not in BROADCAST + ("look", "pm"):
+            raise ValueError("unknown command in mix: " + name)
+        mix.append((name, float(weight)))
+    return mix
+
+
+class Pending(object):
+    """A command whose token is still on its way to somebody."""
+
+    def __init__(self, kind, sender, expected, sent):
+        self.kind = kind
+        self.sender = sender
+        self.expected = expected
+        self.seen = 0
+        self.sent = sent
+
+
+class Client(object):
+
+    def __init__(self, index, room, dm=False):
+        self.index = index
+        self.name = "Bot" + str(index)
+        self.room = room
+        # only a DM can open a room, so the first client in each is one
+        self.dm = dm
+        self.state = CONNECTING
+        self.socket = None
+        self.inbox = ""
+        self.outbox = ""
+        self.connectStarted = None
+
+
+class LoadGenerator(object):
+
+    def __init__(self, options):
+        self.options = options
+        self.mix = parseMix(options.mix)
+        self.weight = sum(weight for name, weight in self.mix)
+        self.poller = Poller()
+        self.clients = []
+        self.byFd = {}
+        self.rooms = {}
+        self.timers = []
+        self.pending = {}
+        self.tokens = 0
+        self.recording = False
+        self.typing = True
+        self.random = random.Random(options.seed)
+
+        self.sent = {}
+        self.latency = {}
+        self.fanout = []
+        self.logins = []
+        self.failures = 0
+        self.errors = []
+        self.unplaced = 0
+
+    # connecting and logging in
+
+    def connect(self, client):
+        client.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        client.socket.setblocking(0)
+        # like a telnet client: each line goes out as soon as it's typed
+        client.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        client.connectStarted = time.time()
+        error = client.socket.connect_ex((self.options.host, self.options.port))
+        if error not in (0, errno.EINPROGRESS):
+            self.fail(client, "connect: " + os.strerror(error))
+            return
+        self.byFd[client.socket.fileno()] = client
+        self.poller.register(client.socket.fileno(), READ | WRITE)
+        client.state = LOGGING_IN
+        client.outbox = client.name + "\r\n" + ("y" if client.dm else "n") + "\r\n"
+
+    def received(self, client, data):
+        client.inbox = client.inbox + data
+        end = client.inbox.rfind("\n")
+        if client.state != READY and ROOM_PROMPT in client.inbox:
+            # the sharded front asks for a room during login
+            client.inbox = client.inbox.replace(ROOM_PROMPT, "")
+            self.write(client, client.room + "\r\n")
+        if end < 0:
+            return
+        text = client.inbox[:end]
+        client.inbox = client.inbox[end + 1:]
+
+        if client.state in (LOGGING_IN, JOINING) and any(reason in text for reason in TURNED_AWAY):
+            self.unplaced += 1
+            self.fail(client, "couldn't get into " + client.room)
+            return
+        if client.state == LOGGING_IN and JOINED in text:
+            self.logins.append(time.time() - client.connectStarted)
+            if client.room == "lobby" or self.options.workers > 0:
+                self.ready(client)
+            else:
+                client.state = JOINING
+                self.write(client, "join " + client.room + "\r\n")
+        elif client.state == JOINING and ("You join the " + client.room) in text:
+            self.ready(client)
+
+        for match in TOKEN.finditer(text):
+            self.seen(client, int(match.group(1)))
+
+    def ready(self, client):
+        client.state = READY
+        self.rooms.setdefault(client.room, []).append(client)
+        self.schedule(client)
+
+    # typing commands
+
+    def schedule(self, client):
+        delay = self.random.expovariate(self.options.rate)
+        heapq.heappush(self.timers, (time.time() + delay, client.index))
+
+    def pick(self):
+        roll = self.random.uniform(0, self.weight)
+        for name, weight in self.mix:
+            roll -= weight
+            if roll <= 0:
+                return name
+        return self.mix[-1][0]
+
+    def act(self, client):
+        if client.state != READY or not self.typing:
+            return
+        self.tokens += 1
+        token = "~" + str(self.tokens) + "~"
+        kind = self.pick()
+        present = len(self.rooms.get(client.room, ()))
+
+        if kind == "say":
+            line, expected = "say " + token + " hello there", present
+        elif kind == "emote":
+            line, expected = "emote ; waves " + token, present
+        elif kind == "roll":
+            line, expected = "roll 1d20 " + token, present
+        elif kind == "look":
+            line, expected = "look " + token, 1
+        else:
+            others = [other for other in self.rooms.get(client.room, ()) if other is not client]
+            if not others:
+                line, expected, kind = "say " + token, present, "say"
+            else:
+                line, expected = "pm " + self.random.choice(others).name + " " + token, 2
+
+        if self.recording:
+            self.sent[kind] = self.sent.get(kind, 0) + 1
+            self.pending[self.tokens] = Pending(kind, client, expected, time.time())
+        self.write(client, line + "\r\n")
+        self.schedule(client)
+
+    def seen(self, client, token):
+        pending = self.pending.get(token)
+        if pending is None:
+            return
+        now = time.time()
+        if client is pending.sender:
+            self.latency.setdefault(pending.kind, []).append(now - pending.sent)
+        pending.seen += 1
+        if pending.seen >= pending.expected:
+            if pending.kind in BROADCAST:
+                self.fanout.append(now - pending.sent)
+            del self.pending[token]
+
+    # the socket side
+
+    def write(self, client, data):
+        client.outbox = client.outbox + data
+        self.flush(client)
+
+    def flush(self, client):
+        if client.state == CLOSED:
+            return
+        try:
+            while client.outbox:
+                sent = client.socket.send(client.outbox)
+                client.outbox = client.outbox[sent:]
+        except socket.error, e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.ENOTCONN):
+                self.poller.modify(client.socket.fileno(), READ | WRITE)
+                return
+            self.fail(client, "send: " + str(e))
+            return
+        self.poller.modify(client.socket.fileno(), READ)
+
+    def fail(self, client, reason):
+        self.failures += 1
+        if len(self.errors) < 10:
+            self.errors.append(client.name + " " + reason)
+        self.close(client)
+
+    def close(self, client):
+        if client.state == CLOSED:
+            return
+        if client.socket is not None:
+            fd = client.socket.fileno()
+            if fd in self.byFd:
+                del self.byFd[fd]
+                self.poller.unregister(fd)
+            client.socket.close()
+        if client in self.rooms.get(client.room, ()):
+            self.rooms[client.room].remove(client)
+        client.state = CLOSED
+
+    def pump(self, until):
+        """Serves sockets and timers until the given time."""
+        while True:
+            now = time.time()
+            if now >= until:
+                return
+            while self.timers and self.timers[0][0] <= now:
+                at, index = heapq.heappop(self.timers)
+                self.act(self.clients[index])
+            timeout = until - now
+            if self.timers:
+                timeout = min(timeout, max(0.0, self.timers[0][0] - now))
+            for fd, events in self.poller.poll(timeout):
+                client = self.byFd.get(fd)
+                if client is None:
+                    continue
+                if events & READ:
+                    try:
+                        data = client.socket.recv(65536)
+                    except socket.error, e:
+                        if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                            self.fail(client, "recv: " + str(e))
+                        continue
+                    if not data:
+                        self.fail(client, "closed by the server")
+                        continue
+                    self.received(client, data)
+                elif events & ERROR:
+                    self.fail(client, "socket error")
+                    continue
+                if events & WRITE and client.state != CLOSED:
+                    self.flush(client)
+
+    def run(self):
+        options = self.options
+        for index in range(options.clients):
+            if options.rooms > 1:
+                self.clients.append(Client(index, "room" + str(index % options.rooms), index < options.rooms))
+            else:
+                self.clients.append(Client(index, "lobby"))
+
+        # the DMs go first and open the rooms; then everyone else connects
+        # at a steady pace, with logins served in between
+        interval = 1.0 / options.connect_rate
+        started = time.time()
+        deadline = started + options.login_timeout
+        opening = [client for client in self.clients if client.dm]
+        for client in self.clients:
+            self.connect(client)
+            self.pump(time.time() + interval)
+            if opening and client is opening[-1]:
+                while time.time() < deadline and any(dm.state not in (READY, CLOSED) for dm in opening):
+                    self.pump(time.time() + 0.05)
+        while time.time() < deadline and sum(len(room) for room in self.rooms.values()) < options.clients - self.failures:
+            self.pump(time.time() + 0.05)
+        for client in self.clients:
+            if client.state not in (READY, CLOSED):
+                self.unplaced += 1
+                self.fail(client, "never got into " + client.room)
+        connectTime = time.time() - started
+
+        self.recording = True
+        window = time.time()
+        server = self.sample()
+        self.pump(window + options.duration)
+        serverAfter = self.sample()
+        window = time.time() - window
+        self.recording = False
+
+        # let the last tokens arrive before counting them as lost
+        self.typing = False
+        self.pump(time.time() + options.drain)
+        lost = len(self.pending)
+
+        for client in self.clients:
+            self.close(client)
+        self.poller.close()
+
+        sent = sum(self.sent.values())
+        report = {
+            'options': {'clients': options.clients, 'rate': options.rate, 'duration': options.duration,
+                        'rooms': options.rooms, 'mix': options.mix, 'server_args': options.server_args,
+                        'workers': options.workers},
+            'connected': len(self.logins),
+            'connect_time': connectTime,
+            'failures': self.failures,
+            'unplaced': self.unplaced,
+            'errors': self.errors,
+            'login': percentiles(self.logins),
+            'commands_sent': sent,
+            'commands_per_second': sent / window,
+            'lost': lost,
+            'latency': dict((kind, percentiles(samples)) for kind, samples in self.latency.items()),
+            'latency_all': percentiles([sample for samples in self.latency.values() for sample in samples]),
+            'fanout': percentiles(self.fanout),
+        }
+        if server is not None and serverAfter is not None:
+            report['server'] = {
+                'cpu_seconds': serverAfter['cpu'] - server['cpu'],
+                'cpu_percent': 100.0 * (serverAfter['cpu'] - server['cpu']) / window,
+                'rss_kb': serverAfter['rss'],
+                'peak_rss_kb': serverAfter['peak'],
+                'processes': serverAfter['processes'],
+            }
+        return report
+
+    # the server process
+
+    def sample(self):
+        """CPU seconds and memory of the server and its children, or None
+           when we didn't start it."""
+        if self.options.pid is None:
+            return None
+        pids = processTree(self.options.pid)
+        ticks = float(os.sysconf('SC_CLK_TCK'))
+        cpu = 0.0
+        rss = 0
+        peak = 0
+        for pid in pids:
+            try:
+                with open("/proc/%d/stat" % pid) as f:
+                    fields = f.read().rsplit(")", 1)[1].split()
+                cpu += (int(fields[11]) + int(fields[12])) / ticks
+                with open("/proc/%d/status" % pid) as f:
+                    for line in f:
+                        if line.startswith("VmRSS:"):
+                            rss += int(line.split()[1])
+                        elif line.startswith("VmHWM:"):
+                            peak += int(line.split()[1])
+            except (IOError, IndexError, ValueError):
+                pass
+        return {'cpu': cpu, 'rss': rss, 'peak': peak, 'processes': len(pids)}
+
+
+def processTree(root):
+    children = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open("/proc/" + entry + "/stat") as f:
+                parent = int(f.read().rsplit(")", 1)[1].split()[1])
+        except (IOError, IndexError, ValueError):
+            continue
+        children.setdefault(parent, []).append(int(entry))
+    tree = [root]
+    for pid in tree:
+        tree.extend(children.get(pid, ()))
+    return tree
+
+
+def startServer(options, dataDir):
+    args = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "server.py"),
+            "--port", str(options.port), "--data-dir", dataDir] + options.server_args.split()
+    if options.workers > 0:
+        args = args + ["--workers", str(options.workers)]
+    log = open(options.server_log, 'wb')
+    # a background shell leaves SIGINT ignored, which the server needs to stop
+    process = subprocess.Popen(args, stdout=log, stderr=subprocess.STDOUT,
+                               preexec_fn=lambda: signal.signal(signal.SIGINT, signal.SIG_DFL))
+    deadline = time.time() + 10
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError("the server exited; see " + options.server_log)
+        try:
+            probe = socket.create_connection((options.host, options.port), timeout=0.2)
+            probe.close()
+            # the probe shows up as a client that hung up during login
+            return process
+        except socket.error:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError("the server did not start listening; see " + options.server_log)
+
+
+def stopServer(process):
+    process.send_signal(signal.SIGINT)
+    deadline = time.time() + 10
+    while time.time() < deadline and process.poll() is None:
+        time.sleep(0.1)
+    if process.poll() is None:
+        process.kill()
+        process.wait()
+
+
+def printReport(report):
+    def line(label, stats):
+        if stats is None:
+            return "    " + label.ljust(10) + "-"
+        return "    " + label.ljust(10) + "n=%-7d p50 %7.2f  p90 %7.2f  p99 %7.2f  max %7.2f ms" % (
+            stats['count'], stats['p50'] * 1000, stats['p90'] * 1000, stats['p99'] * 1000, stats['max'] * 1000)
+
+    out = sys.stderr
+    print >> out, "Connected %d of %d clients in %.1fs (%d failures)" % (
+        report['connected'], report['options']['clients'], report['connect_time'], report['failures'])
+    print >> out, "Sent %d commands, %.1f/s, %d lost" % (report['commands_sent'], report['commands_per_second'], report['lost'])
+    print >> out, "Round trip:"
+    for kind in sorted(report['latency']):
+        print >> out, line(kind, report['latency'][kind])
+    print >> out, line("all", report['latency_all'])
+    print >> out, "Broadcast fan-out:"
+    print >> out, line("room", report['fanout'])
+    if 'server' in report:
+        server = report['server']
+        print >> out, "Server: %.2f CPU seconds (%.0f%%), %d KB resident, %d KB peak, %d processes" % (
+            server['cpu_seconds'], server['cpu_percent'], server['rss_kb'], server['peak_rss_kb'], server['processes'])
+    for error in report['errors']:
+        print >> out, "    " + error
+    if report['unplaced']:
+        print >> out, "FAILED: %d clients never got into their room; the numbers above don't describe the load asked for." % report['unplaced']
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load generator for the Mushy server.")
+    parser.add_argument('--clients', type=int, default=50)
+    parser.add_argument('--rate', type=float, default=0.5, help="commands per second per client")
+    parser.add_argument('--duration', type=float, default=20.0, help="seconds to measure for")
+    parser.add_argument('--rooms', type=int, default=1, help="spread the clients over this many rooms")
+    parser.add_argument('--mix', default=DEFAULT_MIX, help="weights of say, emote, roll, look and pm")
+    parser.add_argument('--connect-rate', type=float, default=500.0, help="new connections per second")
+    parser.add_argument('--login-timeout', type=float, default=30.0)
+    parser.add_argument('--drain', type=float, default=2.0, help="seconds to wait for late replies")
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--host', default="127.0.0.1")
+    parser.add_argument('--port', type=int, default=18080)
+    parser.add_argument('--no-server', action='store_true', help="load a server that is already running")
+    parser.add_argument('--server-args', default="", help="extra arguments for server.py")
+    parser.add_argument('--workers', type=int, default=0, help="start the server with this many workers")
+    parser.add_argument('--server-log', default=os.devnull)
+    parser.add_argument('--json', metavar='FILE', help="write the results to FILE ('-' for stdout)")
+    options = parser.parse_args()
+
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    wanted = options.clients * 2 + 64
+    if soft < wanted:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (min(wanted, hard), hard))
+
+    process = None
+    dataDir = None
+    options.pid = None
+    if not options.no_server:
+        dataDir = tempfile.mkdtemp(prefix="mushy-load-")
+        process = startServer(options, dataDir)
+        options.pid = process.pid
+    try:
+        report = LoadGenerator(options).run()
+    finally:
+        if process is not None:
+            stopServer(process)
+        if dataDir is not None:
+            shutil.rmtree(dataDir, ignore_errors=True)
+
+    printReport(report)
+    if options.json == '-':
+        print json.dumps(report, indent=2, sort_keys=True)
+    elif options.json:
+        with open(options.json, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    if report['unplaced']:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
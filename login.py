@@ -0,0 +1,128 @@
+from colorer import colorfy
+
+ASK_NAME = 0
+ASK_TAKEOVER = 1
+ASK_DM = 2
+ASK_ROOM = 3
+DONE = 4
+
+
+class LoginSession(object):
+    """The login conversation for one connection, independent of how the
+       connection is served. Call start() for the greeting, then feed() each
+       line the client sends; both return the text to send back. Once
+       finished is set, rejected tells whether the client backed out, and
+       otherwise username and dm describe the new player. With askRoom set,
+       the player also picks the room to start in (room stays None for the
+       lobby)."""
+
+    def __init__(self, world, askRoom=False):
+        self.world = world
+        self.askRoom = askRoom
+        self.state = ASK_NAME
+        self.username = ""
+        self.dm = False
+        self.room = None
+        # the connection this login took the place of, if any
+        self.clone = None
+        self.finished = False
+        self.rejected = False
+
+    def start(self):
+        return "-- Welcome to Mushy --\nWhat will you use for a name?\n"
+
+    def feed(self, line):
+        line = line.strip()
+        if self.state == ASK_NAME:
+            return self.answerName(line)
+        elif self.state == ASK_TAKEOVER:
+            return self.answerTakeover(line)
+        elif self.state == ASK_DM:
+            return self.answerDM(line)
+        elif self.state == ASK_ROOM:
+            return self.answerRoom(line)
+        return ""
+
+    def answerName(self, username):
+        reply = "\n"
+        # validate username
+        if len(username) < 1:
+            reply = reply + "Choose a REAL name!\n"
+        if len(username.split()) > 1:
+            reply = reply + "Only use your first name!\n"
+        if len(username) < 1 or len(username.split()) != 1:
+            return reply + "What will you use for a name?\n"
+
+        self.username = username[0].upper() + username[1:]
+        if checkIfOnline(self.world, self.username):
+            self.state = ASK_TAKEOVER
+            return reply + "Another instance of you is already connected. Do you want to take its place? (y/n)\n"
+
+        self.state = ASK_DM
+        return reply + "Are you the DM for the group (y if yes)? "
+
+    def answerTakeover(self, choice):
+        if choice.lower() == 'y':
+            self.clone = killClone(self.world, self.username)
+            self.state = ASK_DM
+            return "Are you the DM for the group (y if yes)? "
+        elif choice.lower() == 'n':
+            self.state = DONE
+            self.finished = True
+            self.rejected = True
+            return ""
+        return "Another instance of you is already connected. Do you want to take its place? (y/n)\n"
+
+    def answerDM(self, choice):
+        self.dm = choice.lower() == 'y'
+        if self.askRoom:
+            self.state = ASK_ROOM
+            return "Which room will you join (blank for the lobby)? "
+        self.state = DONE
+        self.finished = True
+        return ""
+
+    def answerRoom(self, room):
+        if len(room.split()) > 1:
+            return "Room names are one word. Which room will you join? "
+        if room != "":
+            self.room = room.lower()
+        self.state = DONE
+        self.finished = True
+        return ""
+
+
+def checkIfOnline(world, username):
+    user = world.findPlayer(username)
+    return user is not None and user.proxy is not None and user.proxy.running
+
+
+def killClone(world, username):
+    """Disconnects a player's running login. Returns it, or None."""
+    user = world.findPlayer(username)
+    if user is not None and user.proxy is not None and user.proxy.running:
+        world.leave(user)
+        user.proxy.kill()
+        return user
+    return None
+
+
+def enterSession(world, player, room=None, clone=None):
+    """Registers a freshly logged in player, puts them in a room (the lobby
+       by default) and announces them to everyone there. A player coming
+       back to a login still registered, or to the clone they killed, is
+       shown its scrollback first."""
+    previous = world.enter(player, room)
+    if previous is not None and previous.proxy is not None:
+        # lost a race with another login under the same name, or the
+        # connection it had dropped without logging out
+        previous.proxy.kill()
+    if previous is None:
+        previous = clone
+    if previous is not None:
+        player.takeOver(previous)
+
+    player.instance.broadcast(colorfy("[SERVER] " + player.name + " has joined the session.", "bright yellow"),
+                              actor=player, actorMessage=colorfy("[SERVER] You have joined the session.", "bright yellow"))
+
+    player.sendMessage(colorfy("[SERVER] You may type 'help' at any time for a list of commands.", 'bright green'))
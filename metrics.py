@@ -0,0 +1,220 @@
+import json
+import math
+import time
+import threading
+
+"""
+Where the time goes: per-command latency histograms and counts, and what
+each client has been sent.
+
+Everything is off unless the server is started with --metrics (or a DM
+turns it on with "stats on"). While it is off, each instrumented spot
+costs one check of the enabled flag.
+
+For every command the dispatcher records how long it waited in the queue,
+how long routing took (shorthands, aliases, prefixes), and how long the
+handler ran, sends included. Sends are also timed on their own: handing
+bytes to a client's output buffer, and writing them to the socket. Each
+time ratelimit holds something back is counted, with how long it waited.
+"""
+
+enabled = False
+dumpPath = None
+dumpInterval = 60.0
+
+lock = threading.Lock()
+started = time.time()
+commands = {}
+phases = {}
+clients = {}
+throttles = {}
+
+# histogram buckets are quarter octaves of microseconds
+STEPS = 4
+BUCKETS = 40 * STEPS
+
+
+def configure(on, path=None, interval=60.0):
+    global enabled, dumpPath, dumpInterval
+    enabled = on
+    dumpPath = path
+    dumpInterval = interval
+
+
+class Histogram(object):
+
+    def __init__(self):
+        self.counts = [0] * BUCKETS
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds):
+        # lock held
+        micros = seconds * 1000000.0
+        if micros < 1.0:
+            bucket = 0
+        else:
+            mantissa, exponent = math.frexp(micros)
+            bucket = min(exponent * STEPS + int((mantissa - 0.5) * 2 * STEPS), BUCKETS - 1)
+        self.counts[bucket] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, fraction):
+        """Returns the upper edge of the bucket holding the given fraction
+           of samples, in seconds."""
+        if self.count == 0:
+            return 0.0
+        wanted = fraction * self.count
+        seen = 0
+        for bucket, count in enumerate(self.counts):
+            seen += count
+            if seen >= wanted:
+                if bucket == 0:
+                    return 0.000001
+                exponent, step = divmod(bucket, STEPS)
+                edge = math.ldexp(0.5 + float(step + 1) / (2 * STEPS), exponent) / 1000000.0
+                return min(edge, self.max)
+        return self.max
+
+    def mean(self):
+        if self.count == 0:
+            return 0.0
+        return self.total / self.count
+
+    def summary(self):
+        return {'count': self.count, 'mean': self.mean(), 'p50': self.percentile(0.5),
+                'p95': self.percentile(0.95), 'p99': self.percentile(0.99), 'max': self.max}
+
+
+class CommandTimings(object):
+
+    def __init__(self):
+        self.wait = Histogram()
+        self.route = Histogram()
+        self.handler = Histogram()
+        self.failed = 0
+
+
+def command(name, wait, route, handler, ok):
+    with lock:
+        timings = commands.get(name)
+        if timings is None:
+            timings = commands[name] = CommandTimings()
+        if wait is not None:
+            timings.wait.record(wait)
+        timings.route.record(route)
+        timings.handler.record(handler)
+        if not ok:
+            timings.failed += 1
+
+
+def phase(name, seconds):
+    with lock:
+        histogram = phases.get(name)
+        if histogram is None:
+            histogram = phases[name] = Histogram()
+        histogram.record(seconds)
+
+
+def sent(client, nbytes):
+    with lock:
+        counts = clients.get(client)
+        if counts is None:
+            counts = clients[client] = [0, 0]
+        counts[0] += 1
+        counts[1] += nbytes
+
+
+def throttled(kind, seconds=0.0):
+    with lock:
+        counts = throttles.get(kind)
+        if counts is None:
+            counts = throttles[kind] = [0, 0.0]
+        counts[0] += 1
+        counts[1] += seconds
+
+
+def reset():
+    global started
+    with lock:
+        commands.clear()
+        phases.clear()
+        clients.clear()
+        throttles.clear()
+        started = time.time()
+
+
+def snapshot():
+    """Everything recorded so far, as plain data."""
+    with lock:
+        return {
+            'time': time.time(),
+            'since': started,
+            'commands': dict((name, {'wait': t.wait.summary(), 'route': t.route.summary(),
+                                     'handler': t.handler.summary(), 'failed': t.failed})
+                             for name, t in commands.items()),
+            'phases': dict((name, h.summary()) for name, h in phases.items()),
+            'clients': dict((name, {'messages': c[0], 'bytes': c[1]}) for name, c in clients.items()),
+            'throttled': dict((kind, {'count': c[0], 'waited': c[1]}) for kind, c in throttles.items()),
+        }
+
+
+def milliseconds(seconds):
+    return "%.2f" % (seconds * 1000.0)
+
+
+def report(top=10):
+    """Lines of text for the stats command."""
+    data = snapshot()
+    lines = ["Since " + time.strftime("%H:%M:%S", time.localtime(data['since'])) + ", in milliseconds:"]
+    lines.append("    command        count   p50     p95     max     wait    route")
+    ranked = sorted(data['commands'].items(), key=lambda item: -item[1]['handler']['count'] * item[1]['handler']['mean'])
+    for name, timings in ranked:
+        handler = timings['handler']
+        lines.append("    " + name.ljust(15) + str(handler['count']).ljust(8) +
+                     milliseconds(handler['p50']).ljust(8) + milliseconds(handler['p95']).ljust(8) +
+                     milliseconds(handler['max']).ljust(8) + milliseconds(timings['wait']['mean']).ljust(8) +
+                     milliseconds(timings['route']['mean']))
+    for name, histogram in sorted(data['phases'].items()):
+        lines.append("    " + name.ljust(15) + str(histogram['count']).ljust(8) +
+                     milliseconds(histogram['p50']).ljust(8) + milliseconds(histogram['p95']).ljust(8) +
+                     milliseconds(histogram['max']))
+    if data['throttled']:
+        lines.append("Throttled:")
+        for kind, counts in sorted(data['throttled'].items()):
+            lines.append("    " + kind.ljust(15) + str(counts['count']) + " times, " +
+                         milliseconds(counts['waited']) + " ms waited")
+    if data['clients']:
+        lines.append("Sent to clients:")
+        ranked = sorted(data['clients'].items(), key=lambda item: -item[1]['bytes'])[:top]
+        for name, counts in ranked:
+            lines.append("    " + name.ljust(15) + str(counts['messages']) + " messages, " + str(counts['bytes']) + " bytes")
+    return lines
+
+
+def startDumping(suffix=""):
+    """Appends a snapshot to the dump file every dumpInterval seconds, if
+       a dump file was configured."""
+    if dumpPath is None:
+        return None
+    path = dumpPath + suffix
+
+    def dumpForever():
+        while True:
+            time.sleep(dumpInterval)
+            if not enabled:
+                continue
+            try:
+                with open(path, 'ab') as f:
+                    f.write(json.dumps(snapshot(), sort_keys=True, encoding='latin-1') + "\n")
+            except (IOError, OSError) as e:
+                print "Metrics: Could not write " + path + ": " + str(e)
+
+    thread = threading.Thread(target=dumpForever, name="MetricsDump")
+    thread.daemon = True
+    thread.start()
+    return thread
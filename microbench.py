@@ -0,0 +1,260 @@
+import os
+import sys
+import json
+import time
+import timeit
+import argparse
+import subprocess
+from collections import deque
+
+import commandparser
+import functionmapper
+import commands
+import session
+import entity
+import ratelimit
+from colorer import colorfy
+
+"""
+Microbenchmarks for the per-command hot paths: making a command's args,
+parsing a line, expanding shorthands, the flag parsing in
+say/whisper/display, colorfy, rendering the scene and help.
+
+    python microbench.py                 run everything, compare, record
+    python microbench.py --filter say    only benchmarks with "say" in the name
+    python microbench.py --no-save       compare without recording the run
+
+Commands run against a room of fake players whose output is kept in memory,
+so no sockets or threads are involved. Each benchmark reports the best time
+per call over several repeats. Runs are appended to a history file, and
+each benchmark is compared with the median of its last few runs.
+
+Timings on a shared machine wander by a good 30% from run to run. Every
+run also times a fixed piece of plain Python, and earlier runs are scaled
+by how fast that went then against now, so a machine that is busier today
+doesn't look like a regression. A benchmark that still looks slower is
+timed again and keeps its better time, and it only counts as a regression
+when it is slower than the threshold and than twice the spread its own
+recent runs show. Once the history holds
+BASELINE_RUNS runs, a regression fails the run with exit status 1; before
+that it is only reported.
+"""
+
+HISTORY = "microbench-history.jsonl"
+# how many earlier runs the baseline is the median of
+BASELINE_RUNS = 5
+
+
+class CaptureProxy(object):
+    """Stands in for a client connection and keeps what it's sent."""
+
+    def __init__(self):
+        self.running = True
+        self.entity = None
+        self.output = deque(maxlen=100)
+        self.sent = 0
+
+    def setEntity(self, entity):
+        self.entity = entity
+
+    def send(self, payload):
+        self.output.append(payload)
+        self.sent += len(payload)
+
+    def kill(self):
+        self.running = False
+
+
+class NullDispatcher(object):
+    """Swallows queued commands, so parseLine can be timed on its own."""
+
+    def put(self, args):
+        pass
+
+
+def makeRoom(players=10):
+    world = session.World()
+    room = world.lobby
+    actors = []
+    for index in range(players):
+        player = entity.Entity(CaptureProxy(), "Player" + str(index), room)
+        world.enter(player, room)
+        actors.append(player)
+    actors[0].dm = True
+
+    room.paintSceneTitle(colorfy("Inferno Cave", "bright red"))
+    room.paintSceneBody(colorfy("Lava swirls around burning stone in a river of red.", "red"))
+    for name in ("flame", "altar", "bones", "torch", "chest"):
+        room.paintObject(name, colorfy("A " + name + " sits here.", "yellow"))
+    return world, room, actors
+
+
+def command(line, actor):
+    return commandparser.CommandArgs(name=line.split(" ")[0], tokens=line.split(" "), full=line, actor=actor)
+
+
+def benchmarks():
+    """Returns [(name, callable)]."""
+    # flood protection would turn the repeated commands away
+    ratelimit.configure((0, 0), dict((name, (0, 0)) for name in ratelimit.classLimits), (0, 0))
+    world, room, actors = makeRoom()
+    dm = actors[0]
+
+    quiet = session.Instance(name="quiet")
+    quiet.dispatcher = NullDispatcher()
+    parser = entity.Entity(CaptureProxy(), "Parser", quiet)
+
+    def run(line):
+        return lambda: commandparser.dispatchCommand(command(line, dm))
+
+    def handler(function, line):
+        return lambda: function(command(line, dm))
+
+    def shorthand(line):
+        return lambda: functionmapper.shorthandHandler(command(line, dm))
+
+    def invalidated():
+        room.invalidateScene()
+        return room.scenePayload()
+
+    return [
+        ("CommandArgs", lambda: commandparser.CommandArgs(name="say", tokens=["say", "hi"], full="say hi", actor=dm)),
+        ("parseLine", lambda: commandparser.parseLine("say hello there, how are you?", parser)),
+        ("shorthand emote", shorthand(";waves at everyone")),
+        ("shorthand roll", shorthand("#20")),
+        ("shorthand say", shorthand("'hello there")),
+        ("route prefix", shorthand("whi -t king Hello")),
+        ("say", handler(commands.say, "say hello there, how are you?")),
+        ("say -l -t", handler(commands.say, "say -l elven -t king hello your majesty")),
+        ("whisper -t", handler(commands.whisper, "whisper -t king hello your majesty")),
+        ("display -c", handler(commands.display, "display -c bred The torch gutters.")),
+        ("dispatch say", run("say hello there")),
+        ("colorfy", lambda: colorfy("Eitan says, \"Hello.\"", "bright yellow")),
+        ("viewScene", room.viewScene),
+        ("scene cached", room.scenePayload),
+        ("scene render", invalidated),
+        ("look", handler(commands.look, "look")),
+        ("help", handler(commands.help, "help")),
+        ("help topic", handler(commands.help, "help whisper")),
+    ]
+
+
+def measure(function, repeat=5, minimum=0.2):
+    """Best seconds per call over several repeats, each long enough to
+       time reliably."""
+    timer = timeit.Timer(function)
+    number = 1
+    while True:
+        elapsed = timer.timeit(number)
+        if elapsed >= minimum / 10:
+            break
+        number *= 10
+    number = max(1, int(number * minimum / elapsed))
+    return min(timer.repeat(repeat, number)) / number
+
+
+def revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"],
+                                       cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=open(os.devnull, 'w')).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def loadHistory(path):
+    runs = []
+    if not os.path.exists(path):
+        return runs
+    with open(path) as f:
+        for line in f:
+            try:
+                runs.append(json.loads(line))
+            except ValueError:
+                pass
+    return runs
+
+
+def calibrate(repeat):
+    """Seconds per call of a fixed bit of interpreter work, to tell a slow
+       machine from slow code."""
+    words = ["word" + str(i) for i in range(100)]
+    return measure(lambda: sorted(dict((word, len(word)) for word in words).items()), repeat)
+
+
+def baseline(runs, name, calibration=None):
+    """Returns (median, spread, runs) over a benchmark's recent runs, each
+       scaled to this run's calibration when both have one, the spread
+       being (slowest - fastest) / median; None if it has none."""
+    times = []
+    for run in runs:
+        if name not in run.get('results', {}):
+            continue
+        seconds = run['results'][name]
+        if calibration is not None and run.get('calibration'):
+            seconds = seconds * calibration / run['calibration']
+        times.append(seconds)
+    times = times[-BASELINE_RUNS:]
+    if not times:
+        return None
+    times.sort()
+    median = times[len(times) // 2]
+    return median, (times[-1] - times[0]) / median, len(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Microbenchmarks for the command hot paths.")
+    parser.add_argument('--filter', default="", help="only run benchmarks whose name contains this")
+    parser.add_argument('--history', default=HISTORY, help="where runs are recorded")
+    parser.add_argument('--threshold', type=float, default=0.4,
+                        help="fail if a benchmark is this much slower than its baseline (0.4 is 40%%), "
+                             "or twice its recent spread if that is more")
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--no-save', action='store_true', help="don't record this run")
+    options = parser.parse_args()
+
+    history = loadHistory(options.history)
+    results = {}
+    regressions = []
+    settled = True
+    calibration = calibrate(options.repeat)
+    print "%-18s %12s %12s %8s" % ("benchmark", "usec/call", "baseline", "change")
+    for name, function in benchmarks():
+        if options.filter not in name:
+            continue
+        seconds = measure(function, options.repeat)
+        entry = baseline(history, name, calibration)
+        if entry is None:
+            results[name] = seconds
+            print "%-18s %12.3f %12s %8s" % (name, seconds * 1e6, "-", "-")
+            continue
+        base, spread, count = entry
+        allowed = max(options.threshold, 2 * spread)
+        if seconds / base - 1 > allowed:
+            # one slow timing is usually the machine; keep the better of two
+            seconds = min(seconds, measure(function, options.repeat))
+        results[name] = seconds
+        change = seconds / base - 1
+        flag = ""
+        if change > allowed:
+            flag = "  REGRESSION"
+            regressions.append(name)
+            if count < BASELINE_RUNS:
+                flag = "  slower (baseline has " + str(count) + " of " + str(BASELINE_RUNS) + " runs)"
+                settled = False
+        print "%-18s %12.3f %12.3f %+7.1f%%%s" % (name, seconds * 1e6, base * 1e6, change * 100, flag)
+
+    if not options.no_save:
+        with open(options.history, 'a') as f:
+            f.write(json.dumps({'time': time.time(), 'revision': revision(), 'python': sys.version.split()[0],
+                                'calibration': calibration, 'results': results}, sort_keys=True) + "\n")
+
+    if regressions:
+        print str(len(regressions)) + " benchmark(s) slower than their baseline allows: " + ", ".join(regressions)
+        if settled:
+            sys.exit(1)
+        print "Not failing the run until the history holds " + str(BASELINE_RUNS) + " runs."
+
+
+if __name__ == '__main__':
+    main()
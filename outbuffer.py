@@ -0,0 +1,179 @@
+import threading
+import time
+from collections import deque
+
+DROP = 'drop'
+COALESCE = 'coalesce'
+DISCONNECT = 'disconnect'
+POLICIES = (DROP, COALESCE, DISCONNECT)
+
+# Defaults for new buffers, set from the command line in server.main.
+defaultLimit = 256 * 1024
+defaultPolicy = COALESCE
+
+
+def configure(limit=None, policy=None):
+    global defaultLimit, defaultPolicy
+    if limit is not None:
+        defaultLimit = limit
+    if policy is not None:
+        if policy not in POLICIES:
+            raise ValueError("Unknown output policy: %r" % policy)
+        defaultPolicy = policy
+
+
+class OutputBuffer(object):
+    """Bounded queue of outgoing bytes for one client.
+
+       Producers (the dispatcher, login, broadcasts) call put() and never
+       touch the socket. A writer takes everything queued so far with take(),
+       writes it, and reports back through sent(). When a client falls more
+       than `limit` bytes behind, the policy decides what happens:
+
+           drop       - new messages are discarded until the client catches up
+           coalesce   - the backlog is replaced by a single "skipped" notice
+           disconnect - put() returns False and the caller drops the client
+    """
+
+    def __init__(self, limit=None, policy=None):
+        if limit is None:
+            limit = defaultLimit
+        if policy is None:
+            policy = defaultPolicy
+        self.limit = limit
+        self.policy = policy
+        self.lock = threading.Lock()
+        self.ready = threading.Condition(self.lock)
+        self.chunks = deque()
+        self.size = 0
+        self.inflight = 0
+        self.closed = False
+        # when the client last took some output, or last had none waiting
+        self.progress = time.time()
+
+        # metrics, read through stats()
+        self.messages = 0
+        self.sentMessages = 0
+        self.sentBytes = 0
+        self.dropped = 0
+        self.droppedBytes = 0
+        self.coalesced = 0
+        self.maxBuffered = 0
+        self.batches = 0
+        self.totalLatency = 0.0
+        self.maxLatency = 0.0
+
+    def put(self, data):
+        """Queues data for the writer. Returns False if the client has
+           fallen behind and the policy says to disconnect it."""
+        with self.lock:
+            if self.closed:
+                return True
+
+            if self.chunks and self.size + self.inflight + len(data) > self.limit:
+                if self.policy == DROP:
+                    self.dropped += 1
+                    self.droppedBytes += len(data)
+                    return True
+                elif self.policy == COALESCE:
+                    self.discard()
+                    self.coalesced += 1
+                    self.append("[SERVER] You fell behind; some messages were skipped.\n")
+                else:
+                    self.discard()
+                    self.closed = True
+                    self.ready.notify_all()
+                    return False
+
+            self.append(data)
+            self.ready.notify()
+        return True
+
+    def append(self, data):
+        now = time.time()
+        if self.size + self.inflight == 0:
+            self.progress = now
+        self.chunks.append((now, data))
+        self.size += len(data)
+        self.messages += 1
+        if self.size + self.inflight > self.maxBuffered:
+            self.maxBuffered = self.size + self.inflight
+
+    def discard(self):
+        self.dropped += len(self.chunks)
+        self.droppedBytes += self.size
+        self.chunks.clear()
+        self.size = 0
+
+    def take(self, block=True):
+        """Returns (data, queued) with everything queued so far joined into
+           one string, `queued` being when the oldest part was queued. Blocks
+           for data unless told not to; returns None when there is nothing to
+           write (or, blocking, once the buffer is closed and empty)."""
+        with self.lock:
+            while not self.chunks:
+                if self.closed or not block:
+                    return None
+                self.ready.wait()
+            queued = self.chunks[0][0]
+            count = len(self.chunks)
+            data = "".join([chunk for stamp, chunk in self.chunks])
+            self.chunks.clear()
+            self.size = 0
+            self.inflight += len(data)
+            self.sentMessages += count
+        return data, queued
+
+    def sent(self, nbytes, queued=None):
+        """Reports bytes written. Pass the `queued` stamp from take() once
+           the whole batch is out to record its latency."""
+        with self.lock:
+            self.inflight -= nbytes
+            self.sentBytes += nbytes
+            self.progress = time.time()
+            if queued is not None:
+                latency = time.time() - queued
+                self.batches += 1
+                self.totalLatency += latency
+                if latency > self.maxLatency:
+                    self.maxLatency = latency
+
+    def close(self, discard=False):
+        """Stops accepting output. The writer still gets what is queued
+           unless discard is set."""
+        with self.lock:
+            if discard:
+                self.discard()
+            self.closed = True
+            self.ready.notify_all()
+
+    def stalled(self, now):
+        """Seconds the client has had output waiting without taking any."""
+        with self.lock:
+            if self.size + self.inflight == 0:
+                return 0.0
+            return now - self.progress
+
+    def buffered(self):
+        with self.lock:
+            return self.size + self.inflight
+
+    def stats(self):
+        with self.lock:
+            average = 0.0
+            if self.batches > 0:
+                average = self.totalLatency / self.batches
+            return {
+                'buffered': self.size + self.inflight,
+                'max_buffered': self.maxBuffered,
+                'limit': self.limit,
+                'policy': self.policy,
+                'messages': self.messages,
+                'sent_messages': self.sentMessages,
+                'sent_bytes': self.sentBytes,
+                'dropped': self.dropped,
+                'dropped_bytes': self.droppedBytes,
+                'coalesced': self.coalesced,
+                'average_latency': average,
+                'max_latency': self.maxLatency,
+            }
@@ -0,0 +1,210 @@
+import os
+import sys
+import ast
+import importlib
+import threading
+import traceback
+
+"""
+Commands that live in modules of the plugins package.
+
+A plugin module marks its command functions with the command decorator:
+
+    from pluginloader import command
+
+    @command("roll", aliases=("r",))
+    def roll(args):
+        ...
+
+At startup the loader reads each plugin's source without importing it,
+finds the decorated functions and registers a stand-in for each, carrying
+the real docstring so help works. The module is imported the first time
+one of its commands is used, and its real functions take over.
+
+A DM can reload plugins whose source has changed. Reloading swaps the
+functions in the router and nothing else, so nobody is disconnected.
+"""
+
+
+def command(name, aliases=()):
+    """Marks a function as the handler of a command. Stack it to give one
+       function several commands."""
+    def mark(function):
+        marks = function.__dict__.setdefault('commands', [])
+        marks.insert(0, (name, tuple(aliases)))
+        return function
+    return mark
+
+
+def scan(path):
+    """Returns [(name, aliases, docstring)] for every command marked in a
+       plugin's source, without importing it."""
+    with open(path, 'rb') as f:
+        tree = ast.parse(f.read(), path)
+    found = []
+    for node in tree.body:
+        if not isinstance(node, ast.FunctionDef):
+            continue
+        doc = ast.get_docstring(node, clean=False)
+        for decorator in node.decorator_list:
+            if not isinstance(decorator, ast.Call):
+                continue
+            target = decorator.func
+            if isinstance(target, ast.Attribute):
+                target = ast.Name(id=target.attr)
+            if not isinstance(target, ast.Name) or target.id != 'command':
+                continue
+            if not decorator.args or not isinstance(decorator.args[0], ast.Str):
+                continue
+            aliases = ()
+            for keyword in decorator.keywords:
+                if keyword.arg == 'aliases' and isinstance(keyword.value, (ast.Tuple, ast.List)):
+                    aliases = tuple(item.s for item in keyword.value.elts if isinstance(item, ast.Str))
+            found.append((decorator.args[0].s, aliases, doc))
+    return found
+
+
+class LazyCommand(object):
+    """Stands in for a command until its plugin is imported."""
+
+    def __init__(self, loader, plugin, name, doc):
+        self.loader = loader
+        self.plugin = plugin
+        self.name = name
+        self.__doc__ = doc
+
+    def __call__(self, args):
+        function = self.loader.load(self.plugin).get(self.name)
+        if function is None:
+            return False
+        return function(args)
+
+
+class Plugin(object):
+
+    def __init__(self, name, path):
+        self.name = name
+        self.path = path
+        self.mtime = None
+        self.module = None
+        # command name -> function, or LazyCommand until loaded
+        self.commands = {}
+
+
+class Loader(object):
+    """Finds the plugins in a package and keeps their commands registered
+       with a router."""
+
+    def __init__(self, router, package="plugins", directory=None):
+        self.router = router
+        self.package = package
+        if directory is None:
+            directory = os.path.join(os.path.dirname(os.path.abspath(__file__)), package)
+        self.directory = directory
+        self.lock = threading.RLock()
+        self.plugins = {}
+
+    def discover(self):
+        """Registers stand-ins for the commands of every plugin not seen
+           before. Returns the names of the new plugins."""
+        found = []
+        if not os.path.isdir(self.directory):
+            return found
+        for filename in sorted(os.listdir(self.directory)):
+            name, extension = os.path.splitext(filename)
+            if extension != ".py" or name.startswith("_"):
+                continue
+            with self.lock:
+                if name in self.plugins:
+                    continue
+                plugin = Plugin(name, os.path.join(self.directory, filename))
+                try:
+                    self.stub(plugin)
+                except (SyntaxError, IOError):
+                    print "Plugins: Could not read " + plugin.path + "."
+                    print traceback.format_exc()
+                    continue
+                self.plugins[name] = plugin
+            found.append(name)
+        return found
+
+    def stub(self, plugin):
+        plugin.mtime = os.path.getmtime(plugin.path)
+        commands = {}
+        aliases = {}
+        for name, names, doc in scan(plugin.path):
+            commands[name] = LazyCommand(self, plugin, name, doc)
+            aliases[name] = names
+        self.install(plugin, commands, aliases)
+
+    def load(self, plugin):
+        """Imports a plugin if it isn't yet. Returns its commands."""
+        with self.lock:
+            if plugin.module is None:
+                plugin.module = importlib.import_module(self.package + "." + plugin.name)
+                plugin.mtime = os.path.getmtime(plugin.path)
+                self.collect(plugin)
+            return plugin.commands
+
+    def collect(self, plugin):
+        commands = {}
+        aliases = {}
+        for value in vars(plugin.module).values():
+            for name, names in getattr(value, 'commands', ()):
+                if callable(value):
+                    commands[name] = value
+                    aliases[name] = names
+        self.install(plugin, commands, aliases)
+
+    def install(self, plugin, commands, aliases):
+        # lock held
+        for name in plugin.commands:
+            if name not in commands:
+                self.router.unregister(name)
+        for name, function in commands.items():
+            self.router.register(name, function, aliases.get(name, ()))
+        plugin.commands = commands
+
+    def refresh(self, plugin):
+        # a fresh module, so functions deleted from the source go away too
+        fullname = self.package + "." + plugin.name
+        old = sys.modules.pop(fullname, None)
+        try:
+            plugin.module = importlib.import_module(fullname)
+        except:
+            if old is not None:
+                sys.modules[fullname] = old
+            raise
+        plugin.mtime = os.path.getmtime(plugin.path)
+        self.collect(plugin)
+
+    def reload(self, name=None):
+        """Reloads one plugin, or every plugin whose source changed, and
+           picks up new ones. Returns [(plugin name, error or None)]."""
+        results = [(found, None) for found in self.discover()]
+        with self.lock:
+            if name is not None:
+                if name not in self.plugins:
+                    return results + [(name, "no such plugin")]
+                chosen = [self.plugins[name]]
+            else:
+                chosen = [plugin for plugin in self.plugins.values()
+                          if os.path.exists(plugin.path) and os.path.getmtime(plugin.path) != plugin.mtime]
+
+            for plugin in sorted(chosen, key=lambda plugin: plugin.name):
+                try:
+                    if plugin.module is None:
+                        self.stub(plugin)
+                    else:
+                        self.refresh(plugin)
+                    results.append((plugin.name, None))
+                except:
+                    # the commands that were working keep working
+                    results.append((plugin.name, str(sys.exc_info()[1])))
+        return results
+
+    def listPlugins(self):
+        """Returns [(name, loaded, command names)], sorted by name."""
+        with self.lock:
+            return sorted((plugin.name, plugin.module is not None, sorted(plugin.commands))
+                          for plugin in self.plugins.values())
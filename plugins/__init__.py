@@ -0,0 +1,3 @@
+"""
+Command modules, found and loaded by pluginloader.
+"""
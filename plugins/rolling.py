@@ -0,0 +1,159 @@
+import dice
+from colorer import colorfy
+from pluginloader import command
+
+"""
+Dice rolling, and the DM's view of the dice log.
+"""
+
+
+@command("roll")
+@command("hroll")
+def roll(args):
+    """
+    Roll some dice. The dice roll is public.
+
+    syntax: roll <dice> [reason]
+
+            dice - a number of dice and their sides, like 2d6, added to
+                   or subtracted from other dice and numbers
+
+    A few extras may follow the dice:
+        kh<n> / kl<n> - keep the highest or lowest n dice
+        dh<n> / dl<n> - drop the highest or lowest n dice
+        !             - exploding dice; every die that rolls its highest
+                        side adds another die
+    "adv" and "dis" roll a d20 with advantage or disadvantage.
+
+    example:
+        roll 1d20
+        >>[DICE] DM_Eitan rolls 1d20.
+        >>  18
+
+        roll 4d6kh3+2 strength
+        >>[DICE (strength)] Justin rolls 4d6kh3+2.
+        >>  4d6kh3: 6, 5, 3, (1)
+        >>  total: 16
+
+
+    Alternatively, as a shorthand, you may roll a single die of N sides
+    with no specified purpose with the "#" token (no space).
+
+    example:
+        #20
+        >>[DICE] DM_Eitan rolls 1d20.
+        >>  18
+
+
+    Rolls can also be kept hidden from others. To do this, use the
+    command "hroll" instead of "roll".
+
+    example:
+        hroll 1d20
+    """
+    if len(args.tokens) < 2:
+        return False
+
+    visible = True
+    if args.tokens[0] == 'hroll':
+        visible = False
+
+    try:
+        result = args.actor.instance.dice.roll(args.actor.name, args.tokens[1], hidden=not visible)
+    except dice.DiceError as e:
+        args.actor.sendMessage(str(e))
+        return True
+
+    purpose = args.full[len(args.tokens[0] + " " + args.tokens[1] + " "):]
+
+    marking = "[DICE"
+    if purpose != "":
+        marking = marking + " (" + purpose + ")"
+    marking = marking + "] "
+    marking = colorfy(marking, 'bright yellow')
+
+    lines = [marking + args.actor.name + " rolls " + result.expression.text + "."] + result.lines()
+    msg = "\n".join(lines)
+
+    if visible:
+        args.actor.instance.broadcast(msg, actor=args.actor)
+    else:
+        args.actor.sendMessage(msg)
+
+    return True
+
+
+@command("dicelog")
+def dicelog(args):
+    """
+    A DM may look over the rolls made in the room, hidden ones included.
+    Every roll is logged with the seed it was rolled from, so it can be
+    rolled again to settle an argument.
+
+    syntax: dicelog [count]
+            dicelog replay <number>
+            dicelog verify
+            dicelog seed [seed]
+
+            count - how many of the latest rolls to show, 10 by default
+            number - the roll to roll again, as numbered in the log
+            seed - start the room's dice over from this seed
+
+    "verify" rolls every logged roll again and checks nothing in the log
+    was changed after the fact.
+    """
+    if not args.actor.dm:
+        return False
+
+    log = args.actor.instance.dice
+    tokens = args.tokens
+
+    if len(tokens) == 1 or (len(tokens) == 2 and tokens[1].isdigit()):
+        count = 10
+        if len(tokens) == 2:
+            count = int(tokens[1])
+            if count < 1:
+                return False
+        entries = [entry for entry in log.recent if entry['expr'] is not None][-count:]
+        if len(entries) == 0:
+            args.actor.sendMessage("Nobody has rolled here yet.")
+            return True
+        msg = colorfy("Rolls in the " + args.actor.instance.name + ":", "bright yellow")
+        for entry in entries:
+            line = "#" + str(entry['seq']) + " " + entry['actor'] + ": " + entry['expr'] + " = " + str(entry['total'])
+            if entry['hidden']:
+                line = line + colorfy(" (hidden)", "dark gray")
+            msg = msg + "\n    " + line
+        args.actor.sendMessage(msg)
+
+    elif tokens[1] == "replay" and len(tokens) == 3 and tokens[2].lstrip("#").isdigit():
+        entry = log.find(int(tokens[2].lstrip("#")))
+        if entry is None or entry['expr'] is None:
+            args.actor.sendMessage("There is no roll #" + tokens[2].lstrip("#") + " in the log.")
+            return True
+        result = log.replay(entry)
+        verdict = "matches the log."
+        if result.total != entry['total'] or result.lines() != entry['lines']:
+            verdict = "does NOT match the log, which says " + str(entry['total']) + "."
+        lines = ["#" + str(entry['seq']) + " " + entry['actor'] + " rolled " + entry['expr'] + ":"]
+        lines = lines + result.lines() + ["That " + verdict]
+        args.actor.sendMessage("\n".join(lines))
+
+    elif tokens[1] == "verify" and len(tokens) == 2:
+        checked, problems = log.verify()
+        if len(problems) == 0:
+            args.actor.sendMessage(str(checked) + " rolls checked, all of them match.")
+        else:
+            args.actor.sendMessage(str(checked) + " rolls checked, with problems:\n    " + "\n    ".join(problems))
+
+    elif tokens[1] == "seed" and len(tokens) == 2:
+        args.actor.sendMessage("The dice in the " + args.actor.instance.name + " were seeded with " + str(log.seed) + ".")
+
+    elif tokens[1] == "seed" and len(tokens) == 3 and tokens[2].isdigit():
+        log.reseed(int(tokens[2]), args.actor.name)
+        args.actor.instance.broadcast(colorfy(args.actor.name + " reseeds the dice.", "bright yellow"))
+
+    else:
+        return False
+
+    return True
@@ -0,0 +1,145 @@
+import time
+
+import metrics
+
+"""
+Flood protection: token buckets on what a client types, on what each kind
+of command may do, and on how much a room may broadcast.
+
+    input    every line a connection sends. A connection over its rate
+             isn't read from until it's back under, so the flood backs up
+             in the client's own TCP window instead of the server's queues.
+    classes  commands grouped by what they cost everyone else: chat, rolls
+             and DM painting. A command over its class's rate is refused
+             with a note to slow down.
+    fan-out  bytes a room broadcasts, counted once per listener. A room
+             over budget has its dispatcher wait before sending more, so a
+             noisy room slows itself down and nobody else.
+
+Every limit is a rate per second and a burst; a rate of 0 turns it off.
+Throttling shows up in metrics.
+"""
+
+# Defaults, set from the command line in server.main.
+inputRate = 20.0
+inputBurst = 40
+classLimits = {
+    'chat': (5.0, 15),
+    'roll': (2.0, 10),
+    'paint': (2.0, 10),
+}
+fanoutRate = 4 * 1024 * 1024
+fanoutBurst = 1024 * 1024
+# the longest a dispatcher waits out a room's fan-out debt at once
+maxFanoutWait = 1.0
+
+commandClasses = {
+    'say': 'chat', 'whisper': 'chat', 'pm': 'chat', 'emote': 'chat',
+    'ooc': 'chat', 'mask': 'chat', 'status': 'chat',
+    'roll': 'roll', 'hroll': 'roll',
+    'paint': 'paint', 'erase': 'paint', 'wipe': 'paint', 'display': 'paint', 'scene': 'paint',
+}
+
+
+def configure(inputLimit=None, classes=None, fanoutLimit=None):
+    """The limits are (rate, burst); classes maps class names to limits."""
+    global inputRate, inputBurst, fanoutRate, fanoutBurst
+    if inputLimit is not None:
+        inputRate, inputBurst = inputLimit
+    if classes is not None:
+        for name, limit in classes.items():
+            if name not in classLimits:
+                raise ValueError("Unknown command class: %r" % name)
+            classLimits[name] = limit
+    if fanoutLimit is not None:
+        fanoutRate, fanoutBurst = fanoutLimit
+
+
+def parseLimit(text):
+    """Reads "RATE" or "RATE/BURST"; the burst defaults to a second's worth,
+       and at least one."""
+    rate, _, burst = text.partition("/")
+    rate = float(rate)
+    if burst:
+        burst = float(burst)
+    else:
+        burst = max(rate, 1.0)
+    if rate < 0 or burst < 0:
+        raise ValueError("Limits can't be negative: %r" % text)
+    return rate, burst
+
+
+class TokenBucket(object):
+    """Holds up to burst tokens, refilled at rate per second. Not locked:
+       each bucket belongs to one thread at a time (a connection's reader,
+       a room's dispatcher), and where two threads do meet the worst case
+       is a slightly wrong count."""
+
+    def __init__(self, rate, burst):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.tokens = self.burst
+        self.stamp = time.time()
+
+    def refill(self, now):
+        if now > self.stamp:
+            self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def take(self, amount=1, now=None):
+        """Takes tokens if there are enough. Returns whether it did."""
+        if now is None:
+            now = time.time()
+        self.refill(now)
+        if self.tokens < amount:
+            return False
+        self.tokens -= amount
+        return True
+
+    def charge(self, amount=1, now=None):
+        """Takes tokens whether or not there are enough, going into debt.
+           Returns how many seconds until the debt is paid off (0 if there
+           is none)."""
+        if now is None:
+            now = time.time()
+        self.refill(now)
+        self.tokens -= amount
+        if self.tokens >= 0:
+            return 0.0
+        return -self.tokens / self.rate
+
+
+def inputBucket():
+    """A new connection's input bucket, or None when input isn't limited."""
+    if inputRate <= 0:
+        return None
+    return TokenBucket(inputRate, inputBurst)
+
+
+def fanoutBucket():
+    """A new room's fan-out budget, or None when fan-out isn't limited."""
+    if fanoutRate <= 0:
+        return None
+    return TokenBucket(fanoutRate, fanoutBurst)
+
+
+def admit(actor, name):
+    """Charges a command to its class's bucket for the actor. Returns False
+       if the actor is over the limit."""
+    kind = commandClasses.get(name)
+    if kind is None:
+        return True
+    rate, burst = classLimits[kind]
+    if rate <= 0:
+        return True
+    buckets = actor.buckets
+    if buckets is None:
+        buckets = actor.buckets = {}
+    bucket = buckets.get(kind)
+    if bucket is None:
+        bucket = buckets[kind] = TokenBucket(rate, burst)
+    if bucket.take():
+        return True
+    if metrics.enabled:
+        metrics.throttled(kind)
+    return False
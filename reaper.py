@@ -0,0 +1,179 @@
+import sys
+import time
+import socket
+import threading
+import traceback
+
+import telnet
+from colorer import colorfy
+
+"""
+Connection lifecycle: noticing connections that are dead, stuck or never
+going to log in, and closing them before they pile up.
+
+Every connection is tracked from accept until it closes, and swept every
+few seconds:
+
+    login      a connection still at the login prompts after loginTimeout
+               is closed.
+    idle       a player who hasn't sent anything for idleTimeout is told so,
+               disconnected and taken out of their room (off by default;
+               tables idle a lot).
+    keepalive  a player quiet for keepaliveInterval is sent a telnet NOP.
+               A peer that has gone away makes the write fail, and the
+               connection is dropped. Sockets also get TCP keepalives, so
+               the kernel finds half-open connections on its own.
+    stalled    a client with output waiting that hasn't taken any of it for
+               stallTimeout is dropped and taken out of their room.
+    linkdead   a player whose connection dropped without logging out stays
+               in their room (so reconnecting replays what they missed)
+               for linkdeadTimeout, then is taken out of the room and the
+               world.
+
+The threaded core sweeps from a thread of its own; the event loop sweeps on
+its own thread from a timer. Connections need connected, lastRead,
+lastProbe, entity, running, output (an outbuffer.OutputBuffer, except
+during threaded logins), send(), kill() and abort().
+"""
+
+# Seconds, set from the command line in server.main; 0 turns each off.
+loginTimeout = 120.0
+idleTimeout = 0.0
+keepaliveInterval = 60.0
+stallTimeout = 120.0
+linkdeadTimeout = 600.0
+# how often connections are checked
+checkInterval = 5.0
+
+
+def configure(login=None, idle=None, keepalive=None, stall=None, linkdead=None):
+    global loginTimeout, idleTimeout, keepaliveInterval, stallTimeout, linkdeadTimeout
+    if login is not None:
+        loginTimeout = login
+    if idle is not None:
+        idleTimeout = idle
+    if keepalive is not None:
+        keepaliveInterval = keepalive
+    if stall is not None:
+        stallTimeout = stall
+    if linkdead is not None:
+        linkdeadTimeout = linkdead
+
+
+def keepalive(sock):
+    """Has the kernel probe an idle socket, so a peer that vanished without
+       closing (a dropped network, a sleeping laptop) is noticed."""
+    if keepaliveInterval <= 0:
+        return
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        if hasattr(socket, 'TCP_KEEPIDLE'):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, max(1, int(keepaliveInterval)))
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, max(1, int(keepaliveInterval / 4)))
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, 4)
+    except socket.error:
+        pass
+
+
+class Reaper(object):
+    """Tracks a server's connections and closes the ones that have had
+       their time."""
+
+    def __init__(self, world):
+        self.world = world
+        self.lock = threading.Lock()
+        self.connections = set()
+        # player -> when their connection was first seen dead
+        self.dead = {}
+        self.thread = None
+
+    def track(self, connection):
+        with self.lock:
+            self.connections.add(connection)
+
+    def untrack(self, connection):
+        with self.lock:
+            self.connections.discard(connection)
+
+    def start(self):
+        """Sweeps from a thread of its own, for the threaded core."""
+        self.thread = threading.Thread(target=self.sweepForever, name="Reaper")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def sweepForever(self):
+        while True:
+            time.sleep(checkInterval)
+            try:
+                self.sweep()
+            except:
+                exc_type, exc_value, exc_traceback = sys.exc_info()
+                traceback.print_exception(exc_type, exc_value, exc_traceback, limit=None, file=sys.stdout)
+
+    def sweep(self, now=None):
+        if now is None:
+            now = time.time()
+        with self.lock:
+            connections = list(self.connections)
+        for connection in connections:
+            self.check(connection, now)
+        self.reapLinkdead(now)
+
+    def check(self, connection, now):
+        if connection.entity is not None and not connection.running:
+            # already on its way out
+            self.untrack(connection)
+            return
+
+        if connection.entity is None:
+            if loginTimeout > 0 and now - connection.connected > loginTimeout:
+                print "Server: Closing a connection that never logged in."
+                self.untrack(connection)
+                connection.kill()
+            return
+
+        name = connection.entity.name
+        idle = now - connection.lastRead
+        if idleTimeout > 0 and idle > idleTimeout:
+            print "Server: Closing " + name + "'s connection, idle for " + str(int(idle)) + " seconds."
+            self.untrack(connection)
+            connection.send(colorfy("[SERVER] You've been idle too long, so you're being disconnected.", "bright yellow") + "\n")
+            self.remove(connection.entity, "was idle too long and leaves the session.")
+            connection.kill()
+            return
+
+        if stallTimeout > 0 and connection.output.stalled(now) > stallTimeout:
+            print "Server: Dropping " + name + "'s connection, which stopped taking output."
+            self.untrack(connection)
+            connection.abort()
+            self.remove(connection.entity, "lost their connection and leaves the session.")
+            return
+
+        if keepaliveInterval > 0 and idle > keepaliveInterval and now - connection.lastProbe > keepaliveInterval:
+            connection.lastProbe = now
+            connection.send(telnet.IAC + telnet.NOP)
+
+    def reapLinkdead(self, now):
+        if linkdeadTimeout <= 0:
+            return
+        dead = {}
+        for player in self.world.players:
+            proxy = player.proxy
+            if proxy is None or proxy.running:
+                continue
+            since = self.dead.get(player, now)
+            if now - since <= linkdeadTimeout:
+                dead[player] = since
+                continue
+            self.remove(player, "lost their connection and leaves the session.")
+        self.dead = dead
+
+    def remove(self, player, why):
+        """Takes a player the reaper disconnected out of their room and the
+           world, and tells the room why."""
+        if player not in self.world.players:
+            # already replaced by a newer login
+            return
+        room = player.instance
+        self.world.leave(player)
+        room.broadcast(colorfy("[SERVER] " + player.name + " " + why, "bright yellow"))
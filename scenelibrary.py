@@ -0,0 +1,135 @@
+import os
+import time
+import zlib
+import fcntl
+import urllib
+import marshal
+import threading
+from collections import OrderedDict
+
+"""
+Named scenes a DM can save once and load again in any room.
+
+Each scene is a file holding the zlib-compressed marshal of
+(title, body, objects). An index file maps every scene name to its file,
+object count and save time, so listing and finding a scene never scans the
+directory, however many scenes a campaign collects. Scenes loaded or saved
+recently are kept in memory.
+
+Sharded workers share the directory: saves take a lock on the index, and a
+worker rereads the index whenever the file changes, dropping any scene it
+has cached that was since saved again or removed.
+"""
+
+INDEX = "index"
+SCENE = ".scene"
+
+# how many scenes are kept in memory
+cacheSize = 64
+
+
+class Library(object):
+
+    def __init__(self, directory):
+        self.directory = directory
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.indexPath = os.path.join(directory, INDEX)
+        self.lock = threading.Lock()
+        self.index = {}
+        self.indexStamp = None
+        self.cache = OrderedDict()
+        with self.lock:
+            self.refresh()
+
+    def refresh(self):
+        # lock held; rereads the index if another process has replaced it
+        try:
+            stat = os.stat(self.indexPath)
+        except OSError:
+            return
+        stamp = (stat.st_mtime, stat.st_size, stat.st_ino)
+        if stamp == self.indexStamp:
+            return
+        with open(self.indexPath, 'rb') as f:
+            index = marshal.loads(f.read())
+        # a scene deleted or saved again since it was cached is stale
+        for name in list(self.cache):
+            if index.get(name) != self.index.get(name):
+                del self.cache[name]
+        self.index = index
+        self.indexStamp = stamp
+
+    def remember(self, name, scene):
+        # lock held
+        self.cache.pop(name, None)
+        self.cache[name] = scene
+        while len(self.cache) > cacheSize:
+            self.cache.popitem(last=False)
+
+    def names(self):
+        """Returns (name, object count, save time) for every saved scene,
+           sorted by name."""
+        with self.lock:
+            self.refresh()
+            return sorted((name, entry[1], entry[2]) for name, entry in self.index.items())
+
+    def load(self, name):
+        """Returns (title, body, objects) for a saved scene, or None."""
+        name = name.lower()
+        with self.lock:
+            self.refresh()
+            scene = self.cache.get(name)
+            if scene is not None:
+                self.remember(name, scene)
+                return scene[0], scene[1], dict(scene[2])
+
+            entry = self.index.get(name)
+            if entry is None:
+                return None
+            try:
+                with open(os.path.join(self.directory, entry[0]), 'rb') as f:
+                    scene = marshal.loads(zlib.decompress(f.read()))
+            except (IOError, OSError, ValueError, EOFError, zlib.error):
+                return None
+            self.remember(name, scene)
+            return scene[0], scene[1], dict(scene[2])
+
+    def save(self, name, title, body, objects):
+        """Saves a scene under a name, replacing any scene already there."""
+        name = name.lower()
+        scene = (title, body, dict(objects))
+        filename = urllib.quote(name, safe='') + SCENE
+        path = os.path.join(self.directory, filename)
+
+        with self.lock:
+            with open(self.indexPath + ".lock", 'wb') as lockFile:
+                fcntl.flock(lockFile, fcntl.LOCK_EX)
+                self.write(path, zlib.compress(marshal.dumps(scene)))
+
+                self.refresh()
+                index = dict(self.index)
+                index[name] = (filename, len(objects), time.time())
+                self.write(self.indexPath, marshal.dumps(index))
+                self.index = index
+                self.indexStamp = None
+            self.remember(name, scene)
+
+    def write(self, path, data):
+        # the old file stays whole until the new one is renamed over it
+        temporary = path + ".tmp"
+        with open(temporary, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(temporary, path)
+
+    def preload(self, count=None):
+        """Reads the most recently saved scenes into memory."""
+        if count is None:
+            count = cacheSize
+        with self.lock:
+            self.refresh()
+            recent = sorted(self.index.items(), key=lambda item: item[1][2], reverse=True)[:count]
+        for name, entry in reversed(recent):
+            self.load(name)
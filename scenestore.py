@@ -0,0 +1,313 @@
+import os
+import sys
+import time
+import zlib
+import struct
+import urllib
+import marshal
+import threading
+import traceback
+from collections import deque
+
+"""
+Durable storage for what DMs paint into each room.
+
+Every change to a room's scene is appended to that room's log as a record:
+
+    (seq, 'title', text)
+    (seq, 'body', text)
+    (seq, 'object', tag, description)
+    (seq, 'erase', tag)
+    (seq, 'wipeScene',)
+    (seq, 'wipeObjects',)
+    (seq, 'load', title, body, objects)    the whole scene at once
+
+Records are framed with their length and a CRC32, so a record torn by a
+crash is recognised and dropped on recovery. Once a log grows long, or has
+been around a while, the room is compacted: the whole scene is written to a
+snapshot (to a temporary file that is then renamed into place) and the log
+starts over. Recovery loads the snapshot and replays whatever log records
+are newer than it.
+
+All writing happens on one background thread, which takes whatever has
+piled up, appends it, and fsyncs each touched log once per batch. Recording
+a change never waits on the disk.
+"""
+
+HEADER = struct.Struct(">II")
+LOG = ".log"
+SNAPSHOT = ".snapshot"
+
+# compact a room after this many logged changes, or after this many seconds
+# with anything in its log
+compactEvery = 500
+snapshotInterval = 300.0
+
+
+def frame(record):
+    data = marshal.dumps(record)
+    return HEADER.pack(len(data), zlib.crc32(data) & 0xffffffff) + data
+
+
+def readFrames(path):
+    """Returns (records, length) for the intact records at the start of a
+       file; length is where the first damaged or partial record begins."""
+    if not os.path.exists(path):
+        return [], 0
+    with open(path, 'rb') as f:
+        return unframe(f.read())
+
+
+def unframe(data):
+    """Like readFrames, for records already read into a string."""
+    records = []
+    offset = 0
+    while offset + HEADER.size <= len(data):
+        length, crc = HEADER.unpack_from(data, offset)
+        end = offset + HEADER.size + length
+        if end > len(data):
+            break
+        chunk = data[offset + HEADER.size:end]
+        if zlib.crc32(chunk) & 0xffffffff != crc:
+            break
+        try:
+            records.append(marshal.loads(chunk))
+        except (ValueError, EOFError, TypeError):
+            break
+        offset = end
+    return records, offset
+
+
+class SceneState(object):
+    """A room's scene as plain data."""
+
+    def __init__(self, title="", body="", objects=None):
+        self.title = title
+        self.body = body
+        if objects is None:
+            objects = {}
+        self.objects = objects
+
+    def apply(self, op):
+        kind = op[0]
+        if kind == 'title':
+            self.title = op[1]
+        elif kind == 'body':
+            self.body = op[1]
+        elif kind == 'object':
+            self.objects[op[1]] = op[2]
+        elif kind == 'erase':
+            self.objects.pop(op[1], None)
+        elif kind == 'wipeScene':
+            self.title = ""
+            self.body = ""
+        elif kind == 'wipeObjects':
+            self.objects = {}
+        elif kind == 'load':
+            self.title, self.body, self.objects = op[1], op[2], dict(op[3])
+
+
+class SceneStore(object):
+    """The durable copy of one room's scene. The room calls record() as it
+       changes; everything else happens on the archive's writer thread,
+       which keeps its own copy of the scene for writing snapshots.
+
+       A store is read from disk once, when the archive first opens it. It
+       also keeps the scene as recorded so far, written out or not, which
+       is what a room closed and opened again starts from."""
+
+    def __init__(self, archive, name):
+        self.archive = archive
+        self.name = name
+        base = os.path.join(archive.directory, urllib.quote(name, safe=''))
+        self.logPath = base + LOG
+        self.snapshotPath = base + SNAPSHOT
+        self.state = SceneState()
+        self.seq = 0
+        self.logged = 0
+        self.log = None
+        self.lastSnapshot = time.time()
+        # the scene with every recorded change applied; archive lock
+        self.current = None
+
+    def load(self):
+        # archive lock held, before the writer knows of the store;
+        # recovers the scene from disk
+        snapshots, length = readFrames(self.snapshotPath)
+        if snapshots:
+            seq, title, body, objects = snapshots[0]
+            self.state = SceneState(title, body, objects)
+            self.seq = seq
+
+        records, length = readFrames(self.logPath)
+        for record in records:
+            if record[0] > self.seq:
+                self.state.apply(record[1:])
+                self.seq = record[0]
+                self.logged += 1
+        if os.path.exists(self.logPath) and length < os.path.getsize(self.logPath):
+            # drop the torn tail so new records follow intact ones
+            with open(self.logPath, 'r+b') as f:
+                f.truncate(length)
+
+        self.current = SceneState(self.state.title, self.state.body, dict(self.state.objects))
+
+    def scene(self):
+        """The scene with every change recorded so far, as a SceneState."""
+        with self.archive.lock:
+            return SceneState(self.current.title, self.current.body, dict(self.current.objects))
+
+    def record(self, *op):
+        """Queues a change for the writer. Never blocks on the disk."""
+        self.archive.put(self, op)
+
+    def append(self, ops):
+        # writer thread only
+        if self.log is None:
+            self.log = open(self.logPath, 'ab')
+        chunks = []
+        for op in ops:
+            self.seq += 1
+            self.state.apply(op)
+            chunks.append(frame((self.seq,) + op))
+        self.log.write("".join(chunks))
+        self.log.flush()
+        os.fsync(self.log.fileno())
+        self.logged += len(ops)
+
+    def due(self, now):
+        if self.logged == 0:
+            return False
+        return self.logged >= compactEvery or now - self.lastSnapshot >= snapshotInterval
+
+    def compact(self):
+        # writer thread only
+        temporary = self.snapshotPath + ".tmp"
+        with open(temporary, 'wb') as f:
+            f.write(frame((self.seq, self.state.title, self.state.body, self.state.objects)))
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(temporary, self.snapshotPath)
+        self.archive.syncDirectory()
+
+        # a crash before this point just replays records the snapshot has
+        if self.log is not None:
+            self.log.close()
+        self.log = open(self.logPath, 'wb')
+        self.logged = 0
+        self.lastSnapshot = time.time()
+
+    def close(self):
+        if self.log is not None:
+            self.log.close()
+            self.log = None
+
+
+class Archive(object):
+    """A directory of room stores and the thread that writes them."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.stores = {}
+        self.lock = threading.Lock()
+        self.ready = threading.Condition(self.lock)
+        self.pending = deque()
+        self.closing = False
+        self.writer = threading.Thread(target=self.writeForever, name="SceneWriter")
+        self.writer.daemon = True
+        self.writer.start()
+
+    def names(self):
+        """Names of every room with a stored scene."""
+        names = set()
+        for filename in os.listdir(self.directory):
+            for extension in (LOG, SNAPSHOT):
+                if filename.endswith(extension):
+                    names.add(urllib.unquote(filename[:-len(extension)]))
+        return sorted(names)
+
+    def has(self, name):
+        """Whether a room has a stored scene, or one recorded and not yet
+           written."""
+        with self.lock:
+            store = self.stores.get(name)
+            if store is not None and (store.current.title or store.current.body or store.current.objects):
+                return True
+        base = os.path.join(self.directory, urllib.quote(name, safe=''))
+        return os.path.exists(base + LOG) or os.path.exists(base + SNAPSHOT)
+
+    def open(self, name):
+        """Returns a room's store, reading it from disk the first time."""
+        with self.lock:
+            if name not in self.stores:
+                store = SceneStore(self, name)
+                store.load()
+                self.stores[name] = store
+            return self.stores[name]
+
+    def put(self, store, op):
+        with self.lock:
+            if self.closing:
+                return
+            store.current.apply(op)
+            self.pending.append((store, op))
+            self.ready.notify()
+
+    def syncDirectory(self):
+        try:
+            fd = os.open(self.directory, os.O_RDONLY)
+        except OSError:
+            return
+        try:
+            os.fsync(fd)
+        except OSError:
+            pass
+        finally:
+            os.close(fd)
+
+    def writeForever(self):
+        while True:
+            with self.lock:
+                if not self.pending and not self.closing:
+                    self.ready.wait(snapshotInterval / 10)
+                batch = self.pending
+                self.pending = deque()
+                closing = self.closing
+                stores = self.stores.values()
+
+            try:
+                self.write(batch, stores)
+            except:
+                exc_type, exc_value, exc_traceback = sys.exc_info()
+                traceback.print_exception(exc_type, exc_value, exc_traceback, limit=None, file=sys.stdout)
+
+            if closing and not batch:
+                break
+
+        for store in stores:
+            store.close()
+
+    def write(self, batch, stores):
+        byStore = {}
+        order = []
+        for store, op in batch:
+            if store not in byStore:
+                byStore[store] = []
+                order.append(store)
+            byStore[store].append(op)
+        for store in order:
+            store.append(byStore[store])
+
+        now = time.time()
+        for store in stores:
+            if store.due(now):
+                store.compact()
+
+    def close(self):
+        """Writes out everything recorded so far and stops the writer."""
+        with self.lock:
+            self.closing = True
+            self.ready.notify()
+        self.writer.join()
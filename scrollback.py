@@ -0,0 +1,63 @@
+import threading
+from collections import deque
+
+"""
+The last stretch of output each player was sent, so a player who comes back
+(reconnecting, or taking the place of a connection left hanging) can be
+shown what they missed.
+
+A player's scrollback is a ring of the payloads they were sent, dropped
+oldest first once they add up to more than the limit. Broadcasts hand every
+player the same payload, so scrollbacks mostly hold references to shared
+strings; the limit still counts them in full, which keeps it a hard bound
+on what a player can pin in memory, however long they sit idle.
+"""
+
+# Default byte limit for new scrollbacks, set from the command line in
+# server.main. 0 keeps no scrollback at all.
+defaultLimit = 16 * 1024
+
+
+def configure(limit=None):
+    global defaultLimit
+    if limit is not None:
+        if limit < 0:
+            raise ValueError("Scrollback limit can't be negative: %r" % limit)
+        defaultLimit = limit
+
+
+class Scrollback(object):
+    """Bounded ring of the payloads most recently sent to one player.
+       Any thread may add; a room's dispatcher and a pm from another room
+       can send to the same player at once."""
+
+    def __init__(self, limit=None):
+        if limit is None:
+            limit = defaultLimit
+        self.limit = limit
+        self.lock = threading.Lock()
+        self.payloads = deque()
+        self.size = 0
+
+    def add(self, payload):
+        if self.limit == 0:
+            return
+        if len(payload) > self.limit:
+            # only the end of it fits; start on a line of its own
+            payload = payload[-self.limit:]
+            newline = payload.find("\n")
+            if newline != -1 and newline + 1 < len(payload):
+                payload = payload[newline + 1:]
+        with self.lock:
+            self.payloads.append(payload)
+            self.size += len(payload)
+            while self.size > self.limit:
+                self.size -= len(self.payloads.popleft())
+
+    def contents(self):
+        """Everything held, oldest first, as one string."""
+        with self.lock:
+            return "".join(self.payloads)
+
+    def __len__(self):
+        return self.size
@@ -1,21 +1,40 @@
+import os
 import sys
+import time
 import traceback
 import socket
+import argparse
 import commandparser
+import functionmapper
 import threading
 import entity
 import session
-
-from colorer import colorfy
+import login
+import telnet
+import eventloop
+import outbuffer
+import scrollback
+import ratelimit
+import reaper
+import metrics
+import scenestore
+import scenelibrary
+import transcript
+import shard
 
 
 class LoginProxy(threading.Thread):
 
-    def __init__(self, socket, instance):
+    def __init__(self, socket, world, reaper):
         threading.Thread.__init__(self)
         self.socket = socket
         self.running = False
-        self.instance = instance
+        self.world = world
+        self.reaper = reaper
+        self.entity = None
+        self.connected = time.time()
+        self.decoder = telnet.LineDecoder()
+        self.lines = []
 
     def setEntity(self, entity):
         self.entity = entity
@@ -28,79 +47,48 @@ class LoginProxy(threading.Thread):
         except:
             pass
 
-    def killClone(self, username):
-        for user in self.instance.connections:
-            if not isinstance(user, entity.Entity):
-                continue
-            if username == user.name and user.proxy.running:
-                user.proxy.kill()
-                self.instance.connections.remove(user)
-                return
-        return
-
-    def checkIfOnline(self, username):
-        for user in self.instance.connections:
-            if not isinstance(user, entity.Entity):
-                continue
-            if username == user.name and user.proxy.running:
-                return True
-        return False
+    def readLine(self):
+        """Returns the next line from the client, or None once it hangs up."""
+        while not self.lines:
+            data = self.socket.recv(4096)
+            if not data:
+                return None
+            self.lines = self.decoder.feed(data)
+        return self.lines.pop(0)
 
     def run(self):
+        try:
+            self.login()
+        finally:
+            self.reaper.untrack(self)
+
+    def login(self):
         try:
             self.running = True
-            username = ""
-            self.socket.send("-- Welcome to Mushy --\n")
-            while len(username) < 1 or len(username.split()) != 1:
-                self.socket.send("What will you use for a name?\n")
-                username = self.socket.recv(4096).strip()
-                self.socket.send("\n")
-                # validate username
-                if len(username) < 1:
-                    self.socket.send("Choose a REAL name!\n")
-                if len(username.split()) > 1:
-                    self.socket.send("Only use your first name!\n")
-
-            username = username[0].upper() + username[1:]
-            online = self.checkIfOnline(username)
-            if online:
-                done = False
-                while not done:
-                    self.socket.send("Another instance of you is already connected. Do you want to take its place? (y/n)\n")
-                    choice = self.socket.recv(4096).strip()
-
-                    if choice.lower() == 'y':
-                        self.killClone(username)
-                        done = True
-                        online = False
-                    elif choice.lower() == 'n':
-                        self.kill()
-                        done = True
-
-            if not online:
-                self.socket.send("Are you the DM for the group (y if yes)? ")
-                choice = self.socket.recv(4096).strip()
-
-                dm = False
-                if choice.lower() == 'y':
-                    dm = True
-
-                proxy = entity.ClientProxy(self.socket)
-                player = entity.Entity(proxy, username, self.instance)
-
-                if dm:
-                    player.dm = True
-
-                self.instance.connections.append(player)
-                player.proxy.start()
-
-                for e in self.instance.connections:
-                    if e == player:
-                        player.sendMessage(colorfy("[SERVER] You have joined the session.", "bright yellow"))
-                    else:
-                        e.sendMessage(colorfy("[SERVER] " + player.name + " has joined the session.", "bright yellow"))
-
-                player.sendMessage(colorfy("[SERVER] You may type 'help' at any time for a list of commands.", 'bright green'))
+            dialog = login.LoginSession(self.world)
+            self.socket.send(dialog.start())
+            while not dialog.finished:
+                line = self.readLine()
+                if line is None:
+                    self.kill()
+                    print "Server: Client connection closed during login."
+                    return
+                reply = dialog.feed(line)
+                if reply:
+                    self.socket.send(reply)
+
+            if dialog.rejected:
+                self.kill()
+                return
+
+            # anything typed ahead of the login prompts carries over
+            proxy = entity.ClientProxy(self.socket, self.decoder, self.lines, self.reaper)
+            self.reaper.track(proxy)
+            player = entity.Entity(proxy, dialog.username, self.world.lobby)
+            player.dm = dialog.dm
+
+            login.enterSession(self.world, player, clone=dialog.clone)
+            player.proxy.start()
         except:
             exc_type, exc_value, exc_traceback = sys.exc_info()
             traceback.print_exception(exc_type, exc_value, exc_traceback, limit=None, file=sys.stdout)
@@ -109,39 +97,166 @@ class LoginProxy(threading.Thread):
             print "Server: Client connection closed. Exception during login."
 
 
-def main():
-    connections = []
-    instance = session.Instance(connections)
-
-    server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    server_socket.bind(('', 8080))
-    server_socket.listen(0)
-    print "Server: Listening on port 8080, press control+C to exit."
-
-    commandparser.startDispatching()
-    print "Server: Done."
-
-    done = False
-    while not done:
+def serveThreaded(server_socket, world):
+    """One LoginProxy thread per accepted socket, which hands off to one
+       ClientProxy thread per player, and a reaper thread watching them."""
+    lifecycle = reaper.Reaper(world)
+    lifecycle.start()
+    while True:
         try:
             client_socket, address = server_socket.accept()
             print "Server: Accepting connection from " + address[0] + "..."
+            reaper.keepalive(client_socket)
             # spawn up a client proxy here
-            proxy = LoginProxy(client_socket, instance)
+            proxy = LoginProxy(client_socket, world, lifecycle)
+            lifecycle.track(proxy)
             proxy.start()
         except KeyboardInterrupt:
-            print ""
-            print "Server: Closing server socket and dispatcher..."
-            server_socket.close()
-            commandparser.stopDispatching()
-            print "Server: Closing client connections..."
-            for connection in instance.connections:
-                connection.proxy.kill()
-            done = True
+            raise
         except:
             exc_type, exc_value, exc_traceback = sys.exc_info()
             traceback.print_exception(exc_type, exc_value, exc_traceback, limit=None, file=sys.stdout)
+
+
+def serveEventLoop(server_socket, world):
+    """Every socket is served from this one thread."""
+    loop = eventloop.EventLoop(server_socket, world)
+    try:
+        loop.run()
+    finally:
+        loop.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Mushy server.")
+    parser.add_argument('--port', type=int, default=8080,
+                        help="the port to listen on")
+    parser.add_argument('--core', choices=('threaded', 'eventloop'), default='threaded',
+                        help="networking core: a thread per connection, or a single event loop thread")
+    parser.add_argument('--workers', type=int, default=0, metavar='N',
+                        help="run N worker processes, each owning a share of the rooms (0 runs everything in one process)")
+    parser.add_argument('--output-limit', type=int, default=outbuffer.defaultLimit, metavar='BYTES',
+                        help="how far a client may fall behind on output before the policy kicks in")
+    parser.add_argument('--output-policy', choices=outbuffer.POLICIES, default=outbuffer.defaultPolicy,
+                        help="what to do with a client that falls behind")
+    parser.add_argument('--max-rooms', type=int, default=session.maxRooms, metavar='N',
+                        help="most rooms open at once, lobby included; only DMs open new ones")
+    parser.add_argument('--input-rate', type=ratelimit.parseLimit, metavar='RATE[/BURST]',
+                        help="lines per second a client may send; past that it isn't read from until it slows down "
+                             "(default %g/%d, 0 for no limit)" % (ratelimit.inputRate, ratelimit.inputBurst))
+    parser.add_argument('--command-rate', action='append', default=[], metavar='CLASS=RATE[/BURST]',
+                        help="commands per second each player may use from a class: " +
+                             ", ".join(sorted(ratelimit.classLimits)) + " (may be repeated, 0 for no limit)")
+    parser.add_argument('--fanout-rate', type=ratelimit.parseLimit, metavar='RATE[/BURST]',
+                        help="bytes per second a room may broadcast, counted once per listener "
+                             "(default %d/%d, 0 for no limit)" % (ratelimit.fanoutRate, ratelimit.fanoutBurst))
+    parser.add_argument('--login-timeout', type=float, default=reaper.loginTimeout, metavar='SECONDS',
+                        help="close connections that haven't logged in by then (0 never does)")
+    parser.add_argument('--idle-timeout', type=float, default=reaper.idleTimeout, metavar='SECONDS',
+                        help="disconnect players who send nothing for this long (0 never does)")
+    parser.add_argument('--keepalive', type=float, default=reaper.keepaliveInterval, metavar='SECONDS',
+                        help="probe connections quiet for this long, with TCP keepalives and a telnet NOP (0 turns probing off)")
+    parser.add_argument('--stall-timeout', type=float, default=reaper.stallTimeout, metavar='SECONDS',
+                        help="drop clients that take none of their waiting output for this long (0 never does)")
+    parser.add_argument('--linkdead-timeout', type=float, default=reaper.linkdeadTimeout, metavar='SECONDS',
+                        help="how long players whose connection dropped stay in their room (0 keeps them until they're replaced)")
+    parser.add_argument('--scrollback', type=int, default=scrollback.defaultLimit, metavar='BYTES',
+                        help="how much recent output to keep for each player, replayed when they reconnect (0 keeps none)")
+    parser.add_argument('--data-dir', default='data', metavar='DIR',
+                        help="where room scenes, the scene library, dice logs and transcripts are kept (an empty string keeps them in memory only)")
+    parser.add_argument('--metrics', action='store_true',
+                        help="time every command and count what each client is sent (see the stats command)")
+    parser.add_argument('--metrics-file', metavar='PATH',
+                        help="append a JSON snapshot of the metrics to PATH every --metrics-interval seconds")
+    parser.add_argument('--metrics-interval', type=float, default=60.0, metavar='SECONDS')
+    options = parser.parse_args()
+    if options.max_rooms < 1:
+        parser.error("--max-rooms must be at least 1")
+    session.maxRooms = options.max_rooms
+    outbuffer.configure(options.output_limit, options.output_policy)
+    scrollback.configure(options.scrollback)
+    classes = {}
+    for setting in options.command_rate:
+        name, _, limit = setting.partition("=")
+        if name not in ratelimit.classLimits or not limit:
+            parser.error("--command-rate takes CLASS=RATE[/BURST], with CLASS one of " + ", ".join(sorted(ratelimit.classLimits)))
+        try:
+            classes[name] = ratelimit.parseLimit(limit)
+        except ValueError:
+            parser.error("bad limit in --command-rate " + setting)
+    ratelimit.configure(options.input_rate, classes, options.fanout_rate)
+    reaper.configure(options.login_timeout, options.idle_timeout, options.keepalive,
+                     options.stall_timeout, options.linkdead_timeout)
+    metrics.configure(options.metrics, options.metrics_file, options.metrics_interval)
+
+    if options.workers > 0:
+        mainSharded(options)
+        return
+
+    archive = None
+    library = None
+    diceDir = None
+    recorder = None
+    if options.data_dir:
+        archive = scenestore.Archive(options.data_dir)
+        library = scenelibrary.Library(os.path.join(options.data_dir, "library"))
+        library.preload()
+        diceDir = os.path.join(options.data_dir, "dice")
+        recorder = transcript.Recorder(os.path.join(options.data_dir, "transcripts"))
+    world = session.World(archive=archive, library=library, diceDir=diceDir, recorder=recorder)
+
+    server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server_socket.bind(('', options.port))
+    server_socket.listen(socket.SOMAXCONN)
+    print "Server: Listening on port " + str(options.port) + " (" + options.core + " core), press control+C to exit."
+
+    # help is rendered before anyone asks for it
+    functionmapper.helpIndex.refresh()
+    commandparser.startDispatching()
+    metrics.startDumping()
+    print "Server: Done."
+
+    try:
+        if options.core == 'eventloop':
+            serveEventLoop(server_socket, world)
+        else:
+            serveThreaded(server_socket, world)
+    except KeyboardInterrupt:
+        print ""
+        print "Server: Closing server socket and dispatcher..."
+        server_socket.close()
+        commandparser.stopDispatching()
+        print "Server: Closing client connections..."
+        for connection in world.players:
+            connection.proxy.kill()
+    if archive is not None:
+        print "Server: Writing out scenes..."
+        archive.close()
+    if recorder is not None:
+        print "Server: Writing out transcripts..."
+        recorder.close()
+    print "Server: Bye!"
+
+
+def mainSharded(options):
+    # fork before the listening socket exists so the workers don't hold it
+    processes, buses = shard.startWorkers(options.workers, options.data_dir)
+
+    server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server_socket.bind(('', options.port))
+    server_socket.listen(socket.SOMAXCONN)
+    print "Server: Listening on port " + str(options.port) + " (" + str(options.workers) + " workers), press control+C to exit."
+
+    try:
+        shard.serveSharded(server_socket, buses)
+    except KeyboardInterrupt:
+        print ""
+        print "Server: Closing server socket and stopping workers..."
+        server_socket.close()
+    for process in processes:
+        process.join()
     print "Server: Bye!"
 
 
@@ -1,41 +1,246 @@
+import time
+import threading
+import commandparser
+import dicelog
+import metrics
+import ratelimit
+from collections import OrderedDict
+from colorer import colorfy
+
+LOBBY = "lobby"
+# Most rooms a world keeps open at once, lobby included; set from the
+# command line in server.main.
+maxRooms = 64
+
+
+def encode(message):
+    """Turns a message into the bytes that go on the wire."""
+    if isinstance(message, unicode):
+        message = message.encode('utf-8')
+    return message + "\n"
+
+
+class Registry(object):
+    """The players connected to a session, keyed by lowercased name and kept
+       in the order they joined.
+
+       Changes take a lock and publish a fresh tuple of the members, so
+       iterating (every broadcast does) never takes the lock and never sees
+       the registry change underneath it."""
+
+    def __init__(self, entities=()):
+        self.lock = threading.Lock()
+        self.byName = OrderedDict()
+        for e in entities:
+            self.byName[e.name.lower()] = e
+        self.members = tuple(self.byName.values())
+
+    def add(self, entity):
+        """Registers an entity, replacing anyone already registered under
+           the same name. Returns the entity that was replaced, if any."""
+        with self.lock:
+            key = entity.name.lower()
+            previous = self.byName.get(key)
+            self.byName[key] = entity
+            self.members = tuple(self.byName.values())
+        if previous is entity:
+            return None
+        return previous
+
+    def remove(self, entity):
+        """Unregisters an entity. Returns False if it wasn't registered,
+           which includes having been replaced by a newer login."""
+        with self.lock:
+            key = entity.name.lower()
+            if self.byName.get(key) is not entity:
+                return False
+            del self.byName[key]
+            self.members = tuple(self.byName.values())
+        return True
+
+    def rename(self, entity, name):
+        """Changes an entity's name. Returns False if the name is taken."""
+        with self.lock:
+            key = name.lower()
+            old = entity.name.lower()
+            if key != old and key in self.byName:
+                return False
+            if self.byName.get(old) is entity:
+                del self.byName[old]
+            entity.name = name
+            self.byName[key] = entity
+            self.members = tuple(self.byName.values())
+        return True
+
+    def find(self, name):
+        return self.byName.get(name.lower())
+
+    def __iter__(self):
+        return iter(self.members)
+
+    def __len__(self):
+        return len(self.members)
+
+    def __contains__(self, entity):
+        return self.byName.get(entity.name.lower()) is entity
+
+
 class Instance(object):
+    """One room: its own players, scene, objects and command dispatcher."""
 
-    def __init__(self, connections):
-        self.connections = connections
+    def __init__(self, connections=(), name=LOBBY, world=None, store=None, diceDir=None, transcript=None, dice=None):
+        self.name = name
+        self.world = world
+        self.dispatcher = commandparser.Dispatcher("Dispatcher-" + name)
+        # the room's own random stream, and the audit log of its rolls
+        if dice is None:
+            dice = dicelog.DiceLog(name, diceDir)
+        self.dice = dice
+        self.connections = Registry(connections)
         self.objects = {}
         self.scene_title = ""
         self.scene_body = ""
+        # the room's scenestore.SceneStore, if scenes outlive the server
+        self.store = store
+        if store is not None:
+            state = store.scene()
+            self.scene_title = state.title
+            self.scene_body = state.body
+            self.objects = state.objects
+        # the room's transcript.Transcript, if what it sees is recorded
+        self.transcript = transcript
+        # bytes the room may broadcast, counted once per listener
+        self.fanout = ratelimit.fanoutBucket()
+
+        # rendered scene and object payloads, dropped by the mutators below
+        self.sceneVersion = 0
+        self.sceneCache = (None, None)
+        self.objectCache = {}
+        self.cacheHits = 0
+        self.cacheMisses = 0
+
+    def close(self):
+        """Stops the room's dispatcher once it has run what's queued. The
+           scene store, transcript and dice log stay with the archive,
+           recorder and world, which hand them back if the room is opened
+           again."""
+        self.dispatcher.close(self.dice.close)
+
+    def addConnection(self, entity):
+        """Adds a player to the session. Returns whoever it replaced."""
+        return self.connections.add(entity)
+
+    def removeConnection(self, entity):
+        return self.connections.remove(entity)
+
+    def renameConnection(self, entity, name):
+        return self.connections.rename(entity, name)
+
+    def findConnection(self, name):
+        """Looks up a connected player by name, ignoring case."""
+        return self.connections.find(name)
+
+    def broadcast(self, message, actor=None, actorMessage=None, skipActor=False):
+        """Sends a message to everyone in the session. The message is
+           encoded once and the same bytes go to every connection.
+
+           actor - whoever caused the message
+           actorMessage - what the actor sees instead, if it differs
+           skipActor - leave the actor out altogether"""
+        if self.transcript is not None:
+            self.transcript.record(actor.name if actor is not None else None, message)
+
+        payload = encode(message)
+        actorPayload = payload
+        if actorMessage is not None:
+            actorPayload = encode(actorMessage)
+
+        if self.fanout is not None:
+            wait = self.fanout.charge(len(payload) * len(self.connections))
+            if wait > 0:
+                self.throttle(wait)
+
+        for e in self.connections:
+            if e is actor and actor is not None:
+                if not skipActor:
+                    e.sendPayload(actorPayload)
+            else:
+                e.sendPayload(payload)
+
+    def throttle(self, wait):
+        # only the room's own dispatcher waits, which holds up this room and
+        # no other; broadcasts from elsewhere (logins, the event loop) just
+        # leave the debt for the next one
+        if self.dispatcher.thread is not threading.current_thread():
+            return
+        wait = min(wait, ratelimit.maxFanoutWait)
+        if metrics.enabled:
+            metrics.throttled("fan-out", wait)
+        time.sleep(wait)
 
     def paintSceneTitle(self, title):
         self.scene_title = title
+        self.invalidateScene()
+        if self.store is not None:
+            self.store.record('title', title)
 
     def paintSceneBody(self, body):
         self.scene_body = body
+        self.invalidateScene()
+        if self.store is not None:
+            self.store.record('body', body)
 
     def viewScene(self):
-        ret = ""
-        if self.scene_title == "" and self.scene_body == "":
-            ret = ""
-
-        if self.scene_title != "" and self.scene_body != "":
-            ret = ret + self.scene_title + "\n" + self.scene_body
+        scene = "\n".join(part for part in (self.scene_title, self.scene_body) if part != "")
+        if len(self.objects) == 0:
+            return scene
+        items = "".join("    " + item + "\n" for item in self.objects)
+        return scene + "\nYou see a few items of interest:\n" + items
 
-        elif self.scene_title == "":
-            ret = ret + self.scene_body
+    def scenePayload(self):
+        """Returns the scene as it goes on the wire, or None if it is blank.
+           Rendered once and reused until the scene or its objects change."""
+        version, payload = self.sceneCache
+        if version == self.sceneVersion:
+            self.cacheHits += 1
+            return payload
+        self.cacheMisses += 1
+        version = self.sceneVersion
+        scene = self.viewScene()
+        payload = None
+        if scene != "":
+            payload = encode(scene)
+        self.sceneCache = (version, payload)
+        return payload
 
-        elif self.scene_body == "":
-            ret = ret + self.scene_title
+    def objectPayload(self, identifier):
+        """Returns an object's description as it goes on the wire, or None
+           if there is no such object."""
+        key = identifier.lower()
+        payload = self.objectCache.get(key)
+        if payload is not None:
+            self.cacheHits += 1
+            return payload
+        self.cacheMisses += 1
+        description = self.objects.get(key)
+        if description is None:
+            return None
+        payload = encode(description)
+        self.objectCache[key] = payload
+        return payload
 
-        if len(self.objects) == 0:
-            return ret
+    def cacheStats(self):
+        return {'hits': self.cacheHits, 'misses': self.cacheMisses}
 
-        ret = ret + "\nYou see a few items of interest:\n"
-        for item in self.objects:
-            ret = ret + "    " + item + "\n"
-        return ret
+    def invalidateScene(self):
+        self.sceneVersion += 1
 
     def paintObject(self, identifier, description):
         self.objects[identifier.lower()] = description
+        self.objectCache.pop(identifier.lower(), None)
+        self.invalidateScene()
+        if self.store is not None:
+            self.store.record('object', identifier.lower(), description)
 
     def viewObject(self, identifier):
         if identifier.lower() in self.objects:
@@ -45,10 +250,167 @@ class Instance(object):
     def eraseObject(self, identifier):
         if identifier.lower() in self.objects:
             del self.objects[identifier.lower()]
+            self.objectCache.pop(identifier.lower(), None)
+            self.invalidateScene()
+            if self.store is not None:
+                self.store.record('erase', identifier.lower())
 
     def wipeScene(self):
         self.scene_title = ""
         self.scene_body = ""
+        self.invalidateScene()
+        if self.store is not None:
+            self.store.record('wipeScene')
 
     def wipeObjects(self):
         self.objects.clear()
+        self.objectCache.clear()
+        self.invalidateScene()
+        if self.store is not None:
+            self.store.record('wipeObjects')
+
+    def loadScene(self, title, body, objects):
+        """Replaces the scene and every object in one go."""
+        self.scene_title = title
+        self.scene_body = body
+        self.objects = objects
+        self.objectCache = {}
+        self.invalidateScene()
+        if self.store is not None:
+            self.store.record('load', title, body, dict(objects))
+
+
+class World(object):
+    """Every room on the server, and everyone connected to any of them.
+
+       Names are unique across the whole server, so the world keeps its own
+       registry of players next to each room's. Players start out in the
+       lobby. Rooms are opened when someone joins them, at most maxRooms at
+       once, and closed again when the last player leaves; the lobby stays.
+
+       Given a scenestore.Archive, every room keeps its scene on disk, and a
+       room stored there is reopened with its scene. A
+       scenelibrary.Library holds the named scenes DMs save and load, each
+       room's rolls are logged under diceDir, and a transcript.Recorder
+       keeps what each room sees."""
+
+    def __init__(self, lobby=LOBBY, archive=None, library=None, diceDir=None, recorder=None):
+        self.lock = threading.Lock()
+        self.rooms = OrderedDict()
+        self.players = Registry()
+        self.archive = archive
+        self.library = library
+        self.diceDir = diceDir
+        # room name -> dicelog.DiceLog, kept when a room closes
+        self.diceLogs = {}
+        self.recorder = recorder
+        self.lobby = self.room(lobby)
+
+    def exists(self, name):
+        """Whether a room is open or stored in the archive."""
+        key = name.lower()
+        if key in self.rooms:
+            return True
+        return self.archive is not None and self.archive.has(key)
+
+    def room(self, name, create=True):
+        """Returns the room with the given name, opening it if need be.
+           Only rooms that exist are opened unless create is set. Returns
+           None if there is no such room, or maxRooms are already open."""
+        key = name.lower()
+        with self.lock:
+            room = self.rooms.get(key)
+            if room is not None:
+                return room
+            if not create and not self.exists(key):
+                return None
+            if len(self.rooms) >= maxRooms:
+                return None
+            return self.open(key)
+
+    def open(self, key):
+        # with the lock held
+        store = None
+        if self.archive is not None:
+            store = self.archive.open(key)
+        transcript = None
+        if self.recorder is not None:
+            transcript = self.recorder.open(key)
+        dice = self.diceLogs.get(key)
+        if dice is None:
+            dice = self.diceLogs[key] = dicelog.DiceLog(key, self.diceDir)
+        room = Instance(name=key, world=self, store=store, transcript=transcript, dice=dice)
+        self.rooms[key] = room
+        return room
+
+    def vacate(self, room):
+        """Closes a room once nobody is left in it, unless it's the lobby."""
+        if room is self.lobby:
+            return
+        with self.lock:
+            if len(room.connections) > 0 or self.rooms.get(room.name) is not room:
+                return
+            del self.rooms[room.name]
+        room.close()
+
+    def place(self, player, room):
+        """Adds a player to a room, reopening it if it was closed since it
+           was looked up. Returns the room they ended up in."""
+        with self.lock:
+            if self.rooms.get(room.name) is not room:
+                room = self.rooms.get(room.name) or self.open(room.name)
+            player.instance = room
+            room.addConnection(player)
+        return room
+
+    def findRoom(self, name):
+        return self.rooms.get(name.lower())
+
+    def listRooms(self):
+        with self.lock:
+            return self.rooms.values()
+
+    def findPlayer(self, name):
+        """Looks up a connected player in any room, ignoring case."""
+        return self.players.find(name)
+
+    def allPlayers(self):
+        return self.players
+
+    def enter(self, player, room=None):
+        """Registers a freshly logged in player and puts them in a room, the
+           lobby by default. Returns whoever was registered under the same
+           name before, already taken out of their room."""
+        if room is None:
+            room = self.lobby
+        previous = self.players.add(player)
+        if previous is not None:
+            previous.instance.removeConnection(previous)
+        room = self.place(player, room)
+        if previous is not None and previous.instance is not room:
+            self.vacate(previous.instance)
+        return previous
+
+    def move(self, player, room):
+        """Moves a player to another room, telling both rooms about it."""
+        old = player.instance
+        old.broadcast(colorfy("[SERVER] " + player.name + " leaves for the " + room.name + ".", "bright yellow"),
+                      actor=player, skipActor=True)
+        old.removeConnection(player)
+        self.arrive(player, room)
+        self.vacate(old)
+
+    def arrive(self, player, room):
+        room = self.place(player, room)
+        room.broadcast(colorfy("[SERVER] " + player.name + " arrives.", "bright yellow"),
+                       actor=player, actorMessage=colorfy("[SERVER] You join the " + room.name + ".", "bright yellow"))
+
+        scene = room.scenePayload()
+        if scene is not None:
+            player.sendPayload(scene)
+
+    def leave(self, player):
+        self.players.remove(player)
+        room = player.instance
+        room.removeConnection(player)
+        self.vacate(room)
@@ -0,0 +1,463 @@
+import os
+import sys
+import zlib
+import socket
+import itertools
+import traceback
+import threading
+import multiprocessing
+from multiprocessing import reduction
+import commandparser
+import functionmapper
+import entity
+import eventloop
+import login
+import metrics
+import session
+import scenestore
+import scenelibrary
+import transcript
+
+import colorer
+from colorer import colorfy
+
+"""
+The sharded server: one front process and N worker processes.
+
+The front accepts sockets and runs the login prompts. Once a player is
+logged in, their socket's file descriptor is passed to the worker that owns
+the room they asked for, and that worker serves them from then on with its
+own event loop and dispatchers. Rooms are assigned to workers by hashing the
+room name.
+
+Each worker talks to the front over a Unix socket pair (the bus). Messages
+are tuples whose first item names them:
+
+    front -> worker
+        adopt   name token dm status color room decoder lines arriving  (+ socket)
+        deliver name payload          bytes for a player on this worker
+        player  name token dm room    a player elsewhere joined or moved
+        gone    name token            a player elsewhere left
+        kill    name token            another login took this name over
+        stop
+
+    worker -> front
+        deliver name payload          bytes for a player on another worker
+        moved   name token room       a player changed rooms on this worker
+        left    name token            a player logged out
+        migrate name token dm status color room decoder lines arriving  (+ socket)
+                                      a player joined a room owned elsewhere, or
+                                      (not arriving) was logging in to a room
+                                      this worker couldn't open
+
+The front keeps the directory of who is where and forwards directory
+changes to the workers, which is how pm and who reach across workers.
+"""
+
+
+def shardFor(room, count):
+    return (zlib.crc32(room.lower()) & 0xffffffff) % count
+
+
+class Bus(object):
+    """One end of the pipe between the front and a worker. Sends may come
+       from any thread; receiving is left to the event loop thread."""
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.lock = threading.Lock()
+
+    def fileno(self):
+        return self.conn.fileno()
+
+    def send(self, *message):
+        with self.lock:
+            self.conn.send(message)
+
+    def sendSocket(self, client_socket, *message):
+        # the message tells the other end a descriptor follows right behind
+        with self.lock:
+            self.conn.send(message)
+            reduction.send_handle(self.conn, client_socket.fileno(), None)
+
+    def receive(self, handler):
+        """Calls handler(message) for every message waiting on the pipe. A
+           handler that gets a message announcing a socket must collect it
+           with receiveSocket() before returning."""
+        while self.conn.poll():
+            try:
+                message = self.conn.recv()
+            except EOFError:
+                handler(('stop',))
+                return
+            handler(message)
+
+    def receiveSocket(self):
+        fd = reduction.recv_handle(self.conn)
+        client_socket = socket.fromfd(fd, socket.AF_INET, socket.SOCK_STREAM)
+        os.close(fd)
+        return client_socket
+
+
+class RemoteRoom(object):
+    """A room owned by another process; only its name and head count are
+       known here."""
+
+    def __init__(self, name, world=None):
+        self.name = name
+        self.world = world
+        self.connections = []
+
+
+class RemotePlayer(object):
+    """A player served by another process. Messages to them go over the
+       bus, and it doubles as its own proxy so login's clone checks work."""
+
+    def __init__(self, name, token, dm, room, bus):
+        self.name = name
+        self.token = token
+        self.dm = dm
+        self.status = ""
+        self.instance = RemoteRoom(room)
+        self.bus = bus
+        self.proxy = self
+        self.running = True
+
+    def kill(self):
+        self.bus.send('kill', self.name, self.token)
+
+    def sendMessage(self, message):
+        self.sendPayload(session.encode(message))
+
+    def sendPayload(self, payload):
+        self.bus.send('deliver', self.name, payload)
+
+
+class Directory(object):
+    """The front's view of every logged in player. It stands in for the
+       world during login."""
+
+    def __init__(self, buses):
+        self.buses = buses
+        self.players = session.Registry()
+        self.lobby = None
+
+    def findPlayer(self, name):
+        return self.players.find(name)
+
+    def add(self, player, shard):
+        previous = self.players.add(player)
+        self.announce(shard, 'player', player.name, player.token, player.dm, player.instance.name)
+        return previous
+
+    def leave(self, player):
+        if self.players.remove(player):
+            self.announce(None, 'gone', player.name, player.token)
+
+    def announce(self, owner, *message):
+        """Tells every worker except the owner about a directory change."""
+        for index, bus in enumerate(self.buses):
+            if index != owner:
+                bus.send(*message)
+
+
+class FrontLoop(eventloop.EventLoop):
+    """Accepts and logs in clients, then passes each one to its worker."""
+
+    def __init__(self, server_socket, buses):
+        self.buses = buses
+        self.directory = Directory(buses)
+        self.tokens = itertools.count(1)
+        eventloop.EventLoop.__init__(self, server_socket, self.directory)
+        for index, bus in enumerate(buses):
+            self.addReader(bus.fileno(), self.receiver(index))
+
+    def register(self, client_socket):
+        connection = eventloop.EventLoop.register(self, client_socket)
+        connection.dialog = login.LoginSession(self.directory, askRoom=True)
+        return connection
+
+    def loggedIn(self, connection, dialog):
+        room = dialog.room
+        if room is None:
+            room = session.LOBBY
+        shard = shardFor(room, len(self.buses))
+        player = RemotePlayer(dialog.username, self.tokens.next(), dialog.dm, room, self.buses[shard])
+        previous = self.directory.add(player, shard)
+        if previous is not None:
+            previous.kill()
+
+        lines = list(connection.lines)
+        client_socket = self.detach(connection)
+        self.buses[shard].sendSocket(client_socket, 'adopt', player.name, player.token, player.dm, "",
+                                     colorer.FULL, room, connection.decoder, lines, False)
+        client_socket.close()
+
+    def receiver(self, index):
+        bus = self.buses[index]
+
+        def receive():
+            bus.receive(lambda message: self.handle(index, message))
+        return receive
+
+    def handle(self, index, message):
+        kind = message[0]
+        if kind == 'deliver':
+            name, payload = message[1:]
+            player = self.directory.findPlayer(name)
+            if player is not None:
+                player.sendPayload(payload)
+
+        elif kind == 'moved':
+            name, token, room = message[1:]
+            player = self.directory.findPlayer(name)
+            if player is not None and player.token == token:
+                player.instance = RemoteRoom(room)
+                self.directory.announce(index, 'player', name, token, player.dm, room)
+
+        elif kind == 'left':
+            name, token = message[1:]
+            player = self.directory.findPlayer(name)
+            if player is not None and player.token == token:
+                self.directory.leave(player)
+
+        elif kind == 'migrate':
+            name, token, dm, status, color, room, decoder, lines, arriving = message[1:]
+            client_socket = self.buses[index].receiveSocket()
+            player = self.directory.findPlayer(name)
+            if player is None or player.token != token:
+                # taken over while moving
+                client_socket.close()
+                return
+            shard = shardFor(room, len(self.buses))
+            player.instance = RemoteRoom(room)
+            player.bus = self.buses[shard]
+            self.directory.announce(shard, 'player', name, token, dm, room)
+            player.bus.sendSocket(client_socket, 'adopt', name, token, dm, status, color, room, decoder, lines, arriving)
+            client_socket.close()
+
+        elif kind == 'stop':
+            self.removeReader(self.buses[index].fileno())
+
+
+class ShardWorld(session.World):
+    """The rooms owned by one worker, plus a replica of the front's
+       directory for everyone served elsewhere."""
+
+    def __init__(self, index, count, bus, archive=None, library=None, diceDir=None, recorder=None):
+        self.index = index
+        self.count = count
+        self.bus = bus
+        self.loop = None
+        self.remote = session.Registry()
+        self.tokens = {}
+        session.World.__init__(self, archive=archive, library=library, diceDir=diceDir, recorder=recorder)
+
+    def owns(self, name):
+        return shardFor(name, self.count) == self.index
+
+    def exists(self, name):
+        if self.owns(name):
+            return session.World.exists(self, name)
+        key = name.lower()
+        for player in self.remote:
+            if player.instance.name == key:
+                return True
+        return self.archive is not None and self.archive.has(key)
+
+    def room(self, name, create=True):
+        if not self.owns(name):
+            if not create and not self.exists(name):
+                return None
+            return RemoteRoom(name.lower(), self)
+        return session.World.room(self, name, create)
+
+    def findRoom(self, name):
+        if not self.owns(name):
+            return None
+        return session.World.findRoom(self, name)
+
+    def listRooms(self):
+        rooms = session.World.listRooms(self)
+        remote = {}
+        for player in self.remote:
+            name = player.instance.name
+            if name not in remote:
+                remote[name] = RemoteRoom(name, self)
+            remote[name].connections.append(player)
+        return rooms + sorted(remote.values(), key=lambda room: room.name)
+
+    def findPlayer(self, name):
+        player = self.players.find(name)
+        if player is None:
+            player = self.remote.find(name)
+        return player
+
+    def allPlayers(self):
+        return tuple(self.players) + tuple(self.remote)
+
+    def move(self, player, room):
+        if not isinstance(room, RemoteRoom):
+            session.World.move(self, player, room)
+            self.bus.send('moved', player.name, self.tokens.get(player.name.lower()), room.name)
+            return
+
+        old = player.instance
+        old.broadcast(colorfy("[SERVER] " + player.name + " leaves for the " + room.name + ".", "bright yellow"),
+                      actor=player, skipActor=True)
+        old.removeConnection(player)
+        self.players.remove(player)
+        self.vacate(old)
+        self.loop.callSoon(lambda: self.migrate(player, room.name))
+
+    def migrate(self, player, room, arriving=True):
+        token = self.tokens.pop(player.name.lower(), None)
+        connection = player.proxy
+        lines = list(connection.lines)
+        client_socket = self.loop.detach(connection)
+        self.bus.sendSocket(client_socket, 'migrate', player.name, token, player.dm, player.status,
+                            player.color, room, connection.decoder, lines, arriving)
+        client_socket.close()
+
+    def leave(self, player):
+        session.World.leave(self, player)
+        token = self.tokens.pop(player.name.lower(), None)
+        if token is not None:
+            self.bus.send('left', player.name, token)
+
+    def handle(self, message):
+        kind = message[0]
+        if kind == 'adopt':
+            name, token, dm, status, color, room, decoder, lines, arriving = message[1:]
+            self.adopt(self.bus.receiveSocket(), name, token, dm, status, color, room, decoder, lines, arriving)
+
+        elif kind == 'deliver':
+            name, payload = message[1:]
+            player = self.players.find(name)
+            if player is not None:
+                player.sendPayload(payload)
+
+        elif kind == 'player':
+            name, token, dm, room = message[1:]
+            local = self.players.find(name)
+            if local is not None and self.tokens.get(name.lower()) == token:
+                return
+            self.remote.add(RemotePlayer(name, token, dm, room, self.bus))
+
+        elif kind == 'gone':
+            name, token = message[1:]
+            player = self.remote.find(name)
+            if player is not None and player.token == token:
+                self.remote.remove(player)
+
+        elif kind == 'kill':
+            name, token = message[1:]
+            player = self.players.find(name)
+            if player is not None and self.tokens.get(name.lower()) == token:
+                self.tokens.pop(name.lower())
+                session.World.leave(self, player)
+                player.proxy.kill()
+
+        elif kind == 'stop':
+            self.loop.stop()
+
+    def adopt(self, client_socket, name, token, dm, status, color, room, decoder, lines, arriving):
+        connection = self.loop.adopt(client_socket, decoder, lines)
+        player = entity.Entity(connection, name, self.lobby)
+        player.dm = dm
+        player.status = status
+        player.color = color
+        self.tokens[name.lower()] = token
+        stale = self.remote.find(name)
+        if stale is not None:
+            self.remote.remove(stale)
+
+        # only DMs open new rooms, and this worker may have none to spare;
+        # anyone who can't get in goes to the lobby, which may be elsewhere
+        target = self.room(room, dm)
+        if target is None:
+            player.sendMessage("The " + room + " isn't open, so you're going to the lobby.")
+            if isinstance(self.lobby, RemoteRoom):
+                self.migrate(player, self.lobby.name, arriving)
+                return
+            target = self.lobby
+        if arriving:
+            previous = self.players.add(player)
+            if previous is not None:
+                previous.instance.removeConnection(previous)
+            self.arrive(player, target)
+            if previous is not None:
+                self.vacate(previous.instance)
+        else:
+            login.enterSession(self, player, target)
+        self.loop.processLines(connection)
+
+
+def runWorker(index, count, conn, dataDir=None):
+    bus = Bus(conn)
+    # rooms never span workers, so every worker can share the directory
+    archive = None
+    library = None
+    diceDir = None
+    recorder = None
+    if dataDir:
+        archive = scenestore.Archive(dataDir)
+        library = scenelibrary.Library(os.path.join(dataDir, "library"))
+        library.preload()
+        diceDir = os.path.join(dataDir, "dice")
+        recorder = transcript.Recorder(os.path.join(dataDir, "transcripts"))
+    world = ShardWorld(index, count, bus, archive, library, diceDir, recorder)
+    loop = eventloop.EventLoop(None, world)
+    world.loop = loop
+
+    loop.addReader(bus.fileno(), lambda: bus.receive(world.handle))
+
+    functionmapper.helpIndex.refresh()
+    commandparser.startDispatching()
+    metrics.startDumping(".worker-" + str(index))
+    print "Worker " + str(index) + ": Serving."
+    try:
+        loop.run()
+    except KeyboardInterrupt:
+        pass
+    except:
+        exc_type, exc_value, exc_traceback = sys.exc_info()
+        traceback.print_exception(exc_type, exc_value, exc_traceback, limit=None, file=sys.stdout)
+    commandparser.stopDispatching()
+    for player in world.players:
+        player.proxy.kill()
+    loop.close()
+    if archive is not None:
+        archive.close()
+    if recorder is not None:
+        recorder.close()
+    print "Worker " + str(index) + ": Bye!"
+
+
+def startWorkers(count, dataDir=None):
+    """Forks the workers. Call this before opening the listening socket so
+       the workers don't inherit it. Returns (processes, buses)."""
+    processes = []
+    buses = []
+    for index in range(count):
+        front, worker = multiprocessing.Pipe(duplex=True)
+        process = multiprocessing.Process(target=runWorker, args=(index, count, worker, dataDir),
+                                          name="Worker-" + str(index))
+        process.start()
+        worker.close()
+        processes.append(process)
+        buses.append(Bus(front))
+    return processes, buses
+
+
+def serveSharded(server_socket, buses):
+    loop = FrontLoop(server_socket, buses)
+    try:
+        loop.run()
+    finally:
+        for bus in buses:
+            try:
+                bus.send('stop')
+            except (IOError, OSError):
+                pass
+        loop.close()
@@ -0,0 +1,122 @@
+import re
+
+IAC = chr(255)
+DONT = chr(254)
+DO = chr(253)
+WONT = chr(252)
+WILL = chr(251)
+SB = chr(250)
+SE = chr(240)
+NOP = chr(241)
+
+NEGOTIATION = (WILL, WONT, DO, DONT)
+
+# decoder states for telnet commands that span reads
+DATA = 0
+COMMAND = 1
+OPTION = 2
+SUBNEGOTIATION = 3
+SUBNEGOTIATION_IAC = 4
+
+LINE_BREAK = re.compile("\r\n|\r|\n")
+
+# lines longer than this are cut short; the rest, up to the next line
+# break, is thrown away
+maxLineLength = 4096
+
+
+class LineDecoder(object):
+    """Turns a stream of reads into complete lines.
+
+       Reads can end in the middle of a line (or of a CRLF, or of a telnet
+       command) and can carry several lines at once; feed() returns every
+       line completed by the data given so far and keeps the rest for next
+       time. CR, LF and CRLF all end a line, and telnet IAC sequences are
+       removed before anything else sees the data."""
+
+    def __init__(self, maxLength=None):
+        if maxLength is None:
+            maxLength = maxLineLength
+        self.maxLength = maxLength
+        self.state = DATA
+        self.partial = ""
+        self.lastCR = False
+        self.overflow = False
+
+    def feed(self, data):
+        if self.state != DATA or IAC in data:
+            data = self.stripCommands(data)
+        if "\0" in data:
+            # telnet sends a bare CR as CR NUL
+            data = data.replace("\0", "")
+        if not data:
+            return []
+
+        if self.lastCR and data[0] == "\n":
+            # the LF of a CRLF that was split across two reads
+            data = data[1:]
+        self.lastCR = data.endswith("\r")
+
+        parts = LINE_BREAK.split(data)
+        lines = []
+        for part in parts[:-1]:
+            lines.append(self.finish(part))
+            self.partial = ""
+            self.overflow = False
+        self.extend(parts[-1])
+        return lines
+
+    def finish(self, part):
+        if self.overflow:
+            return self.partial
+        return (self.partial + part)[:self.maxLength]
+
+    def extend(self, part):
+        if self.overflow or not part:
+            return
+        self.partial = self.partial + part
+        if len(self.partial) > self.maxLength:
+            self.partial = self.partial[:self.maxLength]
+            self.overflow = True
+
+    def stripCommands(self, data):
+        out = []
+        state = self.state
+        i = 0
+        n = len(data)
+        while i < n:
+            if state == DATA:
+                j = data.find(IAC, i)
+                if j < 0:
+                    out.append(data[i:])
+                    break
+                out.append(data[i:j])
+                i = j + 1
+                state = COMMAND
+                continue
+
+            c = data[i]
+            i += 1
+            if state == COMMAND:
+                if c == IAC:
+                    # IAC IAC is an escaped 255 data byte
+                    out.append(IAC)
+                    state = DATA
+                elif c in NEGOTIATION:
+                    state = OPTION
+                elif c == SB:
+                    state = SUBNEGOTIATION
+                else:
+                    state = DATA
+            elif state == OPTION:
+                state = DATA
+            elif state == SUBNEGOTIATION:
+                if c == IAC:
+                    state = SUBNEGOTIATION_IAC
+            elif state == SUBNEGOTIATION_IAC:
+                if c == SE:
+                    state = DATA
+                else:
+                    state = SUBNEGOTIATION
+        self.state = state
+        return "".join(out)
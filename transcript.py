@@ -0,0 +1,450 @@
+import os
+import re
+import sys
+import gzip
+import time
+import bisect
+import urllib
+import marshal
+import calendar
+import threading
+import traceback
+from collections import deque
+
+import colorer
+import scenestore
+
+"""
+A record of everything said and done in each room, for players who missed
+it and DMs looking back over a session.
+
+Whatever a room broadcasts is recorded as an event, (time, speaker, text),
+with the colors taken out. Each room's events go into chunk files, one per
+hour of wall-clock time, in the room's own directory:
+
+    20240501-190000.log    the chunk being written: framed records, as in
+                           scenestore, cut back to the last whole record
+                           after a crash
+    20240501-180000.gz     a finished chunk, compressed in one go once its
+                           hour is over
+    index                  what each finished chunk holds: its first and
+                           last times, how many events, who spoke and every
+                           word used
+
+Queries go to the index first, held in memory, and only open the chunks
+that can answer them: "since" finds its first chunk by time, and a search
+only reads chunks that have every word (and the speaker) asked for, newest
+first, until it has enough. A log that runs for months costs a search one
+set lookup per hour recorded, plus the few chunks that match.
+
+All writing happens on one background thread; recording an event never
+waits on the disk. Transcripts are flushed each batch but not fsynced, so a
+crash of the machine (not just the server) can lose the last few seconds.
+"""
+
+LOG = ".log"
+CHUNK = ".gz"
+INDEX = "index"
+NAMING = "%Y%m%d-%H%M%S"
+
+# each chunk covers this many seconds
+chunkSeconds = 3600
+# how many events a query returns at most
+queryLimit = 50
+
+WORD = re.compile(r"[a-z0-9']+")
+UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
+
+def words(text):
+    """The words a search matches on: lowercased letters, digits and
+       apostrophes."""
+    return set(WORD.findall(text.lower()))
+
+
+def slotOf(moment):
+    return int(moment // chunkSeconds) * chunkSeconds
+
+
+def parseTime(text, now=None):
+    """Reads "10m", "2h", "3d", "20:30", "2024-05-01" or "2024-05-01 20:30"
+       (local time) as seconds since the epoch. Returns None if it can't."""
+    if now is None:
+        now = time.time()
+    text = text.strip().lower()
+    match = re.match(r"^(\d+) ?([smhd])$", text)
+    if match:
+        return now - int(match.group(1)) * UNITS[match.group(2)]
+    for form in ("%Y-%m-%d %H:%M", "%Y-%m-%d"):
+        try:
+            return time.mktime(time.strptime(text, form))
+        except ValueError:
+            pass
+    try:
+        clock = time.strptime(text, "%H:%M")
+    except ValueError:
+        return None
+    today = time.localtime(now)
+    moment = time.mktime((today.tm_year, today.tm_mon, today.tm_mday, clock.tm_hour, clock.tm_min, 0, 0, 0, -1))
+    if moment > now:
+        moment -= 86400
+    return moment
+
+
+def describe(event, now=None):
+    """An event as a line of text, stamped with its time."""
+    if now is None:
+        now = time.time()
+    moment, speaker, text = event
+    if time.localtime(moment)[:3] == time.localtime(now)[:3]:
+        stamp = time.strftime("%H:%M", time.localtime(moment))
+    else:
+        stamp = time.strftime("%Y-%m-%d %H:%M", time.localtime(moment))
+    return "[" + stamp + "] " + text
+
+
+def readChunk(path):
+    """Returns the events in a finished chunk, as many as can be read."""
+    pieces = []
+    try:
+        f = gzip.open(path, 'rb')
+    except IOError:
+        return []
+    try:
+        while True:
+            piece = f.read(65536)
+            if not piece:
+                break
+            pieces.append(piece)
+    except (IOError, EOFError):
+        pass
+    finally:
+        f.close()
+    return scenestore.unframe("".join(pieces))[0]
+
+
+class Chunk(object):
+    """What the index knows about one chunk file."""
+
+    def __init__(self, slot, first=None, last=None, count=0, speakers=(), vocabulary=()):
+        self.slot = slot
+        self.name = time.strftime(NAMING, time.gmtime(slot))
+        self.first = first
+        self.last = last
+        self.count = count
+        self.speakers = set(speakers)
+        self.vocabulary = set(vocabulary)
+
+    @classmethod
+    def fromName(cls, name):
+        return cls(calendar.timegm(time.strptime(name, NAMING)))
+
+    def add(self, event):
+        moment, speaker, text = event
+        if self.first is None:
+            self.first = moment
+        self.last = moment
+        self.count += 1
+        if speaker:
+            self.speakers.add(speaker.lower())
+        self.vocabulary.update(words(text))
+
+    def has(self, wanted, speaker):
+        if speaker is not None and speaker not in self.speakers:
+            return False
+        return wanted <= self.vocabulary
+
+    def dump(self):
+        return (self.slot, self.first, self.last, self.count, list(self.speakers), list(self.vocabulary))
+
+
+class Transcript(object):
+    """One room's chunks and their index. Only the recorder's thread
+       writes; queries can come from any thread."""
+
+    def __init__(self, recorder, room):
+        self.recorder = recorder
+        self.room = room
+        self.directory = os.path.join(recorder.directory, urllib.quote(room, safe=''))
+        self.lock = threading.Lock()
+        # Chunk, oldest first; the last one may be the one being written
+        self.chunks = []
+        self.current = None
+        self.file = None
+        self.load()
+
+    def path(self, chunk, extension):
+        return os.path.join(self.directory, chunk.name + extension)
+
+    def load(self):
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        indexed = {}
+        try:
+            with open(os.path.join(self.directory, INDEX), 'rb') as f:
+                for entry in marshal.load(f):
+                    chunk = Chunk(*entry)
+                    indexed[chunk.name] = chunk
+        except (IOError, EOFError, ValueError, TypeError):
+            pass
+
+        found = {}
+        stale = False
+        now = time.time()
+        for filename in sorted(os.listdir(self.directory)):
+            name, extension = os.path.splitext(filename)
+            if extension == CHUNK:
+                chunk = indexed.get(name)
+                if chunk is None:
+                    chunk = self.rebuild(name, readChunk(os.path.join(self.directory, filename)))
+                    stale = True
+                if chunk is not None:
+                    found[name] = chunk
+            elif extension == LOG:
+                path = os.path.join(self.directory, filename)
+                if name in found:
+                    # compressed, but stopped before the log was removed
+                    os.remove(path)
+                    continue
+                events, length = scenestore.readFrames(path)
+                if length != os.path.getsize(path):
+                    with open(path, 'r+b') as f:
+                        f.truncate(length)
+                chunk = self.rebuild(name, events)
+                if chunk is None:
+                    continue
+                found[name] = chunk
+                if chunk.slot == slotOf(now):
+                    self.current = chunk
+                else:
+                    self.compress(chunk)
+                    stale = True
+        if set(indexed) != set(name for name, chunk in found.items() if chunk is not self.current):
+            stale = True
+
+        self.chunks = sorted(found.values(), key=lambda chunk: chunk.slot)
+        if stale:
+            self.saveIndex()
+
+    def rebuild(self, name, events):
+        try:
+            chunk = Chunk.fromName(name)
+        except ValueError:
+            return None
+        for event in events:
+            chunk.add(event)
+        return chunk
+
+    def saveIndex(self):
+        # the chunk being written is left out; it's read back on startup
+        entries = [chunk.dump() for chunk in self.chunks if chunk is not self.current]
+        path = os.path.join(self.directory, INDEX)
+        with open(path + ".tmp", 'wb') as f:
+            marshal.dump(entries, f)
+        os.rename(path + ".tmp", path)
+
+    def compress(self, chunk):
+        source = self.path(chunk, LOG)
+        target = self.path(chunk, CHUNK)
+        with open(source, 'rb') as f:
+            data = f.read()
+        out = gzip.open(target + ".tmp", 'wb')
+        try:
+            out.write(data)
+        finally:
+            out.close()
+        # readers look for the compressed chunk first, so it has to be in
+        # place before the log goes
+        os.rename(target + ".tmp", target)
+        os.remove(source)
+
+    def record(self, speaker, message):
+        """Queues something the room broadcast."""
+        self.recorder.put(self, (time.time(), speaker, message))
+
+    def append(self, events):
+        # recorder thread
+        for moment, speaker, message in events:
+            event = (moment, speaker, colorer.ESCAPE.sub("", message))
+            slot = slotOf(moment)
+            if self.current is None or self.current.slot != slot:
+                self.seal()
+                with self.lock:
+                    self.current = Chunk(slot)
+                    self.chunks.append(self.current)
+            if self.file is None:
+                self.file = open(self.path(self.current, LOG), 'ab')
+            self.file.write(scenestore.frame(event))
+            with self.lock:
+                self.current.add(event)
+        if self.file is not None:
+            self.file.flush()
+
+    def due(self, now):
+        return self.current is not None and self.current.slot != slotOf(now)
+
+    def seal(self):
+        """Compresses the chunk being written, once its time is up."""
+        # recorder thread
+        if self.current is None:
+            return
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        self.compress(self.current)
+        with self.lock:
+            self.current = None
+        self.saveIndex()
+
+    def flush(self):
+        """Waits until everything recorded so far is on disk."""
+        self.recorder.flush()
+
+    def events(self, chunk):
+        compressed = self.path(chunk, CHUNK)
+        if os.path.exists(compressed):
+            return readChunk(compressed)
+        return scenestore.readFrames(self.path(chunk, LOG))[0]
+
+    def since(self, moment, limit=queryLimit):
+        """Returns (events, more): the first events from a given time on,
+           and whether there are more after them."""
+        with self.lock:
+            chunks = list(self.chunks)
+        slots = [chunk.slot for chunk in chunks]
+        found = []
+        for chunk in chunks[max(0, bisect.bisect_right(slots, moment) - 1):]:
+            if chunk.last is None or chunk.last < moment:
+                continue
+            found.extend(event for event in self.events(chunk) if event[0] >= moment)
+            if len(found) > limit:
+                return found[:limit], True
+        return found, False
+
+    def tail(self, limit=queryLimit):
+        """Returns the last few events."""
+        with self.lock:
+            chunks = list(self.chunks)
+        found = []
+        for chunk in reversed(chunks):
+            found = self.events(chunk) + found
+            if len(found) >= limit:
+                break
+        return found[-limit:]
+
+    def search(self, text, speaker=None, limit=queryLimit):
+        """Returns (events, more): the latest events with every word of the
+           text, by the given speaker if there is one, and whether there are
+           older ones too."""
+        wanted = words(text)
+        if speaker is not None:
+            speaker = speaker.lower()
+        with self.lock:
+            chunks = [chunk for chunk in self.chunks if chunk.has(wanted, speaker)]
+        found = []
+        for chunk in reversed(chunks):
+            matches = [event for event in self.events(chunk)
+                       if (speaker is None or (event[1] or "").lower() == speaker) and wanted <= words(event[2])]
+            found = matches + found
+            if len(found) > limit:
+                return found[-limit:], True
+        return found, False
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+class Recorder(object):
+    """A directory of room transcripts and the thread that writes them."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.transcripts = {}
+        self.lock = threading.Lock()
+        self.ready = threading.Condition(self.lock)
+        self.drained = threading.Condition(self.lock)
+        self.pending = deque()
+        # events queued and events written, so flush knows what to wait for
+        self.queued = 0
+        self.written = 0
+        self.closing = False
+        self.writer = threading.Thread(target=self.writeForever, name="TranscriptWriter")
+        self.writer.daemon = True
+        self.writer.start()
+
+    def open(self, room):
+        with self.lock:
+            if room not in self.transcripts:
+                self.transcripts[room] = Transcript(self, room)
+            return self.transcripts[room]
+
+    def put(self, transcript, event):
+        with self.lock:
+            if self.closing:
+                return
+            self.pending.append((transcript, event))
+            self.queued += 1
+            self.ready.notify()
+
+    def flush(self, timeout=5.0):
+        deadline = time.time() + timeout
+        with self.lock:
+            target = self.queued
+            while self.written < target and self.writer.is_alive():
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self.drained.wait(remaining)
+
+    def writeForever(self):
+        while True:
+            with self.lock:
+                if not self.pending and not self.closing:
+                    self.ready.wait(chunkSeconds / 60.0)
+                batch = self.pending
+                self.pending = deque()
+                closing = self.closing
+                transcripts = self.transcripts.values()
+
+            try:
+                self.write(batch, transcripts)
+            except:
+                exc_type, exc_value, exc_traceback = sys.exc_info()
+                traceback.print_exception(exc_type, exc_value, exc_traceback, limit=None, file=sys.stdout)
+
+            with self.lock:
+                self.written += len(batch)
+                self.drained.notify_all()
+
+            if closing and not batch:
+                break
+
+        for transcript in transcripts:
+            transcript.close()
+
+    def write(self, batch, transcripts):
+        byTranscript = {}
+        order = []
+        for transcript, event in batch:
+            if transcript not in byTranscript:
+                byTranscript[transcript] = []
+                order.append(transcript)
+            byTranscript[transcript].append(event)
+        for transcript in order:
+            transcript.append(byTranscript[transcript])
+
+        now = time.time()
+        for transcript in transcripts:
+            if transcript.due(now):
+                transcript.seal()
+
+    def close(self):
+        """Writes out everything recorded so far and stops the writer."""
+        with self.lock:
+            self.closing = True
+            self.ready.notify()
+        self.writer.join()